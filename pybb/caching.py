@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+"""
+Full page cache for anonymous users, conditional GET and caching proxy support.
+
+Every cached page is stored under a key which includes current values of the
+version keys the page depends on (topic, forum, category, index or forum structure).
+Post, topic, forum and category signals bump these versions, so stale pages
+become unreachable immediately and simply expire by timeout. The same versions
+are used for ETag calculation, and their names are sent to caching proxy as
+surrogate keys and purged through PYBB_PURGE_BACKEND.
+"""
+
+from __future__ import unicode_literals
+import calendar
+import hashlib
+import time
+
+from django.contrib import messages
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.utils import translation
+from django.utils.encoding import force_bytes, force_text
+from django.utils.http import http_date, parse_etags, parse_http_date_safe, quote_etag
+from django.utils.importlib import import_module
+
+from pybb import defaults, tasks
+from pybb.util import build_cache_key
+
+
+INDEX = 'index'
+STRUCTURE = 'structure'
+
+
+def topic_version(topic_id):
+    return 'topic_%s' % topic_id
+
+
+def forum_version(forum_id):
+    return 'forum_%s' % forum_id
+
+
+def category_version(category_id):
+    return 'category_%s' % category_id
+
+
+def _new_version():
+    # Based on current time, so evicted version key never gets value it had before
+    return int(time.time() * 1000)
+
+
+def get_versions(names):
+    """
+    Return list of current values for version keys `names`, missing keys are initialized
+    """
+    keys = [build_cache_key('page_cache_version', name=name) for name in names]
+    values = cache.get_many(keys)
+    for key in keys:
+        if key not in values:
+            version = _new_version()
+            if not cache.add(key, version):
+                version = cache.get(key, version)
+            values[key] = version
+    return [values[key] for key in keys]
+
+
+def bump_versions(names):
+    """
+    Invalidate all cached pages which depends on any of version keys `names`
+    """
+    for name in set(names):
+        key = build_cache_key('page_cache_version', name=name)
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, _new_version())
+
+
+def is_enabled():
+    return bool(defaults.PYBB_ANONYMOUS_PAGE_CACHE_TIMEOUT)
+
+
+def versions_enabled():
+    return is_enabled() or defaults.PYBB_CONDITIONAL_GET
+
+
+def get_visibility_class(user):
+    """
+    Users of the same visibility class see the same set of topics and posts
+    """
+    if user.is_superuser:
+        return 'superuser'
+    if user.is_authenticated():
+        # moderators and authors see their own posts on moderation
+        return 'user_%s' % user.pk
+    return 'anonymous'
+
+
+def make_etag(request, dependencies, *parts):
+    """
+    Build ETag for page requested by `request` from versions of `dependencies` and any extra `parts`
+    """
+    versions = get_versions(sorted(set(dependencies)))
+    parts = [request.get_full_path(), translation.get_language() or '', get_visibility_class(request.user)] + \
+        list(parts) + versions
+    return hashlib.md5(force_bytes('|'.join(force_text(p) for p in parts))).hexdigest()
+
+
+def _timestamp(dt):
+    return calendar.timegm(dt.utctimetuple())
+
+
+def is_not_modified(request, etag, last_modified=None):
+    """
+    Check If-None-Match and If-Modified-Since headers of `request`
+    """
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        etags = parse_etags(if_none_match)
+        return etag in etags or '*' in etags
+    if_modified_since = request.META.get('HTTP_IF_MODIFIED_SINCE')
+    if if_modified_since and last_modified:
+        if_modified_since = parse_http_date_safe(if_modified_since)
+        return if_modified_since is not None and _timestamp(last_modified) <= if_modified_since
+    return False
+
+
+def set_validators(response, etag, last_modified=None):
+    response['ETag'] = quote_etag(etag)
+    if last_modified:
+        response['Last-Modified'] = http_date(_timestamp(last_modified))
+
+
+def get_surrogate_keys(dependencies):
+    return ['pybb-%s' % name.replace('_', '-') for name in dependencies]
+
+
+def set_surrogate_keys(response, dependencies):
+    """
+    Mark public `response` with surrogate keys, so caching proxy can purge it when content changes
+    """
+    if defaults.PYBB_SURROGATE_KEY_HEADER:
+        keys = get_surrogate_keys(sorted(set(dependencies)))
+        response[defaults.PYBB_SURROGATE_KEY_HEADER] = defaults.PYBB_SURROGATE_KEY_SEPARATOR.join(keys)
+
+
+class BasePurgeBackend(object):
+    """
+    Base class for purging pages from caching proxy (CDN, varnish etc). Subclasses should implement
+    `purge` method, that accepts list of surrogate keys, which was sent with pages in
+    `PYBB_SURROGATE_KEY_HEADER` header.
+    """
+    def purge(self, keys):
+        raise NotImplementedError
+
+
+class LocalPurgeBackend(BasePurgeBackend):
+    """
+    Stand-in backend which only remembers purged keys, useful for tests and local development
+    """
+    def __init__(self):
+        self.purged = []
+
+    def purge(self, keys):
+        self.purged.extend(keys)
+
+
+_purge_backend = (None, None)
+
+
+def get_purge_backend():
+    global _purge_backend
+    name = defaults.PYBB_PURGE_BACKEND
+    if not name:
+        return None
+    if _purge_backend[0] != name:
+        module_name, class_name = name.rsplit('.', 1)
+        _purge_backend = (name, getattr(import_module(module_name), class_name)())
+    return _purge_backend[1]
+
+
+def invalidate(names):
+    """
+    Invalidate cached pages, ETags and pages in caching proxy which depends on version keys `names`.
+    Inside `pybb.tasks.atomic` block pages are invalidated after commit, so they can't be cached again
+    with data which is not committed yet.
+    """
+    tasks.on_commit(_invalidate, tuple(sorted(set(names))))
+
+
+def _invalidate(names):
+    if versions_enabled():
+        bump_versions(names)
+    backend = get_purge_backend()
+    if backend is not None:
+        backend.purge(get_surrogate_keys(names))
+
+
+def is_cacheable_request(request):
+    if not is_enabled() or request.method not in ('GET', 'HEAD'):
+        return False
+    if request.user.is_authenticated():
+        return False
+    # Do not show one-time messages from cache and do not store them in cache
+    return not len(messages.get_messages(request))
+
+
+def get_page_cache_key(request, dependencies):
+    """
+    Build cache key for page requested by `request`, `dependencies` is list of version key names
+    """
+    versions = get_versions(sorted(set(dependencies)))
+    parts = [request.get_full_path(), translation.get_language() or ''] + versions
+    return build_cache_key('anonymous_page',
+                           hash=hashlib.md5(force_bytes('|'.join(force_text(p) for p in parts))).hexdigest())
+
+
+def get_cached_page(key):
+    data = cache.get(key)
+    if data is None:
+        return None
+    content, content_type = data
+    return HttpResponse(content, content_type=content_type)
+
+
+def cache_page(key, request, response):
+    """
+    Store `response` in cache after it will be rendered.
+    Pages which set cookies or contain csrf token (e.g. anonymous post form) are not cached.
+    """
+    def store(response):
+        if response.status_code != 200 or response.cookies or request.META.get('CSRF_COOKIE_USED'):
+            return
+        cache.set(key, (response.content, response['Content-Type']), defaults.PYBB_ANONYMOUS_PAGE_CACHE_TIMEOUT)
+
+    if getattr(response, 'is_rendered', True):
+        store(response)
+    else:
+        response.add_post_render_callback(store)
+
+
+def post_saved(instance, **kwargs):
+    invalidate([topic_version(instance.topic_id), INDEX])
+
+
+def topic_saved(instance, **kwargs):
+    invalidate([topic_version(instance.id), forum_version(instance.forum_id), INDEX])
+
+
+def forum_saved(instance, **kwargs):
+    names = [forum_version(instance.id), category_version(instance.category_id), INDEX]
+    if instance.parent_id:
+        names.append(forum_version(instance.parent_id))
+    update_fields = kwargs.get('update_fields')
+    if not update_fields or set(update_fields) - set(['post_count', 'topic_count', 'updated']):
+        # name, hidden flag or position changed, not only counters
+        names.append(STRUCTURE)
+    invalidate(names)
+
+
+def category_saved(instance, **kwargs):
+    invalidate([category_version(instance.id), INDEX, STRUCTURE])
@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+"""
+Buffered forum and topic views counters.
+
+Every new post changes counters of its forum, so with many concurrent posters in one forum all of them wait
+for lock of the same forum row. If PYBB_BUFFER_FORUM_COUNTERS is enabled, changes are inserted into separate
+delta table instead and folded into forums by `flush_forum_counters` (`pybb_flush_counters` command),
+which should be run periodically. Views show forum counters with pending deltas applied.
+
+If PYBB_TOPIC_VIEWS_BUFFER is enabled, topic views are counted in several cache keys (shards) per topic,
+and every process queues `flush_topic_views` task for topics viewed in it once per
+PYBB_TOPIC_VIEWS_FLUSH_INTERVAL seconds. Task moves counted views to database with one update per
+distinct number of views. `pybb_flush_counters` command moves counted views of all topics.
+"""
+
+from __future__ import unicode_literals
+import hashlib
+import random
+import threading
+import time
+from collections import defaultdict
+
+from django.core.cache import cache
+from django.db.models import Count, F, Max, Q, Sum
+from django.utils.encoding import force_bytes
+
+from pybb import defaults, tasks
+from pybb.util import build_cache_key, iter_id_chunks
+
+
+def add_forum_delta(forum_id, post_count=0, topic_count=0, updated=None):
+    from pybb.models import ForumCounterDelta
+
+    ForumCounterDelta.objects.create(forum_id=forum_id, post_count=post_count, topic_count=topic_count,
+                                     updated=updated)
+
+
+def get_pending(forum_ids):
+    """
+    Return dict forum id -> (post count delta, topic count delta, last updated time) for forums
+    which have pending deltas
+    """
+    from pybb.models import ForumCounterDelta
+
+    if not forum_ids:
+        return {}
+    rows = ForumCounterDelta.objects.filter(forum__in=forum_ids).values('forum')\
+        .annotate(post_count=Sum('post_count'), topic_count=Sum('topic_count'), updated=Max('updated'))
+    return dict((row['forum'], (row['post_count'], row['topic_count'], row['updated'])) for row in rows)
+
+
+def with_pending(forums):
+    """
+    Return list of `forums` with pending deltas added to their counters. Nothing is queried
+    if buffering is disabled. Deltas are added to each forum instance once.
+    """
+    forums = list(forums)
+    if not defaults.PYBB_BUFFER_FORUM_COUNTERS:
+        return forums
+    pending = get_pending([forum.pk for forum in forums if not hasattr(forum, '_pending_applied')])
+    for forum in forums:
+        if hasattr(forum, '_pending_applied'):
+            continue
+        forum._pending_applied = True
+        if forum.pk in pending:
+            post_count, topic_count, updated = pending[forum.pk]
+            forum.post_count += post_count
+            forum.topic_count += topic_count
+            if updated and (forum.updated is None or updated > forum.updated):
+                forum.updated = updated
+    return forums
+
+
+def flush_forum_counters():
+    """
+    Fold pending deltas into forums, returns number of updated forums. Deltas added while flush is
+    running are left for the next one.
+    """
+    from pybb.models import Forum, ForumCounterDelta
+
+    with tasks.atomic():
+        last_id = ForumCounterDelta.objects.aggregate(last_id=Max('id'))['last_id']
+        if last_id is None:
+            return 0
+        deltas = ForumCounterDelta.objects.filter(id__lte=last_id)
+        rows = list(deltas.values('forum').annotate(post_count=Sum('post_count'), topic_count=Sum('topic_count'),
+                                                    updated=Max('updated')).order_by('forum'))
+        for row in rows:
+            forums = Forum.objects.filter(pk=row['forum'])
+            forums.update(post_count=F('post_count') + row['post_count'],
+                          topic_count=F('topic_count') + row['topic_count'])
+            if row['updated']:
+                forums.filter(Q(updated__lt=row['updated']) | Q(updated=None)).update(updated=row['updated'])
+        deltas.delete()
+    return len(rows)
+
+
+def get_post_counters(posts, field):
+    """
+    Return dict `field` value -> (number of `posts`, update or creation time of the last post)
+    with two queries
+    """
+    rows = list(posts.values(field).annotate(count=Count('id'), last_created=Max('created')).order_by())
+    last_created = dict((row[field], row['last_created']) for row in rows)
+    counters = dict((row[field], (row['count'], row['last_created'])) for row in rows)
+    if rows:
+        last_posts = posts.filter(created__in=set(last_created.values())).values_list(field, 'created', 'updated')
+        for key, created, updated in last_posts:
+            if created == last_created[key] and updated:
+                counters[key] = (counters[key][0], updated)
+    return counters
+
+
+def recount_topics(topics, posts, only_changed=False):
+    """
+    Recount `topics` from `posts` (which should include all their posts) with grouped queries
+    and write counters with queryset updates. Returns (checked count, updated count).
+    """
+    from pybb.models import Topic
+
+    counters = get_post_counters(posts, 'topic')
+    count = 0
+    changed = []
+    for pk, post_count, updated in topics.values_list('pk', 'post_count', 'updated'):
+        count += 1
+        values = counters.get(pk, (0, updated))
+        if not only_changed or values != (post_count, updated):
+            changed.append((pk, values))
+    with tasks.atomic():
+        for pk, (post_count, updated) in changed:
+            Topic.objects.filter(pk=pk).update(post_count=post_count, updated=updated)
+    return count, len(changed)
+
+
+def recount_forums(forums, only_changed=False):
+    """
+    Recount `forums` with grouped queries and write counters with queryset updates, pending deltas
+    of these forums are dropped. Returns (checked count, updated count).
+    """
+    from pybb.models import Forum, ForumCounterDelta, Post, Topic
+
+    forum_ids = list(forums.values_list('pk', flat=True))
+    count = 0
+    changed = []
+    with tasks.atomic():
+        # recounted values include buffered deltas
+        ForumCounterDelta.objects.filter(forum__in=forum_ids).delete()
+        counters = get_post_counters(Post.objects.filter(topic__forum__in=forum_ids, topic__deleted=False),
+                                     'topic__forum')
+        topics = Topic.objects.filter(forum__in=forum_ids, deleted=False)
+        topic_counts = dict((row['forum'], row['count']) for row in
+                            topics.values('forum').annotate(count=Count('id')).order_by())
+        for pk, post_count, topic_count, updated in forums.values_list('pk', 'post_count', 'topic_count', 'updated'):
+            count += 1
+            new_post_count, new_updated = counters.get(pk, (0, updated))
+            values = (new_post_count, topic_counts.get(pk, 0), new_updated)
+            if not only_changed or values != (post_count, topic_count, updated):
+                changed.append((pk, values))
+        for pk, (post_count, topic_count, updated) in changed:
+            Forum.objects.filter(pk=pk).update(post_count=post_count, topic_count=topic_count, updated=updated)
+    return count, len(changed)
+
+
+# Timeout of views counted in cache, they are flushed much earlier normally
+VIEWS_TIMEOUT = 60 * 60 * 24 * 7
+
+_views_lock = threading.Lock()
+_viewed_topic_ids = set()
+_views_flushed_at = 0
+
+
+def is_new_view(topic_id, viewer):
+    """
+    Return False if `viewer` (user or ip address) already viewed topic in the last
+    PYBB_TOPIC_VIEWS_DEDUP_TIMEOUT seconds
+    """
+    timeout = defaults.PYBB_TOPIC_VIEWS_DEDUP_TIMEOUT
+    if not timeout:
+        return True
+    key = build_cache_key('topic_viewer', topic_id=topic_id, hash=hashlib.md5(force_bytes(viewer)).hexdigest())
+    return cache.add(key, 1, timeout)
+
+
+def record_topic_view(topic_id):
+    """
+    Count topic view in random shard and queue flush of topics viewed in this process if it's time to
+    """
+    global _views_flushed_at
+
+    key = build_cache_key('topic_views', topic_id=topic_id, shard=random.randrange(defaults.PYBB_TOPIC_VIEWS_SHARDS))
+    cache.add(key, 0, VIEWS_TIMEOUT)
+    try:
+        cache.incr(key)
+    except ValueError:
+        # key was evicted right after adding
+        cache.set(key, 1, VIEWS_TIMEOUT)
+
+    with _views_lock:
+        _viewed_topic_ids.add(topic_id)
+        if time.time() - _views_flushed_at < defaults.PYBB_TOPIC_VIEWS_FLUSH_INTERVAL:
+            return
+        topic_ids = sorted(_viewed_topic_ids)
+        _viewed_topic_ids.clear()
+        _views_flushed_at = time.time()
+    tasks.enqueue('pybb.counters.flush_topic_views', topic_ids)
+
+
+def _get_views_keys(topic_ids):
+    keys = {}
+    for topic_id in topic_ids:
+        # views of anonymous users buffered with PYBB_ANONYMOUS_VIEWS_CACHE_BUFFER
+        keys[build_cache_key('anonymous_topic_views', topic_id=topic_id)] = topic_id
+        if defaults.PYBB_TOPIC_VIEWS_BUFFER:
+            for shard in range(defaults.PYBB_TOPIC_VIEWS_SHARDS):
+                keys[build_cache_key('topic_views', topic_id=topic_id, shard=shard)] = topic_id
+    return keys
+
+
+def get_pending_views(topic_ids):
+    """
+    Return dict topic id -> number of views which are counted in cache and not saved to database yet,
+    all keys are fetched with one `get_many` call
+    """
+    keys = _get_views_keys(topic_ids)
+    pending = dict.fromkeys(topic_ids, 0)
+    for key, value in cache.get_many(list(keys)).items():
+        pending[keys[key]] += value
+    return pending
+
+
+def _flush_views(topic_ids):
+    """
+    Move views of topics counted in cache shards to database, returns number of topics with moved
+    views or None if another flush is running
+    """
+    from pybb.models import Topic
+
+    lock_key = build_cache_key('topic_views_flush_lock')
+    if not cache.add(lock_key, 1, 60):
+        return None
+    try:
+        keys = dict((build_cache_key('topic_views', topic_id=topic_id, shard=shard), topic_id)
+                    for topic_id in topic_ids for shard in range(defaults.PYBB_TOPIC_VIEWS_SHARDS))
+        views = defaultdict(int)
+        for key, value in cache.get_many(list(keys)).items():
+            if not value:
+                continue
+            try:
+                # views counted after reading stay in shard
+                cache.decr(key, value)
+            except ValueError:
+                continue
+            views[keys[key]] += value
+        topics_by_views = defaultdict(list)
+        for topic_id, count in views.items():
+            topics_by_views[count].append(topic_id)
+        with tasks.atomic():
+            for count, ids in sorted(topics_by_views.items()):
+                Topic.objects.filter(pk__in=ids).update(views=F('views') + count)
+        return len(views)
+    finally:
+        cache.delete(lock_key)
+
+
+def flush_topic_views(topic_ids):
+    """
+    Move views of topics counted in cache shards to database. If another flush is running,
+    topics are put back to the list of viewed topics of this process and flushed with the next batch.
+    Task worker in another process never flushes this list, views of these topics are left in cache
+    until they are viewed again or `flush_all_topic_views` is called.
+    """
+    if _flush_views(topic_ids) is None:
+        with _views_lock:
+            _viewed_topic_ids.update(topic_ids)
+
+
+def flush_all_topic_views(chunk_size=500):
+    """
+    Move views counted in cache shards of all topics to database, returns number of topics with moved views.
+    Topics are checked in chunks of `chunk_size`, if another flush is running, chunk waits for it.
+    """
+    from pybb.models import Topic
+
+    count = 0
+    for first_id, last_id in iter_id_chunks(Topic.objects.all(), chunk_size):
+        topic_ids = list(Topic.objects.filter(pk__range=(first_id, last_id)).values_list('pk', flat=True))
+        flushed = _flush_views(topic_ids)
+        while flushed is None:
+            time.sleep(0.1)
+            flushed = _flush_views(topic_ids)
+        count += flushed
+    return count
@@ -2,6 +2,8 @@
 
 from __future__ import unicode_literals
 import os.path
+import re
+import threading
 
 from django.conf import settings
 
@@ -32,6 +34,7 @@ PYBB_DEFAULT_TITLE = getattr(settings, 'PYBB_DEFAULT_TITLE', 'PYBB Powered Forum
 
 import bbcode
 from markdown import Markdown
+from django.utils.encoding import force_text
 from django.utils.html import urlize
 
 PYBB_SMILES_PREFIX = getattr(settings, 'PYBB_SMILES_PREFIX', 'pybb/emoticons/')
@@ -51,11 +54,91 @@ PYBB_SMILES = getattr(settings, 'PYBB_SMILES', {
     ';)': 'wink.png'
 })
 
+def _smiles_pattern(smiles):
+    """
+    Build regexp which matches any of `smiles`. Regexp is built as prefix tree, so
+    it's matched in one pass over text regardless of smiles count. Longest smile
+    wins if several smiles start at the same position.
+    """
+    trie = {}
+    for smile in smiles:
+        node = trie
+        for char in smile:
+            node = node.setdefault(char, {})
+        node[''] = True
+
+    def build(node):
+        branches = [re.escape(char) + build(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ''
+        pattern = branches[0] if len(branches) == 1 else '(?:%s)' % '|'.join(branches)
+        if '' in node:
+            pattern = '(?:%s)?' % pattern
+        return pattern
+
+    return build(trie)
+
+
+_smiles_matcher = (None, None, None)
+
+# Links in html, emoticons are not replaced inside them
+_LINK_RE = re.compile(r'(<a\s[^>]*>.*?</a>)', re.DOTALL | re.IGNORECASE)
+
+
+def _get_smiles_matcher():
+    global _smiles_matcher
+    state = (id(PYBB_SMILES), len(PYBB_SMILES), PYBB_SMILES_PREFIX, settings.STATIC_URL)
+    if _smiles_matcher[0] != state:
+        replacements = dict((smile, '<img src="%s%s%s" alt="smile" />' % (settings.STATIC_URL, PYBB_SMILES_PREFIX, url))
+                            for smile, url in PYBB_SMILES.items() if smile)
+        pattern = _smiles_pattern(replacements.keys()) if replacements else None
+        regexp = re.compile(pattern) if pattern else None
+        _smiles_matcher = (state, regexp, replacements)
+    return _smiles_matcher[1:]
+
+
 def smile_it(str):
-    s = str
-    for smile, url in PYBB_SMILES.items():
-        s = s.replace(smile, '<img src="%s%s%s" alt="smile" />' % (settings.STATIC_URL, PYBB_SMILES_PREFIX, url))
-    return s
+    regexp, replacements = _get_smiles_matcher()
+    if regexp is None:
+        return str
+    return regexp.sub(lambda match: replacements[match.group(0)], str)
+
+
+def urlize_smile_it(str):
+    """
+    Turn urls in html into links and replace emoticons outside of links, so emoticon-like
+    parts of urls (e.g. `8)` in `http://example.com/8)/`) are not broken
+    """
+    parts = _LINK_RE.split(urlize(force_text(str)))
+    parts[::2] = [smile_it(part) for part in parts[::2]]
+    return ''.join(parts)
+
+
+class MarkdownEngine(object):
+    """
+    Markdown markup engine which keeps one Markdown instance per thread and resets
+    it after every conversion instead of building new instance for every text.
+    Keyword arguments are passed to Markdown constructor.
+    """
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+        self.local = threading.local()
+
+    def get_parser(self):
+        parser = getattr(self.local, 'parser', None)
+        if parser is None:
+            parser = self.local.parser = Markdown(**self.kwargs)
+        return parser
+
+    def __call__(self, str):
+        parser = self.get_parser()
+        try:
+            html = parser.convert(str)
+        finally:
+            parser.reset()
+        return urlize_smile_it(html)
+
+_get_smiles_matcher()
 
 bbcode_parser = bbcode.Parser()
 bbcode_parser.add_simple_formatter('img', '<img src="%(value)s">', replace_links=False)
@@ -71,7 +154,7 @@ bbcode_parser.add_formatter('quote', _render_quote, strip=True, swallow_trailing
 
 PYBB_MARKUP_ENGINES = getattr(settings, 'PYBB_MARKUP_ENGINES', {
     'bbcode': lambda str: smile_it(bbcode_parser.format(str)),
-    'markdown': lambda str: urlize(smile_it(Markdown(safe_mode='escape').convert(str)))
+    'markdown': MarkdownEngine(safe_mode='escape')
 })
 
 PYBB_QUOTE_ENGINES = getattr(settings, 'PYBB_QUOTE_ENGINES', {
@@ -81,11 +164,34 @@ PYBB_QUOTE_ENGINES = getattr(settings, 'PYBB_QUOTE_ENGINES', {
 
 PYBB_MARKUP = getattr(settings, 'PYBB_MARKUP', 'bbcode')
 
+PYBB_RENDER_CACHE_SIZE = getattr(settings, 'PYBB_RENDER_CACHE_SIZE', 1000)
+PYBB_RENDER_CACHE_BACKEND = getattr(settings, 'PYBB_RENDER_CACHE_BACKEND', None)
+PYBB_COMPRESS_RENDERED_BODY = getattr(settings, 'PYBB_COMPRESS_RENDERED_BODY', False)
+PYBB_RENDER_MAX_LENGTH = getattr(settings, 'PYBB_RENDER_MAX_LENGTH', None)
+PYBB_RENDER_MAX_DEPTH = getattr(settings, 'PYBB_RENDER_MAX_DEPTH', None)
+PYBB_RENDER_TIME_BUDGET = getattr(settings, 'PYBB_RENDER_TIME_BUDGET', None)
+PYBB_RENDER_MAX_THREADS = getattr(settings, 'PYBB_RENDER_MAX_THREADS', 4)
+PYBB_TASK_BACKEND = getattr(settings, 'PYBB_TASK_BACKEND', 'pybb.tasks.ImmediateBackend')
+
 PYBB_TEMPLATE = getattr(settings, 'PYBB_TEMPLATE', "base.html")
 PYBB_DEFAULT_AUTOSUBSCRIBE = getattr(settings, 'PYBB_DEFAULT_AUTOSUBSCRIBE', True)
 PYBB_ENABLE_ANONYMOUS_POST = getattr(settings, 'PYBB_ENABLE_ANONYMOUS_POST', False)
 PYBB_ANONYMOUS_USERNAME = getattr(settings, 'PYBB_ANONYMOUS_USERNAME', 'Anonymous')
 PYBB_ANONYMOUS_VIEWS_CACHE_BUFFER = getattr(settings, 'PYBB_ANONYMOUS_VIEWS_CACHE_BUFFER', 100)
+PYBB_ANONYMOUS_PAGE_CACHE_TIMEOUT = getattr(settings, 'PYBB_ANONYMOUS_PAGE_CACHE_TIMEOUT', None)
+PYBB_CONDITIONAL_GET = getattr(settings, 'PYBB_CONDITIONAL_GET', False)
+PYBB_SURROGATE_KEY_HEADER = getattr(settings, 'PYBB_SURROGATE_KEY_HEADER', None)
+PYBB_SURROGATE_KEY_SEPARATOR = getattr(settings, 'PYBB_SURROGATE_KEY_SEPARATOR', ' ')
+PYBB_PURGE_BACKEND = getattr(settings, 'PYBB_PURGE_BACKEND', None)
+PYBB_BUFFER_FORUM_COUNTERS = getattr(settings, 'PYBB_BUFFER_FORUM_COUNTERS', False)
+PYBB_TOPIC_VIEWS_BUFFER = getattr(settings, 'PYBB_TOPIC_VIEWS_BUFFER', False)
+PYBB_TOPIC_VIEWS_SHARDS = getattr(settings, 'PYBB_TOPIC_VIEWS_SHARDS', 8)
+PYBB_TOPIC_VIEWS_FLUSH_INTERVAL = getattr(settings, 'PYBB_TOPIC_VIEWS_FLUSH_INTERVAL', 60)
+PYBB_TOPIC_VIEWS_DEDUP_TIMEOUT = getattr(settings, 'PYBB_TOPIC_VIEWS_DEDUP_TIMEOUT', None)
+PYBB_DELETE_BATCH_SIZE = getattr(settings, 'PYBB_DELETE_BATCH_SIZE', 500)
+PYBB_DELETE_BACKGROUND_THRESHOLD = getattr(settings, 'PYBB_DELETE_BACKGROUND_THRESHOLD', 100)
+
+PYBB_SEARCH_BACKEND = getattr(settings, 'PYBB_SEARCH_BACKEND', None)
 
 PYBB_PREMODERATION = getattr(settings, 'PYBB_PREMODERATION', False)
 
@@ -98,6 +204,7 @@ PYBB_POLL_MAX_ANSWERS = getattr(settings, 'PYBB_POLL_MAX_ANSWERS', 10)
 PYBB_AUTO_USER_PERMISSIONS = getattr(settings, 'PYBB_AUTO_USER_PERMISSIONS', True)
 
 PYBB_USE_DJANGO_MAILER = getattr(settings, 'PYBB_USE_DJANGO_MAILER', False)
+PYBB_NOTIFICATION_BATCH_SIZE = getattr(settings, 'PYBB_NOTIFICATION_BATCH_SIZE', 100)
 
 PYBB_PERMISSION_HANDLER = getattr(settings, 'PYBB_PERMISSION_HANDLER', 'pybb.permissions.DefaultPermissionHandler')
 
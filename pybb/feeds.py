@@ -3,16 +3,45 @@
 from __future__ import unicode_literals
 from django.contrib.syndication.views import Feed
 from django.core.urlresolvers import reverse
+from django.db.models import Max
+from django.http import HttpResponseNotModified
 from django.utils.feedgenerator import Atom1Feed
 from django.utils.translation import ugettext_lazy as _
 
-from pybb.models import Post, Topic
+from pybb import caching, defaults
+from pybb.models import Forum, ForumCounterDelta, Post, Topic
 
 from pybb.permissions import perms
 
 class PybbFeed(Feed):
     feed_type = Atom1Feed
 
+    cache_dependencies = [caching.INDEX, caching.STRUCTURE]
+
+    def __call__(self, request, *args, **kwargs):
+        if not defaults.PYBB_CONDITIONAL_GET or request.method not in ('GET', 'HEAD'):
+            response = super(PybbFeed, self).__call__(request, *args, **kwargs)
+        else:
+            last_modified = self.get_last_modified()
+            etag = caching.make_etag(request, self.cache_dependencies, last_modified)
+            if caching.is_not_modified(request, etag, last_modified):
+                return HttpResponseNotModified()
+            response = super(PybbFeed, self).__call__(request, *args, **kwargs)
+            if response.status_code == 200:
+                caching.set_validators(response, etag, last_modified)
+        if response.status_code == 200 and not request.user.is_authenticated():
+            caching.set_surrogate_keys(response, self.cache_dependencies)
+        return response
+
+    def get_last_modified(self):
+        # any new post or topic updates its forum or adds buffered delta of its counters
+        last_modified = Forum.objects.aggregate(last_modified=Max('updated'))['last_modified']
+        if defaults.PYBB_BUFFER_FORUM_COUNTERS:
+            pending = ForumCounterDelta.objects.aggregate(last_modified=Max('updated'))['last_modified']
+            if pending and (last_modified is None or pending > last_modified):
+                last_modified = pending
+        return last_modified
+
     def link(self):
         return reverse('pybb:index')
 
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import base64
+import zlib
+
+import django
+from django.db import models
+from django.utils import six
+from django.utils.encoding import force_bytes, force_text
+
+from pybb import defaults
+
+
+COMPRESSED_PREFIX = '\x01zlib:'
+
+
+def compress(value):
+    """
+    Return `value` compressed if it's enabled with PYBB_COMPRESS_RENDERED_BODY and saves space.
+    Values which look like compressed ones are always compressed, so decompress(compress(value)) == value.
+    """
+    if not value:
+        return value
+    if defaults.PYBB_COMPRESS_RENDERED_BODY or value.startswith(COMPRESSED_PREFIX):
+        raw = force_bytes(value)
+        compressed = COMPRESSED_PREFIX + force_text(base64.b64encode(zlib.compress(raw, 9)))
+        if len(compressed) < len(raw) or value.startswith(COMPRESSED_PREFIX):
+            return compressed
+    return value
+
+
+def decompress(value):
+    if value and value.startswith(COMPRESSED_PREFIX):
+        try:
+            return force_text(zlib.decompress(base64.b64decode(force_bytes(value[len(COMPRESSED_PREFIX):]))))
+        except (TypeError, ValueError, zlib.error):
+            # not compressed text which starts with the prefix
+            pass
+    return value
+
+
+if django.VERSION < (1, 8):
+    _TextFieldBase = six.with_metaclass(models.SubfieldBase, models.TextField)
+else:
+    _TextFieldBase = models.TextField
+
+
+class CompressedTextField(_TextFieldBase):
+    """
+    Text field which is stored compressed if PYBB_COMPRESS_RENDERED_BODY is enabled and
+    decompressed transparently when model is loaded. Stored values of both formats are readable,
+    so setting can be switched at any time, pybb_compress_bodies command converts existing rows.
+    Text lookups (contains etc) don't match compressed values.
+    """
+    def to_python(self, value):
+        if isinstance(value, six.string_types):
+            return decompress(value)
+        return value
+
+    def from_db_value(self, value, *args):
+        return decompress(value)
+
+    def get_prep_value(self, value):
+        value = super(CompressedTextField, self).get_prep_value(value)
+        if isinstance(value, six.string_types):
+            return compress(value)
+        return value
@@ -15,8 +15,9 @@ from pybb import util
 User = util.get_user_model()
 username_field = util.get_username_field()
 
-from pybb.models import Topic, Post, Attachment, PollAnswer
-from pybb import defaults
+from pybb.models import Forum, Topic, Post, Attachment, PollAnswer
+from pybb.permissions import perms
+from pybb import defaults, search
 
 
 class AttachmentForm(forms.ModelForm):
@@ -191,7 +192,7 @@ try:
     class EditProfileForm(forms.ModelForm):
         class Meta(object):
             model = util.get_pybb_profile_model()
-            fields = ['signature', 'time_zone', 'language', 'show_signatures', 'avatar']
+            fields = ['signature', 'time_zone', 'language', 'show_signatures', 'avatar', 'notification_delivery']
 
         def __init__(self, *args, **kwargs):
             super(EditProfileForm, self).__init__(*args, **kwargs)
@@ -225,6 +226,15 @@ class UserSearchForm(forms.Form):
             return qs
 
 
+class SearchForm(forms.Form):
+    q = forms.CharField(label=ugettext_lazy('Search'), max_length=255)
+
+    def clean_q(self):
+        if not search.get_terms(self.cleaned_data['q']):
+            raise forms.ValidationError(ugettext('Search query should contain at least one word'))
+        return self.cleaned_data['q']
+
+
 class PollForm(forms.Form):
     def __init__(self, topic, *args, **kwargs):
         self.topic = topic
@@ -247,3 +257,44 @@ class PollForm(forms.Form):
             return [answers]
         else:
             return answers
+
+
+class MoveTopicsForm(forms.Form):
+    topics = forms.ModelMultipleChoiceField(queryset=Topic.objects.none(), widget=forms.MultipleHiddenInput())
+    forum = forms.ModelChoiceField(label=ugettext_lazy('Move to forum'), queryset=Forum.objects.none())
+
+    def __init__(self, user, *args, **kwargs):
+        super(MoveTopicsForm, self).__init__(*args, **kwargs)
+        self.fields['topics'].queryset = perms.filter_moderated_topics(user, Topic.objects.all())
+        self.fields['forum'].queryset = perms.filter_moderated_forums(user, Forum.objects.all())
+
+
+class MergeTopicsForm(forms.Form):
+    topics = forms.ModelMultipleChoiceField(queryset=Topic.objects.none(), widget=forms.MultipleHiddenInput())
+    target = forms.ModelChoiceField(label=ugettext_lazy('Merge into topic (id)'), queryset=Topic.objects.none(),
+                                    widget=forms.TextInput())
+
+    def __init__(self, user, *args, **kwargs):
+        super(MergeTopicsForm, self).__init__(*args, **kwargs)
+        self.fields['topics'].queryset = perms.filter_moderated_topics(user, Topic.objects.all())
+        self.fields['target'].queryset = perms.filter_moderated_topics(user, Topic.objects.all())
+
+
+class SplitTopicForm(forms.Form):
+    posts = forms.ModelMultipleChoiceField(queryset=Post.objects.none(), widget=forms.MultipleHiddenInput())
+    following = forms.BooleanField(label=ugettext_lazy('Also move all later posts'), required=False)
+    name = forms.CharField(label=ugettext_lazy('Subject of new topic'), max_length=255)
+    forum = forms.ModelChoiceField(label=ugettext_lazy('Forum'), queryset=Forum.objects.none())
+
+    def __init__(self, topic, user, *args, **kwargs):
+        super(SplitTopicForm, self).__init__(*args, **kwargs)
+        self.topic = topic
+        self.fields['posts'].queryset = topic.posts.all()
+        self.fields['forum'].queryset = perms.filter_moderated_forums(user, Forum.objects.all())
+
+    def clean(self):
+        posts = self.cleaned_data.get('posts')
+        if posts and self.cleaned_data.get('following'):
+            first_created = min(post.created for post in posts)
+            self.cleaned_data['posts'] = self.topic.posts.filter(created__gte=first_created)
+        return self.cleaned_data
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils.encoding import force_bytes
+
+from pybb import defaults, util
+from pybb.fields import compress, decompress
+from pybb.models import Post
+
+
+FIELDS = ('body_html', 'body_text')
+
+
+class Command(BaseCommand):
+    help = ('Convert stored body_html and body_text of posts to the format selected with '
+            'PYBB_COMPRESS_RENDERED_BODY setting (compressed or plain) and report space saved.')
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size', type='int', dest='chunk_size', default=500,
+                    help='Number of posts converted in one transaction (500 by default)'),
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+                    help='Only report space which would be saved'),
+    )
+
+    def handle(self, *args, **options):
+        chunk_size = options.get('chunk_size') or 500
+        dry_run = options.get('dry_run')
+        if chunk_size < 1:
+            raise CommandError('--chunk-size should be positive')
+
+        # Stored values are read with plain sql, because fields decompress them on loading
+        qn = connection.ops.quote_name
+        sql = 'SELECT %s, %s FROM %s WHERE %s BETWEEN %%s AND %%s' % (
+            qn(Post._meta.pk.column), ', '.join(qn(Post._meta.get_field(name).column) for name in FIELDS),
+            qn(Post._meta.db_table), qn(Post._meta.pk.column))
+
+        count = converted = size_before = size_after = 0
+        for first_id, last_id in util.iter_id_chunks(Post.objects.all(), chunk_size):
+            cursor = connection.cursor()
+            cursor.execute(sql, [first_id, last_id])
+            changed = []
+            for row in cursor.fetchall():
+                count += 1
+                values = {}
+                for name, stored in zip(FIELDS, row[1:]):
+                    value = decompress(stored)
+                    new_stored = compress(value)
+                    size_before += len(force_bytes(stored))
+                    size_after += len(force_bytes(new_stored))
+                    if new_stored != stored:
+                        values[name] = value
+                if values:
+                    changed.append((row[0], values))
+            converted += len(changed)
+            if changed and not dry_run:
+                with transaction.atomic():
+                    for pk, values in changed:
+                        # field compresses values on saving
+                        Post.objects.filter(pk=pk).update(**values)
+
+        saved = size_before - size_after
+        storage_format = 'compressed' if defaults.PYBB_COMPRESS_RENDERED_BODY else 'plain'
+        self.stdout.write('%s %d of %d posts to %s format' %
+                          ('Would convert' if dry_run else 'Converted', converted, count, storage_format))
+        self.stdout.write('Rendered columns size: %d bytes before, %d bytes after, %d bytes (%.1f%%) saved' %
+                          (size_before, size_after, saved, 100.0 * saved / size_before if size_before else 0))
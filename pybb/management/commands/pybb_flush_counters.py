@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from pybb import counters, defaults
+
+
+class Command(BaseCommand):
+    help = ('Fold buffered forum counters (see PYBB_BUFFER_FORUM_COUNTERS setting) into forums and save topic '
+            'views counted in cache (see PYBB_TOPIC_VIEWS_BUFFER setting) for all topics')
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size', type='int', dest='chunk_size', default=500,
+                    help='Number of topics which views are saved at once (500 by default)'),
+    )
+
+    def handle(self, *args, **options):
+        chunk_size = options.get('chunk_size') or 500
+        if chunk_size < 1:
+            raise CommandError('--chunk-size should be positive')
+        count = counters.flush_forum_counters()
+        self.stdout.write('Counters of %d forums updated' % count)
+        if defaults.PYBB_TOPIC_VIEWS_BUFFER:
+            count = counters.flush_all_topic_views(chunk_size)
+            self.stdout.write('Views of %d topics saved' % count)
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from pybb import search, util
+from pybb.models import Topic, Post
+
+
+class Command(BaseCommand):
+    help = ('Rebuild search index of backend selected with PYBB_SEARCH_BACKEND setting: '
+            'clear it and index names of all topics and bodies of all posts in chunks.')
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size', type='int', dest='chunk_size', default=500,
+                    help='Number of topics or posts indexed at once (500 by default)'),
+    )
+
+    def handle(self, *args, **options):
+        chunk_size = options.get('chunk_size') or 500
+        if chunk_size < 1:
+            raise CommandError('--chunk-size should be positive')
+        backend = search.get_backend()
+        if backend is None:
+            raise CommandError('Search is disabled with PYBB_SEARCH_BACKEND setting')
+
+        backend.clear()
+        for model, name, index in ((Topic, 'topics', backend.index_topics), (Post, 'posts', backend.index_posts)):
+            count = 0
+            for first_id, last_id in util.iter_id_chunks(model.objects.all(), chunk_size):
+                objects = list(model.objects.filter(pk__range=(first_id, last_id)))
+                index(objects)
+                count += len(objects)
+            self.stdout.write('Indexed %d %s' % (count, name))
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import json
+import multiprocessing
+import os
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+
+from pybb import caching, markup, search, util
+from pybb.models import Post
+
+
+POSTS = 'posts'
+SIGNATURES = 'signatures'
+
+
+def get_queryset(kind):
+    if kind == POSTS:
+        return Post.objects.all()
+    return util.get_pybb_profile_model().objects.all()
+
+
+def rerender_chunk(task):
+    """
+    Re-render posts or signatures with ids from `first_id` to `last_id` and write changed html back
+    with queryset updates, so no signals are sent and nothing but rendered fields is touched.
+    Posts whose text was changed are indexed for search in one batch. Returns (kind, last id,
+    rendered count, changed count).
+    """
+    kind, first_id, last_id, dry_run = task
+    qs = get_queryset(kind).filter(pk__range=(first_id, last_id))
+    pk_name = qs.model._meta.pk.name
+    changed = []
+    text_changed = []
+    count = 0
+    if kind == POSTS:
+        for post in qs.only(pk_name, 'body', 'body_html', 'body_text'):
+            count += 1
+            old = (post.body_html, post.body_text)
+            post.render(refresh=True)
+            if (post.body_html, post.body_text) != old:
+                changed.append((post.pk, {'body_html': post.body_html, 'body_text': post.body_text}))
+            if post.body_text != old[1]:
+                text_changed.append(post.pk)
+    else:
+        for profile in qs.only(pk_name, 'signature', 'signature_html'):
+            count += 1
+            signature_html = markup.render(profile.signature, refresh=True)
+            if signature_html != profile.signature_html:
+                changed.append((profile.pk, {'signature_html': signature_html}))
+    if changed and not dry_run:
+        backend = search.get_backend()
+        with transaction.atomic():
+            for pk, values in changed:
+                qs.model.objects.filter(pk=pk).update(**values)
+            if text_changed and backend is not None:
+                # update() sends no signals, so search index is updated here
+                backend.index_posts(Post.objects.filter(pk__in=text_changed))
+    return kind, last_id, count, len(changed)
+
+
+class Command(BaseCommand):
+    help = ('Re-render stored html of posts and signatures after markup engines or emoticons were changed. '
+            'Html is written with queryset updates: no signals are sent, counters and subscriptions '
+            'are not touched. Posts whose text was changed are indexed for search.')
+    option_list = BaseCommand.option_list + (
+        make_option('--posts-only', action='store_true', dest='posts_only', default=False,
+                    help='Re-render only posts'),
+        make_option('--signatures-only', action='store_true', dest='signatures_only', default=False,
+                    help='Re-render only signatures'),
+        make_option('--from-id', type='int', dest='from_id',
+                    help='Re-render only rows with id greater or equal to FROM_ID'),
+        make_option('--to-id', type='int', dest='to_id',
+                    help='Re-render only rows with id less or equal to TO_ID'),
+        make_option('--chunk-size', type='int', dest='chunk_size', default=500,
+                    help='Number of rows rendered and written in one transaction (500 by default)'),
+        make_option('--processes', type='int', dest='processes', default=1,
+                    help='Number of worker processes (1 by default)'),
+        make_option('--state-file', dest='state_file',
+                    help='File for progress: command continues after the last completed chunk '
+                         'recorded in it. Remove the file to start over'),
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+                    help='Only count rows whose html would change'),
+    )
+
+    def handle(self, *args, **options):
+        kinds = [kind for kind, skip in ((POSTS, options.get('signatures_only')),
+                                         (SIGNATURES, options.get('posts_only'))) if not skip]
+        chunk_size = options.get('chunk_size') or 500
+        processes = options.get('processes') or 1
+        dry_run = options.get('dry_run')
+        state_file = options.get('state_file')
+        if not kinds:
+            raise CommandError('--posts-only and --signatures-only can not be used together')
+        if chunk_size < 1 or processes < 1:
+            raise CommandError('--chunk-size and --processes should be positive')
+
+        state = {}
+        if state_file and os.path.exists(state_file):
+            with open(state_file) as f:
+                state = json.load(f)
+
+        def tasks():
+            for kind in kinds:
+                from_id = options.get('from_id')
+                if state.get(kind) is not None:
+                    from_id = max(from_id, state[kind] + 1) if from_id is not None else state[kind] + 1
+                chunks = util.iter_id_chunks(get_queryset(kind), chunk_size, from_id, options.get('to_id'))
+                for first_id, last_id in chunks:
+                    yield kind, first_id, last_id, dry_run
+
+        if processes > 1:
+            # Workers are forked, they must not share database connection with this process
+            for connection in connections.all():
+                connection.close()
+            pool = multiprocessing.Pool(processes)
+            results = pool.imap(rerender_chunk, tasks())
+        else:
+            pool = None
+            results = (rerender_chunk(task) for task in tasks())
+
+        totals = dict((kind, [0, 0]) for kind in kinds)
+        try:
+            # imap returns results in order of tasks, so state always points to the end of finished part
+            for kind, last_id, count, changed in results:
+                totals[kind][0] += count
+                totals[kind][1] += changed
+                self.stdout.write('%s up to id %s: %d rendered, %d %s' %
+                                  (kind, last_id, count, changed, 'would change' if dry_run else 'changed'))
+                if state_file and not dry_run:
+                    state[kind] = last_id
+                    with open(state_file, 'w') as f:
+                        json.dump(state, f)
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+        for kind in kinds:
+            self.stdout.write('Total %s: %d rendered, %d %s' %
+                              (kind, totals[kind][0], totals[kind][1], 'would change' if dry_run else 'changed'))
+        if not dry_run and any(changed for count, changed in totals.values()):
+            # all forum, category and topic pages depend on structure version
+            caching.invalidate([caching.STRUCTURE])
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from pybb.profiles import PybbProfile
+from pybb.subscription import send_digests
+
+
+PERIODS = {
+    # notifications of users who switched to immediate delivery are sent with hourly digests
+    'hourly': [PybbProfile.DELIVERY_HOURLY, PybbProfile.DELIVERY_IMMEDIATE],
+    'daily': [PybbProfile.DELIVERY_DAILY],
+}
+
+
+class Command(BaseCommand):
+    help = ('Send digests of new posts in subscribed topics to users who prefer hourly or daily digests. '
+            'Hourly digests also include notifications stored for users who switched to immediate delivery '
+            'after them. Run it with --period=hourly every hour and with --period=daily every day.')
+    option_list = BaseCommand.option_list + (
+        make_option('--period', dest='period', choices=sorted(PERIODS),
+                    help='Send digests to users with this delivery preference: hourly or daily '
+                         '(hourly also to users with immediate delivery who have stored notifications)'),
+    )
+
+    def handle(self, *args, **options):
+        period = options.get('period')
+        if period not in PERIODS:
+            raise CommandError('--period should be one of: %s' % ', '.join(sorted(PERIODS)))
+        count = send_digests(PERIODS[period])
+        self.stdout.write('Sent %d %s digests' % (count, period))
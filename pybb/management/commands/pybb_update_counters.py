@@ -4,18 +4,87 @@
 from __future__ import unicode_literals
 __author__ = 'zeus'
 
+import multiprocessing
+from optparse import make_option
+
 from django.core.management.base import BaseCommand, CommandError
-from pybb.models import Topic, Forum
+from django.db import connections
+
+from pybb import caching, counters, util
+from pybb.models import Topic, Forum, Post
+
+
+def get_topics(forum_id):
+    if forum_id is None:
+        return Topic.objects.all()
+    return Topic.objects.filter(forum_id=forum_id)
+
+
+def update_topics_chunk(task):
+    """
+    Recount topics with ids from `first_id` to `last_id` and write counters with queryset updates.
+    Returns (last id, checked count, updated count).
+    """
+    first_id, last_id, forum_id, only_changed = task
+    topics = get_topics(forum_id).filter(pk__range=(first_id, last_id))
+    posts = Post.objects.filter(topic_id__range=(first_id, last_id))
+    if forum_id is not None:
+        posts = posts.filter(topic__forum_id=forum_id)
+    count, changed = counters.recount_topics(topics, posts, only_changed)
+    return last_id, count, changed
+
 
 class Command(BaseCommand):
-    help = 'Recalc post counters for forums and topics'
+    help = ('Recalc post counters for forums and topics. Topics are recounted in chunks with grouped queries '
+            'and counters are written with queryset updates, no signals are sent.')
+    option_list = BaseCommand.option_list + (
+        make_option('--forum', type='int', dest='forum_id',
+                    help='Recount only forum with id FORUM_ID and its topics'),
+        make_option('--only-changed', action='store_true', dest='only_changed', default=False,
+                    help='Write only counters which differ from recounted ones'),
+        make_option('--chunk-size', type='int', dest='chunk_size', default=500,
+                    help='Number of topics recounted and written in one transaction (500 by default)'),
+        make_option('--processes', type='int', dest='processes', default=1,
+                    help='Number of worker processes for topics (1 by default)'),
+    )
 
     def handle(self, *args, **options):
+        forum_id = options.get('forum_id')
+        only_changed = options.get('only_changed')
+        chunk_size = options.get('chunk_size') or 500
+        processes = options.get('processes') or 1
+        if chunk_size < 1 or processes < 1:
+            raise CommandError('--chunk-size and --processes should be positive')
+        if forum_id is not None and not Forum.objects.filter(pk=forum_id).exists():
+            raise CommandError('Forum with id %s does not exist' % forum_id)
+
+        tasks = ((first_id, last_id, forum_id, only_changed)
+                 for first_id, last_id in util.iter_id_chunks(get_topics(forum_id), chunk_size))
+        if processes > 1:
+            # Workers are forked, they must not share database connection with this process
+            for connection in connections.all():
+                connection.close()
+            pool = multiprocessing.Pool(processes)
+            results = pool.imap_unordered(update_topics_chunk, tasks)
+        else:
+            pool = None
+            results = (update_topics_chunk(task) for task in tasks)
 
-        for topic in Topic.objects.all():
-            topic.update_counters()
-            self.stdout.write('Successfully updated topic "%s"\n' % topic)
+        total = total_changed = 0
+        try:
+            for last_id, count, changed in results:
+                total += count
+                total_changed += changed
+                self.stdout.write('Topics up to id %s: %d checked, %d updated' % (last_id, count, changed))
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+        self.stdout.write('Total topics: %d checked, %d updated' % (total, total_changed))
 
-        for forum in Forum.objects.all():
-            forum.update_counters()
-            self.stdout.write('Successfully updated forum "%s"\n' % forum)
+        forums = Forum.objects.all() if forum_id is None else Forum.objects.filter(pk=forum_id)
+        forum_count, forums_changed = counters.recount_forums(forums, only_changed)
+        self.stdout.write('Total forums: %d checked, %d updated' % (forum_count, forums_changed))
+        if total_changed or forums_changed:
+            # all forum, category and topic pages depend on structure version
+            caching.invalidate([caching.STRUCTURE])
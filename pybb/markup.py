@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+"""
+Rendering of post bodies and signatures with configured markup engine.
+
+Rendered html is cached by hash of markup engine name, emoticons settings and
+source text: in process memory (LRU, PYBB_RENDER_CACHE_SIZE entries) and,
+optionally, in shared django cache PYBB_RENDER_CACHE_BACKEND.
+
+Texts which exceed PYBB_RENDER_MAX_LENGTH, PYBB_RENDER_MAX_DEPTH or
+PYBB_RENDER_TIME_BUDGET are not rendered within request by render_within_limits,
+caller shows placeholder instead and renders them in background.
+"""
+
+from __future__ import unicode_literals
+import hashlib
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.utils.encoding import force_bytes
+from django.utils.html import linebreaks
+
+from pybb import defaults
+from pybb.util import build_cache_key
+
+try:
+    from django.core.cache import caches
+
+    def get_cache(alias):
+        return caches[alias]
+except ImportError:  # django < 1.7
+    from django.core.cache import get_cache
+
+
+class LRUCache(object):
+    """
+    Thread safe dict-like storage which keeps only `size` recently used items
+    """
+    def __init__(self):
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            try:
+                value = self.data.pop(key)
+            except KeyError:
+                return None
+            self.data[key] = value
+            return value
+
+    def set(self, key, value, size):
+        with self.lock:
+            self.data.pop(key, None)
+            self.data[key] = value
+            while len(self.data) > size:
+                self.data.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+
+local_cache = LRUCache()
+
+logger = logging.getLogger('pybb.markup')
+
+
+class RenderStats(object):
+    """
+    Thread safe counters of render time in current process
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.over_budget = 0
+        self.deferred = 0
+
+    def add(self, duration):
+        with self.lock:
+            self.count += 1
+            self.total_time += duration
+            self.max_time = max(self.max_time, duration)
+            if defaults.PYBB_RENDER_TIME_BUDGET and duration > defaults.PYBB_RENDER_TIME_BUDGET:
+                self.over_budget += 1
+
+    def add_deferred(self):
+        with self.lock:
+            self.deferred += 1
+
+    def as_dict(self):
+        with self.lock:
+            return {
+                'count': self.count,
+                'total_time': self.total_time,
+                'average_time': self.total_time / self.count if self.count else 0.0,
+                'max_time': self.max_time,
+                'over_budget': self.over_budget,
+                'deferred': self.deferred,
+            }
+
+
+stats = RenderStats()
+
+
+def get_render_stats():
+    """
+    Return dict with number of renders, their total, average and max time in seconds,
+    number of renders over PYBB_RENDER_TIME_BUDGET and number of deferred texts
+    """
+    return stats.as_dict()
+
+_smiles_version = (None, None)
+
+
+def get_smiles_version():
+    """
+    Hash of emoticons settings, rendered html should be invalidated when they changes
+    """
+    global _smiles_version
+    smiles = defaults.PYBB_SMILES
+    state = (id(smiles), len(smiles), defaults.PYBB_SMILES_PREFIX, settings.STATIC_URL)
+    if _smiles_version[0] != state:
+        source = '|'.join(['%s=%s' % item for item in sorted(smiles.items())] + list(state[2:]))
+        _smiles_version = (state, hashlib.md5(force_bytes(source)).hexdigest())
+    return _smiles_version[1]
+
+
+def get_render_cache_key(text, markup=None):
+    markup = markup or defaults.PYBB_MARKUP
+    source = '%s|%s|%s' % (markup, get_smiles_version(), text)
+    return build_cache_key('rendered_markup', hash=hashlib.sha1(force_bytes(source)).hexdigest())
+
+
+def _render(text, markup):
+    start = time.time()
+    html = defaults.PYBB_MARKUP_ENGINES[markup](text)
+    duration = time.time() - start
+    stats.add(duration)
+    if defaults.PYBB_RENDER_TIME_BUDGET and duration > defaults.PYBB_RENDER_TIME_BUDGET:
+        logger.warning('Rendering of %d characters with %s took %.3f seconds', len(text), markup, duration)
+    return html
+
+
+def render(text, markup=None, refresh=False):
+    """
+    Return html for `text` rendered with `markup` engine (PYBB_MARKUP by default).
+    With `refresh` text is rendered even if it is cached and cache is updated,
+    use it when markup engines were changed.
+    """
+    markup = markup or defaults.PYBB_MARKUP
+    if not (defaults.PYBB_RENDER_CACHE_SIZE or defaults.PYBB_RENDER_CACHE_BACKEND):
+        return _render(text, markup)
+
+    key = get_render_cache_key(text, markup)
+    html = None if refresh else local_cache.get(key)
+    if html is not None:
+        return html
+    shared_cache = get_cache(defaults.PYBB_RENDER_CACHE_BACKEND) if defaults.PYBB_RENDER_CACHE_BACKEND else None
+    if shared_cache is not None and not refresh:
+        html = shared_cache.get(key)
+    if html is None:
+        html = _render(text, markup)
+        if shared_cache is not None:
+            shared_cache.set(key, html)
+    if defaults.PYBB_RENDER_CACHE_SIZE:
+        local_cache.set(key, html, defaults.PYBB_RENDER_CACHE_SIZE)
+    return html
+
+
+_BBCODE_TAG_RE = re.compile(r'\[(/?)([a-z0-9*]+)[^\[\]]*\]', re.IGNORECASE)
+_MARKDOWN_QUOTE_RE = re.compile(r'^[ \t]*((?:>[ \t]*)+)', re.MULTILINE)
+
+
+def get_bbcode_depth(text):
+    closed = set(name.lower() for closing, name in _BBCODE_TAG_RE.findall(text) if closing)
+    depth = max_depth = 0
+    for closing, name in _BBCODE_TAG_RE.findall(text):
+        # tags without closing pair like [*] are not nested
+        if name.lower() not in closed:
+            continue
+        if closing:
+            depth = max(depth - 1, 0)
+        else:
+            depth += 1
+            max_depth = max(max_depth, depth)
+    return max_depth
+
+
+def get_markdown_depth(text):
+    return max([match.count('>') for match in _MARKDOWN_QUOTE_RE.findall(text)] or [0])
+
+
+NESTING_DEPTH_FUNCTIONS = {
+    'bbcode': get_bbcode_depth,
+    'markdown': get_markdown_depth,
+}
+
+
+def exceeds_limits(text, markup=None):
+    """
+    Check if `text` is longer than PYBB_RENDER_MAX_LENGTH or has tags nested deeper than PYBB_RENDER_MAX_DEPTH
+    """
+    markup = markup or defaults.PYBB_MARKUP
+    if defaults.PYBB_RENDER_MAX_LENGTH and len(text) > defaults.PYBB_RENDER_MAX_LENGTH:
+        return True
+    get_depth = NESTING_DEPTH_FUNCTIONS.get(markup)
+    if defaults.PYBB_RENDER_MAX_DEPTH and get_depth is not None:
+        return get_depth(text) > defaults.PYBB_RENDER_MAX_DEPTH
+    return False
+
+
+def render_placeholder(text):
+    """
+    Return escaped `text` which is shown until it will be rendered
+    """
+    return '<div class="pybb-render-pending">%s</div>' % linebreaks(text, autoescape=True)
+
+
+# Background threads of renders which didn't fit into time budget, by render cache key
+_pending_renders = {}
+_pending_lock = threading.Lock()
+
+
+def wait_pending_render(text, markup=None, timeout=None):
+    """
+    Wait until background rendering of `text` started by `render_within_limits` in this process
+    is finished. Returns False if it's still running after `timeout` seconds.
+    """
+    with _pending_lock:
+        worker = _pending_renders.get(get_render_cache_key(text, markup))
+    if worker is None:
+        return True
+    worker.join(timeout)
+    return not worker.is_alive()
+
+
+def render_within_limits(text, markup=None):
+    """
+    Return html for `text` or None if it exceeds render limits or was not rendered within
+    PYBB_RENDER_TIME_BUDGET seconds. In the last case rendering is finished in background
+    thread and its result goes to cache, the same text is not rendered again until it's finished.
+    If PYBB_RENDER_MAX_THREADS background renders are running, text is not rendered at all.
+    """
+    markup = markup or defaults.PYBB_MARKUP
+    if exceeds_limits(text, markup):
+        stats.add_deferred()
+        return None
+    budget = defaults.PYBB_RENDER_TIME_BUDGET
+    if not budget:
+        return render(text, markup)
+    key = get_render_cache_key(text, markup)
+    if defaults.PYBB_RENDER_CACHE_SIZE:
+        html = local_cache.get(key)
+        if html is not None:
+            return html
+
+    result = []
+
+    def target():
+        try:
+            result.append((render(text, markup), None))
+        except Exception as e:
+            result.append((None, e))
+        finally:
+            with _pending_lock:
+                _pending_renders.pop(key, None)
+
+    with _pending_lock:
+        if key in _pending_renders:
+            # text is being rendered by thread started in one of previous requests
+            stats.add_deferred()
+            return None
+        if len(_pending_renders) >= defaults.PYBB_RENDER_MAX_THREADS:
+            # don't let requests start unbounded number of slow renders, task renders it later
+            stats.add_deferred()
+            return None
+        worker = _pending_renders[key] = threading.Thread(target=target)
+    worker.daemon = True
+    worker.start()
+    worker.join(budget)
+    if not result:
+        stats.add_deferred()
+        return None
+    html, error = result[0]
+    if error is not None:
+        raise error
+    return html
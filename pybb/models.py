@@ -6,8 +6,11 @@ from django.contrib.contenttypes.models import ContentType
 from django.db.models.signals import post_delete, post_save
 from pybb.profiles import PybbProfile
 from pybb.subscription import notify_topic_subscribers
+from pybb import caching, counters, markup, search, tasks
+from pybb.fields import CompressedTextField
 
 from django.db import models, transaction
+from django.db.models import F
 from django.core.urlresolvers import reverse
 from django.db.utils import IntegrityError
 from django.utils.encoding import python_2_unicode_compatible
@@ -31,17 +34,12 @@ try:
     from south.modelsinspector import add_introspection_rules
     add_introspection_rules([], ["^annoying\.fields\.JSONField"])
     add_introspection_rules([], ["^annoying\.fields\.AutoOneToOneField"])
+    add_introspection_rules([], ["^pybb\.fields\.CompressedTextField"])
 except ImportError:
     pass
 
 from pybb import defaults
 
-try:
-    from django.db.transaction import atomic as atomic_func
-except ImportError:
-    from django.db.transaction import commit_on_success as atomic_func
-
-
 @python_2_unicode_compatible
 class Category(models.Model):
     name = models.CharField(_('Name'), max_length=80)
@@ -98,16 +96,38 @@ class Forum(models.Model):
         return self.name
 
     def update_counters(self):
-        posts = Post.objects.filter(topic__forum_id=self.id)
-        self.post_count = posts.count()
-        self.topic_count = Topic.objects.filter(forum=self).count()
-        try:
-            last_post = posts.order_by('-created')[0]
-            self.updated = last_post.updated or last_post.created
-        except IndexError:
-            pass
-
-        self.save()
+        with tasks.atomic():
+            # recounted values include buffered deltas
+            ForumCounterDelta.objects.filter(forum=self).delete()
+            posts = Post.objects.filter(topic__forum_id=self.id, topic__deleted=False)
+            self.post_count = posts.count()
+            self.topic_count = Topic.objects.filter(forum=self, deleted=False).count()
+            try:
+                last_post = posts.order_by('-created')[0]
+                self.updated = last_post.updated or last_post.created
+            except IndexError:
+                pass
+
+            self.save(update_fields=['post_count', 'topic_count', 'updated'])
+
+    def add_counters(self, post_count=0, topic_count=0, updated=None):
+        """
+        Add deltas to counters with one atomic update instead of recounting,
+        `updated` is time of the new last post. If PYBB_BUFFER_FORUM_COUNTERS is enabled,
+        deltas are stored separately and folded into forum by `pybb.counters.flush_forum_counters`.
+        """
+        if defaults.PYBB_BUFFER_FORUM_COUNTERS:
+            counters.add_forum_delta(self.pk, post_count, topic_count, updated)
+        else:
+            values = {'post_count': F('post_count') + post_count, 'topic_count': F('topic_count') + topic_count}
+            if updated is not None:
+                values['updated'] = updated
+            Forum.objects.filter(pk=self.pk).update(**values)
+        if updated is not None:
+            self.updated = updated
+        self.post_count += post_count
+        self.topic_count += topic_count
+        caching.forum_saved(self, update_fields=['post_count', 'topic_count', 'updated'])
 
     def get_absolute_url(self):
         return reverse('pybb:forum', kwargs={'pk': self.id})
@@ -119,7 +139,7 @@ class Forum(models.Model):
     @property
     def last_post(self):
         try:
-            return self.posts.order_by('-created')[0]
+            return self.posts.filter(topic__deleted=False).order_by('-created')[0]
         except IndexError:
             return None
 
@@ -162,12 +182,22 @@ class Topic(models.Model):
     on_moderation = models.BooleanField(_('On moderation'), default=False)
     poll_type = models.IntegerField(_('Poll type'), choices=POLL_TYPE_CHOICES, default=POLL_TYPE_NONE)
     poll_question = models.TextField(_('Poll question'), blank=True, null=True)
+    poll_vote_count = models.IntegerField(_('Poll votes count'), blank=True, default=0)
+    # Topic is hidden and waits for `pybb.moderation.purge_topic`
+    deleted = models.BooleanField(_('Deleted'), default=False, db_index=True)
 
     class Meta(object):
         ordering = ['-created']
         verbose_name = _('Topic')
         verbose_name_plural = _('Topics')
 
+    def __init__(self, *args, **kwargs):
+        super(Topic, self).__init__(*args, **kwargs)
+        # Forum which topic belongs to in database, to find out if topic was moved without extra query
+        self._loaded_forum_id = self.__dict__.get('forum_id') if self.pk else None
+        # Name which is stored in database, search index is updated only when it's changed
+        self._loaded_name = self.__dict__.get('name') if self.pk else None
+
     def __str__(self):
         return self.name
 
@@ -177,8 +207,8 @@ class Topic(models.Model):
         Get first post and cache it for request
         """
         if not hasattr(self, "_head"):
-            self._head = self.posts.all().order_by('created')
-        if not len(self._head):
+            self._head = list(self.posts.all().order_by('created', 'pk')[:1])
+        if not self._head:
             return None
         return self._head[0]
 
@@ -195,22 +225,27 @@ class Topic(models.Model):
         if self.id is None:
             self.created = tznow()
 
-        forum_changed = False
-        old_topic = None
-        if self.id is not None:
-            old_topic = Topic.objects.get(id=self.id)
-            if self.forum != old_topic.forum:
-                forum_changed = True
+        old_forum_id = self._loaded_forum_id
+        if self.id is not None and old_forum_id is None:
+            # forum field was deferred on loading
+            old_forum_id = Topic.objects.filter(id=self.id).values_list('forum_id', flat=True).first()
+        forum_changed = old_forum_id is not None and old_forum_id != self.forum_id
 
         super(Topic, self).save(*args, **kwargs)
+        self._loaded_forum_id = self.forum_id
+        self._loaded_name = self.name
 
         if forum_changed:
-            old_topic.forum.update_counters()
+            Forum.objects.get(pk=old_forum_id).update_counters()
             self.forum.update_counters()
 
     def delete(self, using=None):
-        super(Topic, self).delete(using)
-        self.forum.update_counters()
+        """
+        Hide topic at once, topic with its posts is deleted in batches by deferred task
+        """
+        from pybb import moderation
+
+        moderation.delete_topic(self)
 
     def update_counters(self):
         self.post_count = self.posts.count()
@@ -218,6 +253,20 @@ class Topic(models.Model):
         self.updated = last_post.updated or last_post.created
         self.save()
 
+    def add_counters(self, post_count=0, updated=None, **values):
+        """
+        Add delta to post count with one atomic update instead of recounting, `updated` is time
+        of the new last post, other field `values` are saved as is
+        """
+        if updated is not None:
+            values['updated'] = updated
+        for name, value in values.items():
+            setattr(self, name, value)
+        values['post_count'] = F('post_count') + post_count
+        Topic.objects.filter(pk=self.pk).update(**values)
+        self.post_count += post_count
+        caching.topic_saved(self)
+
     def get_parents(self):
         """
         Used in templates for breadcrumb building
@@ -228,10 +277,72 @@ class Topic(models.Model):
 
     def poll_votes(self):
         if self.poll_type != self.POLL_TYPE_NONE:
-            return PollAnswerUser.objects.filter(poll_answer__topic=self).count()
+            return self.poll_vote_count
         else:
             return None
 
+    def update_poll_votes(self):
+        """
+        Recount total of poll votes, answers tallies are kept by votes changes
+        """
+        self.poll_vote_count = PollAnswerUser.objects.filter(poll_answer__topic=self).count()
+        Topic.objects.filter(pk=self.pk).update(poll_vote_count=self.poll_vote_count)
+
+    def is_poll_voted(self, user):
+        """
+        Return True if `user` voted in poll of this topic. Result is remembered in topic instance,
+        so permission checks and templates of one request make one query.
+        """
+        if not user.is_authenticated():
+            return False
+        if not hasattr(self, '_poll_voted'):
+            self._poll_voted = {}
+        if user.pk not in self._poll_voted:
+            self._poll_voted[user.pk] = PollAnswerUser.objects.filter(poll_answer__topic=self, user=user).exists()
+        return self._poll_voted[user.pk]
+
+    def lock_poll(self):
+        """
+        Lock topic row until the end of transaction, so votes of one user are changed one at a time
+        """
+        list(Topic.objects.select_for_update().filter(pk=self.pk).values_list('pk', flat=True))
+
+    def add_poll_votes(self, user, answers):
+        """
+        Save votes of `user` for `answers` with one insert and add them to tallies of answers and topic
+        in one transaction. Returns False if user has voted already.
+        """
+        with tasks.atomic():
+            self.lock_poll()
+            if PollAnswerUser.objects.filter(poll_answer__topic=self, user=user).exists():
+                self._poll_voted = {user.pk: True}
+                return False
+            PollAnswerUser.objects.bulk_create([PollAnswerUser(poll_answer=answer, user=user) for answer in answers])
+            PollAnswer.objects.filter(pk__in=[answer.pk for answer in answers])\
+                .update(vote_count=F('vote_count') + 1)
+            Topic.objects.filter(pk=self.pk).update(poll_vote_count=F('poll_vote_count') + len(answers))
+        self.poll_vote_count += len(answers)
+        self._poll_voted = {user.pk: True}
+        return True
+
+    def cancel_poll_votes(self, user):
+        """
+        Delete votes of `user` and subtract them from tallies of answers and topic in one transaction.
+        Returns number of deleted votes.
+        """
+        with tasks.atomic():
+            self.lock_poll()
+            votes = list(PollAnswerUser.objects.filter(poll_answer__topic=self, user=user)
+                         .values_list('pk', 'poll_answer'))
+            if votes:
+                PollAnswerUser.objects.filter(pk__in=[pk for pk, answer_id in votes]).delete()
+                PollAnswer.objects.filter(pk__in=[answer_id for pk, answer_id in votes])\
+                    .update(vote_count=F('vote_count') - 1)
+                Topic.objects.filter(pk=self.pk).update(poll_vote_count=F('poll_vote_count') - len(votes))
+        self.poll_vote_count -= len(votes)
+        self._poll_voted = {user.pk: False}
+        return len(votes)
+
 
 class RenderableItem(models.Model):
     """
@@ -242,31 +353,54 @@ class RenderableItem(models.Model):
         abstract = True
 
     body = models.TextField(_('Message'))
-    body_html = models.TextField(_('HTML version'))
-    body_text = models.TextField(_('Text version'))
+    body_html = CompressedTextField(_('HTML version'))
+    body_text = CompressedTextField(_('Text version'))
+
+    def __init__(self, *args, **kwargs):
+        super(RenderableItem, self).__init__(*args, **kwargs)
+        # Body which was rendered to body_html (fields can be deferred, so don't touch them if they are not loaded)
+        self._rendered_body = self.__dict__.get('body') if self.pk and self.__dict__.get('body_html') else None
 
-    def render(self):
-        self.body_html = defaults.PYBB_MARKUP_ENGINES[defaults.PYBB_MARKUP](self.body)
+    def render(self, refresh=False, deferrable=False):
+        """
+        Render body to body_html and body_text. If `deferrable`, body which exceeds render limits
+        is replaced with placeholder and False is returned, it should be rendered later.
+        """
+        html = markup.render_within_limits(self.body) if deferrable else markup.render(self.body, refresh=refresh)
+        if html is None:
+            self.body_html = markup.render_placeholder(self.body)
+            self.body_text = self.body
+            return False
+        self.body_html = html
         # Remove tags which was generated with the markup processor
         text = strip_tags(self.body_html)
         # Unescape entities which was generated with the markup processor
         self.body_text = unescape(text)
+        return True
 
 
 @python_2_unicode_compatible
 class Post(RenderableItem):
+    # Maximum number of SQL statements made by saving new post, see `save`
+    POST_CREATE_QUERIES_LIMIT = 8
+
     topic = models.ForeignKey(Topic, related_name='posts', verbose_name=_('Topic'))
     user = models.ForeignKey(User, related_name='posts', verbose_name=_('User'))
     created = models.DateTimeField(_('Created'), blank=True, db_index=True)
     updated = models.DateTimeField(_('Updated'), blank=True, null=True)
     user_ip = models.IPAddressField(_('User IP'), blank=True, default='0.0.0.0')
-    on_moderation = models.BooleanField(_('On moderation'), default=False)
+    on_moderation = models.BooleanField(_('On moderation'), default=False, db_index=True)
 
     class Meta(object):
         ordering = ['created']
         verbose_name = _('Post')
         verbose_name_plural = _('Posts')
 
+    def __init__(self, *args, **kwargs):
+        super(Post, self).__init__(*args, **kwargs)
+        # Topic which post belongs to in database, to find out if post was moved without extra query
+        self._loaded_topic_id = self.__dict__.get('topic_id') if self.pk else None
+
     def summary(self):
         LIMIT = 50
         tail = len(self.body) > LIMIT and '...' or ''
@@ -276,32 +410,63 @@ class Post(RenderableItem):
         return self.summary()
 
     def save(self, *args, **kwargs):
-        created_at = tznow()
-        if self.created is None:
-            self.created = created_at
-        self.render()
-
-        new = self.pk is None
-
-        topic_changed = False
-        old_post = None
-        if not new:
-            old_post = Post.objects.get(pk=self.pk)
-            if old_post.topic != self.topic:
-                topic_changed = True
-
-        super(Post, self).save(*args, **kwargs)
-
-        # If post is topic head and moderated, moderate topic too
-        if self.topic.head == self and not self.on_moderation and self.topic.on_moderation:
-            self.topic.on_moderation = False
-
-        self.topic.update_counters()
-        self.topic.forum.update_counters()
+        """
+        Save post and update counters of its topic and forum in one transaction, notifications and
+        cache invalidation happen after commit.
 
-        if topic_changed:
-            old_post.topic.update_counters()
-            old_post.topic.forum.update_counters()
+        New post (saved without `created` time) costs at most POST_CREATE_QUERIES_LIMIT statements:
+        post insert, topic head, topic and forum counters updates, profile, subscription and
+        profile post count. New topic adds one insert.
+        """
+        # post created right now is the last one in its topic and forum, so counters can be incremented
+        is_latest = self.pk is None and self.created is None
+        if self.created is None:
+            self.created = tznow()
+        deferred = False
+        if self.body != self._rendered_body:
+            deferred = not self.render(deferrable=True)
+
+        old_topic_id = self._loaded_topic_id
+        if self.pk is not None and old_topic_id is None:
+            # topic field was deferred on loading
+            old_topic_id = Post.objects.filter(pk=self.pk).values_list('topic_id', flat=True).first()
+        topic_changed = old_topic_id is not None and old_topic_id != self.topic_id
+
+        topic_cache_name = Post._meta.get_field('topic').get_cache_name()
+        if getattr(self, topic_cache_name, None) is None:
+            # counters of topic and its forum are updated below, load both with one query
+            self.topic = Topic.objects.select_related('forum').get(pk=self.topic_id)
+
+        # head cached before this save can be stale, it's fetched again (with LIMIT 1) by the first check
+        # after insert, which is subscribers notification from post_save or the check below
+        self.topic.__dict__.pop('_head', None)
+
+        with tasks.atomic(savepoint=False):
+            super(Post, self).save(*args, **kwargs)
+            self._rendered_body = self.body
+            self._loaded_topic_id = self.topic_id
+            # immediate task would render post in this request again, it keeps placeholder instead
+            if deferred and not tasks.is_immediate():
+                tasks.enqueue('pybb.tasks.render_post', self.pk)
+
+            is_head = self.topic.head == self
+            # If post is topic head and moderated, moderate topic too
+            topic_values = {}
+            if is_head and not self.on_moderation and self.topic.on_moderation:
+                self.topic.on_moderation = False
+                topic_values['on_moderation'] = False
+
+            if is_latest:
+                self.topic.add_counters(1, self.created, **topic_values)
+                self.topic.forum.add_counters(1, 1 if is_head else 0, self.created)
+            else:
+                self.topic.update_counters()
+                self.topic.forum.update_counters()
+
+            if topic_changed:
+                old_topic = Topic.objects.select_related('forum').get(pk=old_topic_id)
+                old_topic.update_counters()
+                old_topic.forum.update_counters()
 
     def get_absolute_url(self):
         return reverse('pybb:post', kwargs={'pk': self.id})
@@ -375,7 +540,7 @@ class TopicReadTrackerManager(models.Manager):
         """
         is_new = True
         try:
-            with atomic_func():
+            with transaction.atomic():
                 obj = TopicReadTracker.objects.create(user=user, topic=topic)
         except IntegrityError:
             transaction.commit()
@@ -411,7 +576,7 @@ class ForumReadTrackerManager(models.Manager):
         """
         is_new = True
         try:
-            with atomic_func():
+            with transaction.atomic():
                 obj = ForumReadTracker.objects.create(user=user, forum=forum)
         except IntegrityError:
             transaction.commit()
@@ -436,10 +601,51 @@ class ForumReadTracker(models.Model):
         unique_together = ('user', 'forum')
 
 
+class PendingNotification(models.Model):
+    """
+    Notification about new post which waits for digest email
+    """
+    user = models.ForeignKey(User, related_name='pending_notifications', verbose_name=_('User'))
+    post = models.ForeignKey(Post, related_name='pending_notifications', verbose_name=_('Post'))
+    created = models.DateTimeField(_('Created'), auto_now_add=True)
+
+    class Meta(object):
+        verbose_name = _('Pending notification')
+        verbose_name_plural = _('Pending notifications')
+
+
+class ForumCounterDelta(models.Model):
+    """
+    Change of forum counters which is not folded into forum yet, see PYBB_BUFFER_FORUM_COUNTERS setting
+    """
+    forum = models.ForeignKey(Forum, related_name='counter_deltas', verbose_name=_('Forum'))
+    post_count = models.IntegerField(_('Post count'), default=0)
+    topic_count = models.IntegerField(_('Topic count'), default=0)
+    updated = models.DateTimeField(_('Updated'), blank=True, null=True)
+
+    class Meta(object):
+        verbose_name = _('Forum counters delta')
+        verbose_name_plural = _('Forum counters deltas')
+
+
+class SearchTerm(models.Model):
+    """
+    Entry of inverted index of pybb.search.LocalIndexBackend: term found in post body or in topic name
+    """
+    term = models.CharField(_('Term'), max_length=64, db_index=True)
+    post = models.ForeignKey(Post, related_name='search_terms', verbose_name=_('Post'), blank=True, null=True)
+    topic = models.ForeignKey(Topic, related_name='search_terms', verbose_name=_('Topic'), blank=True, null=True)
+
+    class Meta(object):
+        verbose_name = _('Search term')
+        verbose_name_plural = _('Search terms')
+
+
 @python_2_unicode_compatible
 class PollAnswer(models.Model):
     topic = models.ForeignKey(Topic, related_name='poll_answers', verbose_name=_('Topic'))
     text = models.CharField(max_length=255, verbose_name=_('Text'))
+    vote_count = models.IntegerField(_('Votes count'), blank=True, default=0)
 
     class Meta:
         verbose_name = _('Poll answer')
@@ -449,12 +655,13 @@ class PollAnswer(models.Model):
         return self.text
 
     def votes(self):
-        return self.users.count()
+        return self.vote_count
 
     def votes_percent(self):
+        # answers loaded with topic.poll_answers share topic instance, tallies are not queried
         topic_votes = self.topic.poll_votes()
         if topic_votes > 0:
-            return 1.0 * self.votes() / topic_votes * 100
+            return 1.0 * self.vote_count / topic_votes * 100
         else:
             return 0
 
@@ -474,22 +681,37 @@ class PollAnswerUser(models.Model):
         return '%s - %s' % (self.poll_answer.topic, self.user)
 
 
-def post_saved(instance, **kwargs):
-    notify_topic_subscribers(instance)
+def update_post_count(profile, delta):
+    """
+    Change post count of `profile` with atomic update, loaded profile is kept in sync
+    """
+    get_pybb_profile_model().objects.filter(pk=profile.pk).update(post_count=F('post_count') + delta)
+    profile.post_count += delta
 
-    if get_pybb_profile(instance.user).autosubscribe:
-        instance.topic.subscribers.add(instance.user)
 
-    if kwargs['created']:
-        profile = get_pybb_profile(instance.user)
-        profile.post_count = instance.user.posts.count()
-        profile.save()
+def post_saved(instance, created, **kwargs):
+    # Editing post changes neither subscriptions nor counters
+    if not created:
+        return
 
+    # subscribers are notified about premoderated post when it's approved
+    if not instance.on_moderation:
+        notify_topic_subscribers(instance)
 
-def post_deleted(instance, **kwargs):
     profile = get_pybb_profile(instance.user)
-    profile.post_count = instance.user.posts.count()
-    profile.save()
+    if profile.autosubscribe:
+        # add() doesn't insert row if user is subscribed already
+        instance.topic.subscribers.add(instance.user)
+    update_post_count(profile, 1)
+
+
+def post_deleted(instance, **kwargs):
+    from pybb.moderation import in_bulk_delete
+
+    # Bulk deletes recount profiles once at the end
+    if in_bulk_delete():
+        return
+    update_post_count(get_pybb_profile(instance.user), -1)
 
 
 def user_saved(instance, created, **kwargs):
@@ -508,5 +730,19 @@ def user_saved(instance, created, **kwargs):
 
 post_save.connect(post_saved, sender=Post)
 post_delete.connect(post_deleted, sender=Post)
+post_save.connect(caching.post_saved, sender=Post)
+post_delete.connect(caching.post_saved, sender=Post)
+post_save.connect(caching.topic_saved, sender=Topic)
+post_delete.connect(caching.topic_saved, sender=Topic)
+post_save.connect(caching.forum_saved, sender=Forum)
+post_delete.connect(caching.forum_saved, sender=Forum)
+post_save.connect(caching.category_saved, sender=Category)
+post_delete.connect(caching.category_saved, sender=Category)
+post_save.connect(search.post_saved, sender=Post)
+post_delete.connect(search.post_deleted, sender=Post)
+post_save.connect(search.topic_saved, sender=Topic)
+post_delete.connect(search.topic_deleted, sender=Topic)
 if defaults.PYBB_AUTO_USER_PERMISSIONS:
     post_save.connect(user_saved, sender=get_user_model())
+
+tasks.check_render_backend()
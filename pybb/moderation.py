@@ -0,0 +1,392 @@
+# -*- coding: utf-8 -*-
+"""
+Bulk moderation actions.
+
+Posts and topics are deleted with queryset deletes in batches of PYBB_DELETE_BATCH_SIZE instead of
+`Post.delete` and `Topic.delete` calls, which recount topic, forum and profile after each object.
+Counters of affected topics, forums and profiles are recounted once at the end.
+
+Deleted topic is hidden with `deleted` flag at once and purged by deferred task, so large topic
+doesn't hold locks of request transaction.
+
+Topics are moved, merged and split with updates of `forum` and `topic` columns of all rows at once,
+counters are changed by numbers of moved topics and posts.
+
+Premoderated posts are approved with one update of `on_moderation` flag, subscribers are notified once
+per topic.
+"""
+
+from __future__ import unicode_literals
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+
+from django.db.models import Count, Max, Min
+
+from pybb import caching, counters, defaults, tasks, util
+
+
+_state = threading.local()
+
+
+@contextmanager
+def bulk_delete():
+    """
+    Skip per object counters updates in signal handlers while objects are deleted in this block,
+    caller should recount them itself
+    """
+    previous = getattr(_state, 'bulk_delete', False)
+    _state.bulk_delete = True
+    try:
+        yield
+    finally:
+        _state.bulk_delete = previous
+
+
+def in_bulk_delete():
+    return getattr(_state, 'bulk_delete', False)
+
+
+def iter_batches(ids):
+    ids = sorted(ids)
+    for start in range(0, len(ids), defaults.PYBB_DELETE_BATCH_SIZE):
+        yield ids[start:start + defaults.PYBB_DELETE_BATCH_SIZE]
+
+
+def recount_profiles(user_ids):
+    """
+    Recount post count of profiles of users with `user_ids`
+    """
+    from pybb.models import Post
+
+    post_counts = dict((row['user'], row['count']) for row in
+                       Post.objects.filter(user__in=user_ids).values('user').annotate(count=Count('id')).order_by())
+    for user in util.get_user_model().objects.filter(pk__in=user_ids):
+        profile = util.get_pybb_profile(user)
+        util.get_pybb_profile_model().objects.filter(pk=profile.pk).update(post_count=post_counts.get(user.pk, 0))
+
+
+def recount(topic_ids, forum_ids, user_ids):
+    """
+    Recount remaining topics with `topic_ids`, forums with `forum_ids` and profiles of users with `user_ids`
+    """
+    from pybb.models import Forum, Post, Topic
+
+    for batch in iter_batches(topic_ids):
+        counters.recount_topics(Topic.objects.filter(pk__in=batch), Post.objects.filter(topic__in=batch))
+    for batch in iter_batches(forum_ids):
+        counters.recount_forums(Forum.objects.filter(pk__in=batch))
+    for batch in iter_batches(user_ids):
+        recount_profiles(batch)
+
+
+def get_user_head_topic_ids(user_id):
+    """
+    Return ids of topics whose first post is written by user with `user_id`
+    """
+    from pybb.models import Post
+
+    user_posts = list(Post.objects.filter(user=user_id).values_list('topic', 'created'))
+    first_created = {}
+    for batch in iter_batches(set(topic_id for topic_id, created in user_posts)):
+        first_created.update((row['topic'], row['first_created']) for row in
+                             Post.objects.filter(topic__in=batch).values('topic')
+                             .annotate(first_created=Min('created')).order_by())
+    return set(topic_id for topic_id, created in user_posts if created == first_created.get(topic_id))
+
+
+def purge_user_posts(user_id):
+    """
+    Delete all posts of user with `user_id`. Like `Post.delete`, deleting of the first post of topic
+    deletes whole topic: it's hidden with `delete_topic` and purged by its own task. Topics which
+    become empty are deleted too.
+    """
+    from pybb.models import Post, Topic
+
+    head_topic_ids = get_user_head_topic_ids(user_id)
+    topic_ids = set(Post.objects.filter(user=user_id).values_list('topic', flat=True).distinct())
+    # posts in hidden topics are left to purge_topic
+    reply_topic_ids = topic_ids - head_topic_ids
+    forum_ids = set()
+    for batch in iter_batches(topic_ids):
+        forum_ids.update(Topic.objects.filter(pk__in=batch).values_list('forum', flat=True).order_by().distinct())
+
+    for batch in iter_batches(head_topic_ids):
+        for topic in Topic.objects.filter(pk__in=batch, deleted=False).select_related('forum'):
+            delete_topic(topic)
+    with bulk_delete():
+        for topic_batch in iter_batches(reply_topic_ids):
+            post_ids = Post.objects.filter(user=user_id, topic__in=topic_batch).values_list('pk', flat=True)
+            for batch in iter_batches(post_ids):
+                with tasks.atomic():
+                    Post.objects.filter(pk__in=batch).delete()
+            emptied = list(Topic.objects.filter(pk__in=topic_batch).annotate(cnt=Count('posts'))
+                           .filter(cnt=0).values_list('pk', flat=True))
+            if emptied:
+                with tasks.atomic():
+                    Topic.objects.filter(pk__in=emptied).delete()
+
+    recount(reply_topic_ids, forum_ids, [user_id])
+
+
+def delete_topic(topic):
+    """
+    Hide `topic` and queue its purge. Counters of forum are decremented by topic and its posts right away.
+    """
+    from pybb.models import Forum, Topic
+
+    with tasks.atomic():
+        if not Topic.objects.filter(pk=topic.pk, deleted=False).update(deleted=True):
+            # already hidden, its posts are not counted in forum
+            return
+        topic.deleted = True
+        post_count, updated = Topic.objects.filter(pk=topic.pk).values_list('post_count', 'updated')[0]
+        forum = topic.forum
+        forum.add_counters(-post_count, -1)
+        if updated and forum.updated and updated >= forum.updated:
+            # topic had the last post of forum
+            latest = Topic.objects.filter(forum=forum.pk, deleted=False).aggregate(Max('updated'))['updated__max']
+            if latest is not None:
+                Forum.objects.filter(pk=forum.pk).update(updated=latest)
+                forum.updated = latest
+        caching.topic_saved(topic)
+        tasks.enqueue('pybb.moderation.purge_topic', topic.pk)
+
+
+def purge_topic(topic_id):
+    """
+    Delete topic hidden by `delete_topic` with its posts, attachments, poll votes and read trackers.
+    Dependent rows are deleted in batches, each batch in its own transaction, profiles of posts authors
+    are recounted once at the end. Forum counters don't include hidden topic already.
+    """
+    from pybb.models import PollAnswerUser, Post, Topic, TopicReadTracker
+
+    if not Topic.objects.filter(pk=topic_id, deleted=True).exists():
+        return
+    posts = Post.objects.filter(topic=topic_id)
+    user_ids = set(posts.values_list('user', flat=True).distinct())
+
+    with bulk_delete():
+        for model, qs in ((Post, posts),
+                          (PollAnswerUser, PollAnswerUser.objects.filter(poll_answer__topic=topic_id)),
+                          (TopicReadTracker, TopicReadTracker.objects.filter(topic=topic_id))):
+            for batch in iter_batches(qs.values_list('pk', flat=True)):
+                with tasks.atomic():
+                    model.objects.filter(pk__in=batch).delete()
+        with tasks.atomic():
+            # poll answers and subscriptions are left
+            Topic.objects.filter(pk=topic_id).delete()
+
+    recount((), (), user_ids)
+
+
+def add_forum_counters(deltas):
+    """
+    Add `deltas` (dict forum id -> [post count delta, topic count delta]) to forum counters
+    """
+    from pybb.models import Forum
+
+    for forum in Forum.objects.filter(pk__in=[pk for pk, delta in deltas.items() if any(delta)]):
+        forum.add_counters(*deltas[forum.pk])
+
+
+def update_forums_updated(forum_ids):
+    """
+    Set update time of forums with `forum_ids` to update time of their latest topic
+    """
+    from pybb.models import Forum, Topic
+
+    rows = Topic.objects.filter(forum__in=forum_ids, deleted=False).exclude(updated=None).values('forum')\
+        .annotate(updated=Max('updated')).order_by()
+    for row in rows:
+        Forum.objects.filter(pk=row['forum']).exclude(updated=row['updated']).update(updated=row['updated'])
+
+
+def get_topic_updated(topic_id):
+    """
+    Return update or creation time of the last post of topic with `topic_id`
+    """
+    from pybb.models import Post
+
+    row = Post.objects.filter(topic=topic_id).order_by('-created').values_list('created', 'updated').first()
+    return row and (row[1] or row[0])
+
+
+def move_topics(topics, forum):
+    """
+    Move `topics` (queryset) to `forum`. Returns number of moved topics.
+    """
+    from pybb.models import Topic
+
+    with tasks.atomic():
+        rows = list(topics.filter(deleted=False).exclude(forum=forum).values_list('pk', 'forum', 'post_count'))
+        if not rows:
+            return 0
+        deltas = defaultdict(lambda: [0, 0])
+        for pk, forum_id, post_count in rows:
+            deltas[forum_id][0] -= post_count
+            deltas[forum_id][1] -= 1
+            deltas[forum.pk][0] += post_count
+            deltas[forum.pk][1] += 1
+        ids = [row[0] for row in rows]
+        Topic.objects.filter(pk__in=ids).update(forum=forum)
+        add_forum_counters(deltas)
+        update_forums_updated(deltas.keys())
+        caching.invalidate([caching.topic_version(pk) for pk in ids])
+    return len(rows)
+
+
+def merge_topics(topics, target):
+    """
+    Move posts of `topics` (queryset) to `target` topic and delete emptied topics with their polls.
+    Subscribers of merged topics are subscribed to `target`. Returns number of merged topics.
+    """
+    from pybb.models import Post, Topic
+
+    with tasks.atomic():
+        rows = list(topics.filter(deleted=False).exclude(pk=target.pk).values_list('pk', 'forum', 'post_count'))
+        if not rows:
+            return 0
+        deltas = defaultdict(lambda: [0, 0])
+        for pk, forum_id, post_count in rows:
+            deltas[forum_id][0] -= post_count
+            deltas[forum_id][1] -= 1
+            deltas[target.forum_id][0] += post_count
+        ids = [row[0] for row in rows]
+        Post.objects.filter(topic__in=ids).update(topic=target)
+        # add() doesn't insert rows of users who are subscribed already
+        target.subscribers.add(*util.get_user_model().objects.filter(subscriptions__in=ids)
+                               .values_list('pk', flat=True).distinct())
+        Topic.objects.filter(pk__in=ids).delete()
+        target.add_counters(sum(row[2] for row in rows), get_topic_updated(target.pk))
+        add_forum_counters(deltas)
+        update_forums_updated(deltas.keys())
+        caching.invalidate([caching.topic_version(pk) for pk in ids])
+    return len(rows)
+
+
+def split_posts(posts, name, forum=None):
+    """
+    Move `posts` (queryset of posts of one topic) to new topic `name` in `forum` (forum of their topic
+    by default). Author and creation time of new topic are taken from its first post, source topic
+    is deleted if all its posts are moved. Returns new topic or None if there are no posts.
+    """
+    from pybb.models import Post, Topic
+
+    with tasks.atomic():
+        rows = list(posts.order_by('created').values_list('pk', 'topic', 'user', 'created'))
+        if not rows:
+            return None
+        source = Topic.objects.select_related('forum').get(pk=rows[0][1])
+        ids = [row[0] for row in rows if row[1] == source.pk]
+        forum = forum or source.forum
+
+        topic = Topic.objects.create(forum=forum, name=name, user_id=rows[0][2], post_count=len(ids))
+        Post.objects.filter(pk__in=ids).update(topic=topic)
+        topic.created = rows[0][3]
+        topic.updated = get_topic_updated(topic.pk)
+        Topic.objects.filter(pk=topic.pk).update(created=topic.created, updated=topic.updated)
+
+        deltas = defaultdict(lambda: [0, 0])
+        deltas[source.forum_id][0] -= len(ids)
+        deltas[forum.pk][0] += len(ids)
+        deltas[forum.pk][1] += 1
+        source_updated = get_topic_updated(source.pk)
+        if source_updated:
+            source.add_counters(-len(ids), source_updated)
+        else:
+            deltas[source.forum_id][1] -= 1
+            Topic.objects.filter(pk=source.pk).delete()
+        add_forum_counters(deltas)
+        update_forums_updated(deltas.keys())
+    return topic
+
+
+def get_head_ids(topic_ids):
+    """
+    Return ids of the first posts of topics with `topic_ids`
+    """
+    from pybb.models import Post
+
+    first_created = dict((row['topic'], row['first_created']) for row in
+                         Post.objects.filter(topic__in=topic_ids).values('topic')
+                         .annotate(first_created=Min('created')).order_by())
+    return set(pk for pk, topic_id, created in
+               Post.objects.filter(topic__in=topic_ids, created__in=set(first_created.values()))
+               .values_list('pk', 'topic', 'created')
+               if created == first_created[topic_id])
+
+
+def approve_posts(posts):
+    """
+    Approve premoderated `posts` (queryset). Topics whose first posts are approved become visible,
+    subscribers of each topic are notified once about its last approved post.
+    Returns number of approved posts.
+    """
+    from pybb.models import Post, Topic
+    from pybb.subscription import notify_topic_subscribers
+
+    with tasks.atomic():
+        rows = list(posts.filter(on_moderation=True).values_list('pk', 'topic', 'topic__forum', 'created'))
+        if not rows:
+            return 0
+        ids = [row[0] for row in rows]
+        topic_ids = set(row[1] for row in rows)
+        Post.objects.filter(pk__in=ids).update(on_moderation=False)
+        head_ids = get_head_ids(topic_ids)
+        Topic.objects.filter(on_moderation=True, posts__in=head_ids & set(ids)).update(on_moderation=False)
+
+        last_posts = {}
+        for pk, topic_id, forum_id, created in rows:
+            if pk not in head_ids and (topic_id not in last_posts or created > last_posts[topic_id][1]):
+                last_posts[topic_id] = (pk, created)
+        for post in Post.objects.filter(pk__in=[pk for pk, created in last_posts.values()]).select_related('topic'):
+            notify_topic_subscribers(post)
+        caching.invalidate([caching.topic_version(topic_id) for topic_id in topic_ids] +
+                           [caching.forum_version(row[2]) for row in rows] + [caching.INDEX])
+    return len(rows)
+
+
+def reject_posts(posts):
+    """
+    Delete premoderated `posts` (queryset). Topics whose first posts are rejected are hidden and
+    purged like with `delete_topic`, counters of other topics, their forums and profiles are recounted once.
+    Returns number of rejected posts.
+    """
+    from pybb.models import Post, Topic
+
+    with tasks.atomic():
+        rows = list(posts.filter(on_moderation=True).values_list('pk', 'topic', 'topic__forum', 'user'))
+        if not rows:
+            return 0
+        ids = set(row[0] for row in rows)
+        head_ids = get_head_ids(set(row[1] for row in rows)) & ids
+        deleted_topic_ids = set(row[1] for row in rows if row[0] in head_ids)
+        Topic.objects.filter(pk__in=deleted_topic_ids).update(deleted=True)
+        for topic_id in deleted_topic_ids:
+            tasks.enqueue('pybb.moderation.purge_topic', topic_id)
+        with bulk_delete():
+            Post.objects.filter(pk__in=[row[0] for row in rows if row[1] not in deleted_topic_ids]).delete()
+        recount(set(row[1] for row in rows) - deleted_topic_ids, set(row[2] for row in rows),
+                set(row[3] for row in rows))
+        caching.invalidate([caching.topic_version(topic_id) for topic_id in deleted_topic_ids])
+    return len(rows)
+
+
+def block_user(user, delete_posts=False):
+    """
+    Deactivate `user` and delete all his posts if `delete_posts`. Posts are deleted by deferred task
+    if there are more than PYBB_DELETE_BACKGROUND_THRESHOLD of them. Returns True if posts are left
+    to task which doesn't run within the current request.
+    """
+    from pybb.models import Post
+
+    user.is_active = False
+    user.save()
+    if not delete_posts:
+        return False
+    if Post.objects.filter(user=user).count() > defaults.PYBB_DELETE_BACKGROUND_THRESHOLD:
+        tasks.enqueue('pybb.moderation.purge_user_posts', user.pk)
+        return not tasks.is_immediate()
+    purge_user_posts(user.pk)
+    return False
@@ -8,7 +8,7 @@ from django.utils.importlib import import_module
 from django.db.models import Q
 
 from pybb import defaults
-from pybb.models import Topic, PollAnswerUser
+from pybb.models import Topic
 
 
 def _resolve_class(name):
@@ -52,6 +52,10 @@ class DefaultPermissionHandler(object):
         """ return True if user may view this forum, False if not """
         return user.is_staff or ( forum.hidden == False and forum.category.hidden == False )
 
+    def filter_moderated_forums(self, user, qs):
+        """ return a queryset with forums whose topics `user` may moderate and move topics to """
+        return qs if user.is_superuser else qs.filter(moderators=user)
+
     def may_create_topic(self, user, forum):
         """ return True if `user` is allowed to create a new topic in `forum` """
         return user.has_perm('pybb.add_post')
@@ -61,6 +65,7 @@ class DefaultPermissionHandler(object):
     # 
     def filter_topics(self, user, qs):
         """ return a queryset with topics `user` is allowed to see """
+        qs = qs.filter(deleted=False)
         if not user.is_staff:
             qs = qs.filter(Q(forum__hidden=False) & Q(forum__category__hidden=False))
         if not user.is_superuser:
@@ -72,6 +77,8 @@ class DefaultPermissionHandler(object):
 
     def may_view_topic(self, user, topic):
         """ return True if user may view this topic, False otherwise """
+        if topic.deleted:
+            return False  # deleted topic waits for purge, nobody may see it
         if user.is_superuser:
             return True
         if not user.is_staff and (topic.forum.hidden or topic.forum.category.hidden):
@@ -80,6 +87,11 @@ class DefaultPermissionHandler(object):
             return user.is_authenticated() and (user == topic.user or user in topic.forum.moderators)
         return True
 
+    def filter_moderated_topics(self, user, qs):
+        """ return a queryset with topics `user` may moderate (move, merge, split) """
+        qs = qs.filter(deleted=False)
+        return qs if user.is_superuser else qs.filter(forum__moderators=user)
+
     def may_moderate_topic(self, user, topic):
         return user.is_superuser or user in topic.forum.moderators.all()
 
@@ -103,7 +115,7 @@ class DefaultPermissionHandler(object):
         """ return True if `user` may unstick `topic` """
         return (
             user.is_authenticated() and topic.poll_type != Topic.POLL_TYPE_NONE and not topic.closed and
-            not PollAnswerUser.objects.filter(poll_answer__topic=topic, user=user).exists()
+            not topic.is_poll_voted(user)
         )
 
     def may_create_post(self, user, topic):
@@ -131,6 +143,7 @@ class DefaultPermissionHandler(object):
         """ return a queryset with posts `user` is allowed to see """
 
         # first filter by topic availability
+        qs = qs.filter(topic__deleted=False)
         if not user.is_staff:
             qs = qs.filter(Q(topic__forum__hidden=False) & Q(topic__forum__category__hidden=False))
 
@@ -149,6 +162,8 @@ class DefaultPermissionHandler(object):
 
     def may_view_post(self, user, post):
         """ return True if `user` may view `post`, False otherwise """
+        if post.topic.deleted:
+            return False
         if user.is_superuser:
             return True
         if post.on_moderation:
@@ -3,7 +3,7 @@ import functools
 from django.conf import settings
 from django.db import models
 from django.utils.translation import ugettext_lazy as _
-from pybb import defaults
+from pybb import defaults, markup
 from pybb.util import get_file_path
 
 try:
@@ -28,6 +28,16 @@ class PybbProfile(models.Model):
     Abstract class for user profile, site profile should be inherted from this class
     """
 
+    DELIVERY_IMMEDIATE = 0
+    DELIVERY_HOURLY = 1
+    DELIVERY_DAILY = 2
+
+    DELIVERY_CHOICES = (
+        (DELIVERY_IMMEDIATE, _('Immediately')),
+        (DELIVERY_HOURLY, _('Hourly digest')),
+        (DELIVERY_DAILY, _('Daily digest')),
+    )
+
     class Meta(object):
         abstract = True
         permissions = (
@@ -51,10 +61,20 @@ class PybbProfile(models.Model):
     autosubscribe = models.BooleanField(_('Automatically subscribe'),
         help_text=_('Automatically subscribe to topics that you answer'),
         default=defaults.PYBB_DEFAULT_AUTOSUBSCRIBE)
+    notification_delivery = models.IntegerField(_('Notifications delivery'), choices=DELIVERY_CHOICES,
+        help_text=_('How to send notifications about new posts in topics that you subscribed'),
+        default=DELIVERY_IMMEDIATE)
+
+    def __init__(self, *args, **kwargs):
+        super(PybbProfile, self).__init__(*args, **kwargs)
+        # Signature which was rendered to signature_html
+        self._rendered_signature = self.__dict__.get('signature') if self.pk else None
 
     def save(self, *args, **kwargs):
-        self.signature_html = defaults.PYBB_MARKUP_ENGINES[defaults.PYBB_MARKUP](self.signature)
+        if self.signature != self._rendered_signature:
+            self.signature_html = markup.render(self.signature)
         super(PybbProfile, self).save(*args, **kwargs)
+        self._rendered_signature = self.signature
 
     @property
     def avatar_url(self):
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+"""
+Full-text search over post bodies and topic names.
+
+Index is kept by backend selected with PYBB_SEARCH_BACKEND setting. Backend indexes `body_text`
+of posts and names of topics and filters queryset of posts by query, so results are always
+limited with permission filters and with the current state of database: entries of removed posts
+and posts which user may not see are never shown. Index is updated by tasks queued from
+post_save/post_delete signals, `pybb_rebuild_search_index` command rebuilds it from scratch.
+
+Search is disabled by default. LocalIndexBackend keeps inverted index in SearchTerm model and
+works with any database. Backends based on database full-text search (PostgreSQL tsvector, SQLite FTS5) or
+on external search engines can be plugged in by subclassing BaseSearchBackend.
+"""
+
+from __future__ import unicode_literals
+import re
+
+from django.db.models import Q
+
+from pybb import defaults, tasks
+
+
+MIN_TERM_LENGTH = 2
+MAX_TERM_LENGTH = 64
+# Every term of query adds subquery, long queries are truncated
+MAX_QUERY_TERMS = 8
+
+_word_re = re.compile(r'\w+', re.UNICODE)
+
+
+def get_terms(text):
+    """
+    Split text to lowercase unique terms in order of appearance
+    """
+    terms = []
+    seen = set()
+    for word in _word_re.findall((text or '').lower()):
+        term = word[:MAX_TERM_LENGTH]
+        if len(term) >= MIN_TERM_LENGTH and term not in seen:
+            seen.add(term)
+            terms.append(term)
+    return terms
+
+
+class BaseSearchBackend(object):
+    """
+    Base class for search backends. `index_*` methods accept iterables of objects and replace
+    their indexed text, `remove_*` methods accept ids. `search` accepts query string and queryset
+    of posts and returns queryset of posts which match query, ordering is applied by caller.
+    """
+    def index_posts(self, posts):
+        raise NotImplementedError
+
+    def index_topics(self, topics):
+        raise NotImplementedError
+
+    def remove_posts(self, post_ids):
+        raise NotImplementedError
+
+    def remove_topics(self, topic_ids):
+        raise NotImplementedError
+
+    def search(self, query, posts):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+
+class LocalIndexBackend(BaseSearchBackend):
+    """
+    Keeps inverted index in database table: one SearchTerm row per term of post body or topic name.
+    Post matches query if each term of query is found in its body or in the name of its topic.
+    """
+    def _replace(self, field, objects, get_text):
+        from pybb.models import SearchTerm
+
+        objects = list(objects)
+        entries = []
+        for obj in objects:
+            entries.extend(SearchTerm(term=term, **{field: obj}) for term in get_terms(get_text(obj)))
+        with tasks.atomic():
+            SearchTerm.objects.filter(**{'%s__in' % field: [obj.pk for obj in objects]}).delete()
+            SearchTerm.objects.bulk_create(entries)
+
+    def index_posts(self, posts):
+        self._replace('post', posts, lambda post: post.body_text)
+
+    def index_topics(self, topics):
+        self._replace('topic', topics, lambda topic: topic.name)
+
+    def remove_posts(self, post_ids):
+        from pybb.models import SearchTerm
+
+        SearchTerm.objects.filter(post__in=list(post_ids)).delete()
+
+    def remove_topics(self, topic_ids):
+        from pybb.models import SearchTerm
+
+        SearchTerm.objects.filter(topic__in=list(topic_ids)).delete()
+
+    def search(self, query, posts):
+        from pybb.models import SearchTerm
+
+        terms = get_terms(query)[:MAX_QUERY_TERMS]
+        if not terms:
+            return posts.none()
+        for term in terms:
+            entries = SearchTerm.objects.filter(term=term)
+            posts = posts.filter(Q(pk__in=entries.filter(post__isnull=False).values('post')) |
+                                 Q(topic__in=entries.filter(topic__isnull=False).values('topic')))
+        return posts
+
+    def clear(self):
+        from pybb.models import SearchTerm
+
+        SearchTerm.objects.all().delete()
+
+
+_backend = (None, None)
+
+
+def get_backend():
+    """
+    Return instance of backend selected with PYBB_SEARCH_BACKEND setting or None if search is disabled
+    """
+    global _backend
+    name = defaults.PYBB_SEARCH_BACKEND
+    if not name:
+        return None
+    if _backend[0] != name:
+        _backend = (name, tasks._resolve(name)())
+    return _backend[1]
+
+
+def search_posts(query, posts):
+    """
+    Filter `posts` queryset by query string with the current backend
+    """
+    return get_backend().search(query, posts)
+
+
+def index_post(post_id):
+    from pybb.models import Post
+
+    backend = get_backend()
+    posts = list(Post.objects.filter(pk=post_id))
+    if backend is not None and posts:
+        backend.index_posts(posts)
+
+
+def index_topic(topic_id):
+    from pybb.models import Topic
+
+    backend = get_backend()
+    topics = list(Topic.objects.filter(pk=topic_id))
+    if backend is not None and topics:
+        backend.index_topics(topics)
+
+
+def remove_post(post_id):
+    backend = get_backend()
+    if backend is not None:
+        backend.remove_posts([post_id])
+
+
+def remove_topic(topic_id):
+    backend = get_backend()
+    if backend is not None:
+        backend.remove_topics([topic_id])
+
+
+def post_saved(instance, created, **kwargs):
+    # Signal is sent before `save` marks the body as rendered, so changed body still differs from it
+    if defaults.PYBB_SEARCH_BACKEND and (created or instance.body != instance._rendered_body):
+        tasks.enqueue('pybb.search.index_post', instance.pk)
+
+
+def post_deleted(instance, **kwargs):
+    from pybb.moderation import in_bulk_delete
+
+    # Entries of bulk deleted posts are dropped by foreign key cascade of local index,
+    # other backends never return them, because results are filtered by database
+    if defaults.PYBB_SEARCH_BACKEND and not in_bulk_delete():
+        tasks.enqueue('pybb.search.remove_post', instance.pk)
+
+
+def topic_saved(instance, created, **kwargs):
+    # Signal is sent before `save` updates the loaded name, as for posts above
+    if defaults.PYBB_SEARCH_BACKEND and (created or instance.name != instance._loaded_name):
+        tasks.enqueue('pybb.search.index_topic', instance.pk)
+
+
+def topic_deleted(instance, **kwargs):
+    if defaults.PYBB_SEARCH_BACKEND:
+        tasks.enqueue('pybb.search.remove_topic', instance.pk)
@@ -1,51 +1,206 @@
 # -*- coding: utf-8 -*-
 
 from __future__ import unicode_literals
+import logging
+from itertools import groupby
 from django.conf import settings
 from django.core.urlresolvers import reverse
 from django.template.loader import render_to_string
 from django.utils import translation
 from django.contrib.sites.models import Site
 from django import forms
+from django.core.mail import get_connection
+from django.db.models import Max
 
-from pybb import defaults, util
+from pybb import defaults, tasks, util
 
 if defaults.PYBB_USE_DJANGO_MAILER:
     try:
-        from mailer import send_mail
+        from mailer import send_mass_mail
     except ImportError:
-        from django.core.mail import send_mail
+        from django.core.mail import send_mass_mail
 else:
-    from django.core.mail import send_mail
+    from django.core.mail import send_mass_mail
 
 
+logger = logging.getLogger('pybb.subscription')
 email_validator = forms.EmailField()
 
+
 def notify_topic_subscribers(post):
-    topic = post.topic
-    if post != topic.head:
-        for user in topic.subscribers.all():
-            if user != post.user:
+    """
+    Queue notifications about new `post` for subscribers of its topic
+    """
+    if post != post.topic.head:
+        tasks.enqueue('pybb.subscription.send_topic_notifications', post.pk)
+
+
+def render_notification(post, site, lang):
+    """
+    Return subject and body of notification about `post` in `lang` language
+    """
+    with translation.override(lang):
+        delete_url = reverse('pybb:delete_subscription', args=[post.topic.id])
+        subject = render_to_string('pybb/mail_templates/subscription_email_subject.html',
+                                   {'site': site,
+                                    'post': post
+                                    })
+        # Email subject *must not* contain newlines
+        subject = ''.join(subject.splitlines())
+        message = render_to_string('pybb/mail_templates/subscription_email_body.html',
+                                   {'site': site,
+                                    'post': post,
+                                    'delete_url': delete_url,
+                                    })
+    return subject, message
+
+
+def _send_batch(batch, connection):
+    """
+    Send batch of notifications, connection is opened with the first batch, so replies without
+    subscribers to notify by email don't connect to mail server
+    """
+    if connection is None:
+        connection = get_connection(fail_silently=True)
+        connection.open()
+    send_mass_mail(batch, fail_silently=True, connection=connection)
+    return connection
+
+
+def send_topic_notifications(post_id):
+    """
+    Send notifications about post to subscribers of its topic. Subscribers are streamed from database,
+    notification is rendered once per language and emails are sent in batches of
+    PYBB_NOTIFICATION_BATCH_SIZE over one connection. For subscribers who prefer digests
+    notifications are stored until send_digests call.
+    """
+    from pybb.models import Post, PendingNotification
+
+    try:
+        post = Post.objects.select_related('topic', 'user').get(pk=post_id)
+    except Post.DoesNotExist:
+        return
+    site = Site.objects.get_current()
+    users = post.topic.subscribers.exclude(pk=post.user_id)
+    if defaults.PYBB_PROFILE_RELATED_NAME:
+        users = users.select_related(defaults.PYBB_PROFILE_RELATED_NAME)
+
+    notifications = {}
+    batch = []
+    pending = []
+    connection = None
+    try:
+        for user in users.iterator():
+            try:
+                email_validator.clean(user.email)
+            except:
+                #invalid email
+                continue
+            profile = util.get_pybb_profile(user)
+            if profile.notification_delivery != profile.DELIVERY_IMMEDIATE:
+                pending.append(PendingNotification(user_id=user.pk, post_id=post.pk))
+                continue
+            lang = profile.language or settings.LANGUAGE_CODE
+            if lang not in notifications:
+                notifications[lang] = render_notification(post, site, lang)
+            subject, message = notifications[lang]
+            batch.append((subject, message, settings.DEFAULT_FROM_EMAIL, [user.email]))
+            if len(batch) >= defaults.PYBB_NOTIFICATION_BATCH_SIZE:
+                connection = _send_batch(batch, connection)
+                batch = []
+        if batch:
+            connection = _send_batch(batch, connection)
+    finally:
+        if connection is not None:
+            connection.close()
+    PendingNotification.objects.bulk_create(pending, batch_size=defaults.PYBB_NOTIFICATION_BATCH_SIZE)
+
+
+def render_digest(user, notifications, site):
+    """
+    Return subject and body of digest with `notifications` for `user`
+    """
+    topics = []
+    for notification in notifications:
+        if not topics or topics[-1][0].id != notification.post.topic_id:
+            topics.append((notification.post.topic, []))
+        topics[-1][1].append(notification.post)
+    lang = util.get_pybb_profile(user).language or settings.LANGUAGE_CODE
+    with translation.override(lang):
+        context = {'site': site, 'user': user, 'topics': topics, 'posts_count': len(notifications)}
+        subject = render_to_string('pybb/mail_templates/subscription_digest_subject.html', context)
+        # Email subject *must not* contain newlines
+        subject = ''.join(subject.splitlines())
+        message = render_to_string('pybb/mail_templates/subscription_digest_body.html', context)
+    return subject, message
+
+
+def _iter_digest_batches(qs, site):
+    """
+    Yield batches of up to PYBB_NOTIFICATION_BATCH_SIZE digest messages with ids of their notifications,
+    notifications of users with invalid email are included into batches without messages
+    """
+    batch = []
+    batch_ids = []
+    for user_id, notifications in groupby(qs.iterator(), lambda notification: notification.user_id):
+        notifications = list(notifications)
+        user = notifications[0].user
+        batch_ids.extend(notification.id for notification in notifications)
+        try:
+            email_validator.clean(user.email)
+        except:
+            #invalid email
+            continue
+        subject, message = render_digest(user, notifications, site)
+        batch.append((subject, message, settings.DEFAULT_FROM_EMAIL, [user.email]))
+        if len(batch) >= defaults.PYBB_NOTIFICATION_BATCH_SIZE:
+            yield batch, batch_ids
+            batch, batch_ids = [], []
+    if batch_ids:
+        yield batch, batch_ids
+
+
+def send_digests(deliveries):
+    """
+    Send one email with all pending notifications to every user who has one of `deliveries`
+    notification delivery preference. Notifications are read in one pass ordered by user and topic,
+    digests are sent in batches of PYBB_NOTIFICATION_BATCH_SIZE over one connection. Notifications
+    are deleted when their batch is sent, if sending fails the rest are kept for the next run.
+    Return number of sent digests.
+    """
+    from pybb.models import PendingNotification
+
+    prefix = 'user__%s__' % defaults.PYBB_PROFILE_RELATED_NAME if defaults.PYBB_PROFILE_RELATED_NAME else 'user__'
+    pending = PendingNotification.objects.filter(**{prefix + 'notification_delivery__in': deliveries})
+    # Notifications which will be added while digests are sent will go to the next digest
+    last_id = pending.aggregate(Max('id'))['id__max']
+    if last_id is None:
+        return 0
+    pending = pending.filter(id__lte=last_id)
+    qs = pending.select_related('user', 'post', 'post__topic', 'post__user')\
+        .order_by('user', 'post__topic', 'post__created')
+    if defaults.PYBB_PROFILE_RELATED_NAME:
+        qs = qs.select_related('user__%s' % defaults.PYBB_PROFILE_RELATED_NAME)
+
+    site = Site.objects.get_current()
+    count = 0
+    connection = None
+    try:
+        for batch, batch_ids in _iter_digest_batches(qs, site):
+            if batch:
                 try:
-                    email_validator.clean(user.email)
-                except:
-                    #invalid email
-                    continue
-                old_lang = translation.get_language()
-                lang = util.get_pybb_profile(user).language or settings.LANGUAGE_CODE
-                translation.activate(lang)
-                delete_url = reverse('pybb:delete_subscription', args=[post.topic.id])
-                current_site = Site.objects.get_current()
-                subject = render_to_string('pybb/mail_templates/subscription_email_subject.html',
-                                           { 'site': current_site,
-                                             'post': post
-                                           })
-                # Email subject *must not* contain newlines
-                subject = ''.join(subject.splitlines())
-                message = render_to_string('pybb/mail_templates/subscription_email_body.html',
-                                           { 'site': current_site,
-                                             'post': post,
-                                             'delete_url': delete_url,
-                                             })
-                send_mail(subject, message, settings.DEFAULT_FROM_EMAIL, [user.email], fail_silently=True)
-                translation.activate(old_lang)
+                    if connection is None:
+                        # connection is opened only if there is something to send
+                        connection = get_connection()
+                        connection.open()
+                    send_mass_mail(batch, connection=connection)
+                except Exception:
+                    # notifications of failed and remaining batches are kept for the next digest
+                    logger.exception('Sending of %d digests failed', len(batch))
+                    break
+                count += len(batch)
+            PendingNotification.objects.filter(id__in=batch_ids).delete()
+    finally:
+        if connection is not None:
+            connection.close()
+    return count
@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+"""
+Work which can be deferred from request to background.
+
+Task is a dotted path to a function plus positional arguments. Arguments should be
+simple values (ids, strings), so task backend can serialize them and run task in
+another process. Backend is selected with PYBB_TASK_BACKEND setting, by default
+tasks run immediately in the current process, LocalQueueBackend runs them in
+background thread.
+
+Side effects of database writes (tasks, cache invalidation) are registered with `on_commit`: inside
+transaction they are delayed until it's committed and dropped if it's rolled back.
+"""
+
+from __future__ import unicode_literals
+import functools
+import logging
+import threading
+from contextlib import contextmanager
+
+from django.db import connections, transaction
+from django.utils.importlib import import_module
+from django.utils.six.moves import queue
+
+from pybb import defaults
+
+
+logger = logging.getLogger('pybb.tasks')
+
+
+def _resolve(path):
+    module_name, name = path.rsplit('.', 1)
+    return getattr(import_module(module_name), name)
+
+
+def run_task(path, args):
+    return _resolve(path)(*args)
+
+
+class BaseTaskBackend(object):
+    """
+    Base class for task backends. Subclasses should implement `enqueue` method, which accepts
+    dotted path to task function and tuple of its arguments and arranges `run_task(path, args)` call.
+    """
+    def enqueue(self, path, args):
+        raise NotImplementedError
+
+
+class ImmediateBackend(BaseTaskBackend):
+    """
+    Runs tasks synchronously in the current process
+    """
+    def enqueue(self, path, args):
+        run_task(path, args)
+
+
+class LocalQueueBackend(BaseTaskBackend):
+    """
+    Runs tasks one by one in background thread of the current process. Suitable for single node
+    setups, tasks which are not finished yet are lost when process exits.
+    """
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.worker = None
+
+    def enqueue(self, path, args):
+        self.queue.put((path, args))
+        with self.lock:
+            if self.worker is None or not self.worker.is_alive():
+                self.worker = threading.Thread(target=self.work, name='pybb-tasks')
+                self.worker.daemon = True
+                self.worker.start()
+
+    def work(self):
+        while True:
+            path, args = self.queue.get()
+            try:
+                run_task(path, args)
+            except Exception:
+                logger.exception('Task %s%r failed', path, args)
+            finally:
+                # Don't keep connections of this thread open between tasks
+                for connection in connections.all():
+                    connection.close()
+                self.queue.task_done()
+
+    def join(self):
+        """
+        Wait until all queued tasks will be done
+        """
+        self.queue.join()
+
+
+_hooks = threading.local()
+
+
+def _atomic_depth(connection):
+    if not connection.in_atomic_block:
+        return 0
+    # Outermost block has no savepoint id, nested blocks add one id (or None) each
+    return len(connection.savepoint_ids) + 1
+
+
+def _in_transaction(connection):
+    """
+    Check if connection is inside transaction which is not committed yet. Test cases run inside transaction,
+    which is rolled back at the end, they set `pybb_committed_depth` of connection to treat it as committed.
+    """
+    return _atomic_depth(connection) > getattr(connection, 'pybb_committed_depth', 0)
+
+
+def _get_commit_callbacks(connection):
+    """
+    Return list of callbacks waiting for commit of the current transaction of connection. Django < 1.9
+    has no commit hooks, so `commit`, `rollback` and `close` of connection are wrapped to call or drop them.
+    Callbacks registered in savepoint which is rolled back later are still called at commit.
+    """
+    callbacks = getattr(connection, 'pybb_commit_callbacks', None)
+    if callbacks is None:
+        callbacks = connection.pybb_commit_callbacks = []
+        commit, rollback, close = connection.commit, connection.rollback, connection.close
+
+        def commit_and_call():
+            commit()
+            pending = callbacks[:]
+            del callbacks[:]
+            for func, args in pending:
+                func(*args)
+
+        def rollback_and_drop():
+            del callbacks[:]
+            rollback()
+
+        def close_and_drop():
+            del callbacks[:]
+            close()
+
+        connection.commit, connection.rollback, connection.close = commit_and_call, rollback_and_drop, close_and_drop
+    return callbacks
+
+
+def _call_after_commit(using, callbacks):
+    """
+    Call callbacks right now or, if they were registered inside transaction started by outer
+    `transaction.atomic` block (or ATOMIC_REQUESTS), after this transaction is committed
+    """
+    connection = transaction.get_connection(using)
+    if not _in_transaction(connection):
+        for func, args in callbacks:
+            func(*args)
+    elif hasattr(transaction, 'on_commit'):
+        for func, args in callbacks:
+            transaction.on_commit(functools.partial(func, *args), using=using)
+    else:
+        pending = _get_commit_callbacks(connection)
+        pending.extend(callback for callback in callbacks if callback not in pending)
+
+
+@contextmanager
+def commit_hooks(using=None):
+    """
+    Collect callbacks registered with `on_commit` in this block and call them when the block exits
+    without error. Callbacks of nested blocks are called at the exit of the outermost one,
+    callbacks of a block which exits with error are dropped. If the outermost block is inside
+    transaction, callbacks are called after it's committed.
+    """
+    callbacks = getattr(_hooks, 'callbacks', None)
+    outermost = callbacks is None
+    if outermost:
+        callbacks = _hooks.callbacks = []
+    start = len(callbacks)
+    try:
+        yield
+    except Exception:
+        del callbacks[start:]
+        raise
+    finally:
+        if outermost:
+            _hooks.callbacks = None
+    if outermost:
+        _call_after_commit(using, callbacks)
+
+
+@contextmanager
+def atomic(using=None, savepoint=True):
+    """
+    Like `django.db.transaction.atomic`, but callbacks registered with `on_commit` in the block are called
+    after transaction is committed. If block is nested into transaction started with plain
+    `transaction.atomic`, callbacks are called after the outer transaction is committed.
+    """
+    with commit_hooks(using):
+        with transaction.atomic(using=using, savepoint=savepoint):
+            yield
+
+
+def on_commit(func, *args):
+    """
+    Call `func(*args)` after the current transaction is committed or right now if there is no transaction.
+    Identical calls registered in one `atomic` block are made once.
+    """
+    callbacks = getattr(_hooks, 'callbacks', None)
+    if callbacks is None:
+        _call_after_commit(None, [(func, args)])
+    elif (func, args) not in callbacks:
+        callbacks.append((func, args))
+
+
+_backend = (None, None)
+
+
+def get_backend():
+    global _backend
+    name = defaults.PYBB_TASK_BACKEND
+    if _backend[0] != name:
+        _backend = (name, _resolve(name)())
+    return _backend[1]
+
+
+def is_immediate():
+    """
+    Check if tasks run right in the current request, so deferring work to them saves nothing
+    """
+    return isinstance(get_backend(), ImmediateBackend)
+
+
+def check_render_backend():
+    """
+    Warn if render limits are configured, but there is no task queue to render deferred posts
+    """
+    limits = (defaults.PYBB_RENDER_MAX_LENGTH, defaults.PYBB_RENDER_MAX_DEPTH, defaults.PYBB_RENDER_TIME_BUDGET)
+    if any(limits) and issubclass(_resolve(defaults.PYBB_TASK_BACKEND), ImmediateBackend):
+        logger.warning('Render limits are set, but PYBB_TASK_BACKEND runs tasks immediately: posts which '
+                       'exceed them keep placeholder until pybb_rerender command is run')
+
+
+def _enqueue(path, args):
+    get_backend().enqueue(path, args)
+
+
+def enqueue(path, *args):
+    """
+    Queue task `path` with `args`, inside `atomic` block task is queued after commit,
+    so it always sees data written in the block
+    """
+    on_commit(_enqueue, path, args)
+
+
+def render_post(post_id):
+    """
+    Render post which was saved with placeholder, because it exceeded render limits
+    """
+    from pybb import caching, markup
+    from pybb.models import Post
+
+    try:
+        post = Post.objects.get(pk=post_id)
+    except Post.DoesNotExist:
+        return
+    # If rendering which didn't fit into time budget is still running in this process, reuse its result
+    markup.wait_pending_render(post.body)
+    post.render()
+    # Body could be changed while post was waiting for rendering, its html will be rendered by next task
+    if Post.objects.filter(pk=post.pk, body=post.body).update(body_html=post.body_html, body_text=post.body_text):
+        caching.invalidate([caching.topic_version(post.topic_id)])
+        if defaults.PYBB_SEARCH_BACKEND:
+            # body_text is written with queryset update, no post_save signal is sent
+            enqueue('pybb.search.index_post', post.pk)
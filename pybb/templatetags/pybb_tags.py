@@ -7,7 +7,6 @@ import time
 import warnings
 
 from django import template
-from django.core.cache import cache
 from django.template.base import get_library, InvalidTemplateLibrary, TemplateSyntaxError, TOKEN_BLOCK
 from django.template.defaulttags import LoadNode, CommentNode, IfNode
 from django.template.smartif import Literal
@@ -18,7 +17,6 @@ from django.utils.translation import ugettext as _
 from django.utils import dateformat
 from django.utils.timezone import timedelta
 from django.utils.timezone import now as tznow
-from pybb.util import build_cache_key
 
 try:
     import pytils
@@ -26,9 +24,9 @@ try:
 except ImportError:
     pytils_enabled = False
 
-from pybb.models import TopicReadTracker, ForumReadTracker, PollAnswerUser, Topic, Post
+from pybb.models import TopicReadTracker, ForumReadTracker, Topic, Post
 from pybb.permissions import perms
-from pybb import defaults, util
+from pybb import counters, defaults, util
 
 
 register = template.Library()
@@ -182,9 +180,9 @@ def pybb_topic_unread(topics, user):
 @register.filter
 def pybb_forum_unread(forums, user):
     """
-    Check if forum has unread messages.
+    Check if forum has unread messages. Buffered counters of forums are applied too.
     """
-    forum_list = list(forums)
+    forum_list = counters.with_pending(forums)
     if user.is_authenticated():
         for forum in forum_list:
             forum.unread = forum.topic_count > 0
@@ -211,7 +209,7 @@ def pybb_topic_inline_pagination(topic):
 
 @register.filter
 def pybb_topic_poll_not_voted(topic, user):
-    return not PollAnswerUser.objects.filter(poll_answer__topic=topic, user=user).exists()
+    return not topic.is_poll_voted(user)
 
 
 @register.filter
@@ -356,7 +354,21 @@ def if_has_tag(parser, token):
         return IfNode(Literal(has_tag), nodelist_true, nodelist_false)
 
 
+@register.filter
+def pybbm_prefetch_topic_views(topics):
+    """
+    Fetch views of `topics` which are not saved to database yet with one cache request
+    """
+    topic_list = list(topics)
+    pending = counters.get_pending_views([topic.id for topic in topic_list])
+    for topic in topic_list:
+        topic.pending_views = pending[topic.id]
+    return topic_list
+
+
 @register.filter
 def pybbm_calc_topic_views(topic):
-    cache_key = build_cache_key('anonymous_topic_views', topic_id=topic.id)
-    return topic.views + cache.get(cache_key, 0)
\ No newline at end of file
+    pending = getattr(topic, 'pending_views', None)
+    if pending is None:
+        pending = counters.get_pending_views([topic.id])[topic.id]
+    return topic.views + pending
\ No newline at end of file
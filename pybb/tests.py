@@ -1,23 +1,32 @@
 # -*- coding: utf-8 -*-
 
 from __future__ import unicode_literals
+import re
+import threading
 import time
 import datetime
 import os
+import shutil
+import tempfile
 
-from django.contrib.auth.models import Permission
+from django.contrib.auth.models import AnonymousUser, Permission
 from django.conf import settings
 from django.core import mail
 from django.core.cache import cache
+from django.core.management import call_command
 from django.core.urlresolvers import reverse
 from django.core.exceptions import ValidationError
+from django.db import connection, transaction
 from django.db.models import Q
-from django.test import TestCase
+from django.test import TestCase as DjangoTestCase, TransactionTestCase
 from django.test.client import Client
-from django.test.utils import override_settings
-from pybb import permissions, views as pybb_views
+from django.test.utils import override_settings, CaptureQueriesContext
+from django.utils.six import StringIO
+from django.utils.timezone import now as tznow
+from pybb import caching, counters, fields, markup, moderation, permissions, search, subscription, tasks, \
+    views as pybb_views
 from pybb.templatetags.pybb_tags import pybb_is_topic_unread, pybb_topic_unread, pybb_forum_unread, \
-    pybb_get_latest_topics, pybb_get_latest_posts
+    pybb_get_latest_topics, pybb_get_latest_posts, pybbm_calc_topic_views, pybbm_prefetch_topic_views
 
 from pybb import util
 from pybb.util import build_cache_key
@@ -31,11 +40,26 @@ except ImportError:
     raise Exception('PyBB requires lxml for self testing')
 
 from pybb import defaults
-from pybb.models import Topic, TopicReadTracker, Forum, ForumReadTracker, Post, Category, PollAnswer, Profile
+from pybb.models import Topic, TopicReadTracker, Forum, ForumReadTracker, Post, Category, PollAnswer, Profile, \
+    PendingNotification, ForumCounterDelta, PollAnswerUser, SearchTerm
 
 __author__ = 'zeus'
 
 
+class TestCase(DjangoTestCase):
+    """
+    Transaction of test is rolled back at the end, but it's treated as committed, so callbacks registered with
+    `pybb.tasks.on_commit` are called at the exit of `atomic` blocks started by test
+    """
+    def _fixture_setup(self):
+        super(TestCase, self)._fixture_setup()
+        connection.pybb_committed_depth = tasks._atomic_depth(connection)
+
+    def _fixture_teardown(self):
+        connection.pybb_committed_depth = 0
+        super(TestCase, self)._fixture_teardown()
+
+
 class SharedTestModule(object):
     def create_user(self):
         self.user = User.objects.create_user('zeus', 'zeus@localhost', 'zeus')
@@ -918,6 +942,27 @@ class FeaturesTest(TestCase, SharedTestModule):
         self.assertEqual(response.status_code, 200)
         self.assertTrue(user not in list(self.topic.subscribers.all()))
 
+    def test_topic_subscribers(self):
+        for i in range(3):
+            self.topic.subscribers.add(User.objects.create_user('subscriber%d' % i, 'subscriber%d@localhost' % i))
+        url = reverse('pybb:topic_subscribers', args=[self.topic.id])
+        self.login_client()
+        response = self.client.get(self.topic.get_absolute_url())
+        self.assertNotIn('subscriber_count', response.context)
+        self.assertEqual(self.client.get(url).status_code, 403)
+
+        self.user.is_staff = True
+        self.user.save()
+        response = self.client.get(self.topic.get_absolute_url())
+        # author is subscribed to own topic
+        self.assertTrue(response.context['user'].is_subscribed)
+        self.assertEqual(response.context['subscriber_count'], 4)
+        self.assertContains(response, url)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([user.username for user in response.context['subscriber_list']],
+                         ['subscriber0', 'subscriber1', 'subscriber2', 'zeus'])
+
     def test_topic_updated(self):
         topic = Topic(name='etopic', forum=self.forum, user=self.user)
         topic.save()
@@ -992,6 +1037,30 @@ class FeaturesTest(TestCase, SharedTestModule):
         post.delete()
         self.assertEqual(Profile.objects.get(pk=util.get_pybb_profile(self.user).pk).post_count, 1)
 
+    def test_save_tracks_loaded_relations(self):
+        topic = Topic.objects.get(pk=self.topic.pk)
+        topic.sticky = True
+        with self.assertNumQueries(1):
+            topic.save()
+
+        forum2 = Forum.objects.create(name='forum2', category=self.category)
+        topic2 = Topic.objects.create(name='topic2', forum=forum2, user=self.user)
+        Post.objects.create(topic=topic2, user=self.user, body='head')
+        post = Post.objects.create(topic=self.topic, user=self.user, body='reply')
+        post = Post.objects.get(pk=post.pk)
+        post.topic = topic2
+        post.save()
+        self.assertEqual(Topic.objects.get(pk=self.topic.pk).post_count, 1)
+        self.assertEqual(Topic.objects.get(pk=topic2.pk).post_count, 2)
+        self.assertEqual(Forum.objects.get(pk=self.forum.pk).post_count, 1)
+        self.assertEqual(Forum.objects.get(pk=forum2.pk).post_count, 2)
+
+        topic = Topic.objects.only('id', 'name').get(pk=topic2.pk)
+        topic.forum = self.forum
+        topic.save()
+        self.assertEqual(Forum.objects.get(pk=self.forum.pk).topic_count, 2)
+        self.assertEqual(Forum.objects.get(pk=forum2.pk).topic_count, 0)
+
     def test_latest_topics_tag(self):
         Topic.objects.all().delete()
         for i in range(10):
@@ -1083,6 +1152,1317 @@ class AnonymousTest(TestCase, SharedTestModule):
         self.assertEqual(cache.get(build_cache_key('anonymous_topic_views', topic_id=self.topic.id)), 0)
 
 
+class AnonymousPageCacheTest(TestCase, SharedTestModule):
+    def setUp(self):
+        self.ORIG_PYBB_ANONYMOUS_PAGE_CACHE_TIMEOUT = defaults.PYBB_ANONYMOUS_PAGE_CACHE_TIMEOUT
+        self.ORIG_PYBB_ENABLE_ANONYMOUS_POST = defaults.PYBB_ENABLE_ANONYMOUS_POST
+        defaults.PYBB_ANONYMOUS_PAGE_CACHE_TIMEOUT = 60
+        defaults.PYBB_ENABLE_ANONYMOUS_POST = False
+        cache.clear()
+        self.create_user()
+        self.create_initial()
+
+    def tearDown(self):
+        defaults.PYBB_ANONYMOUS_PAGE_CACHE_TIMEOUT = self.ORIG_PYBB_ANONYMOUS_PAGE_CACHE_TIMEOUT
+        defaults.PYBB_ENABLE_ANONYMOUS_POST = self.ORIG_PYBB_ENABLE_ANONYMOUS_POST
+        cache.clear()
+
+    def test_topic_page_cached(self):
+        url = self.topic.get_absolute_url()
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        with self.assertNumQueries(1):
+            # only topic itself is fetched
+            cached = self.client.get(url)
+        self.assertEqual(cached.content, response.content)
+        # anonymous views are counted for cached pages too
+        self.assertEqual(cache.get(build_cache_key('anonymous_topic_views', topic_id=self.topic.id)), 2)
+
+        Post.objects.create(topic=self.topic, user=self.user, body='new cached post')
+        self.assertContains(self.client.get(url), 'new cached post')
+
+    def test_forum_and_index_invalidation(self):
+        # forum is fetched to check permissions before cached page is returned
+        for url, queries in ((reverse('pybb:index'), 0), (self.forum.get_absolute_url(), 1),
+                             (reverse('pybb:topic_latest'), 0)):
+            self.client.get(url)
+            with self.assertNumQueries(queries):
+                self.client.get(url)
+        Topic.objects.create(name='another cached topic', forum=self.forum, user=self.user)
+        self.assertContains(self.client.get(self.forum.get_absolute_url()), 'another cached topic')
+        self.assertContains(self.client.get(reverse('pybb:topic_latest')), 'another cached topic')
+
+        self.forum.name = 'renamed forum'
+        self.forum.save()
+        self.assertContains(self.client.get(reverse('pybb:index')), 'renamed forum')
+        self.assertContains(self.client.get(self.topic.get_absolute_url()), 'renamed forum')
+
+    def test_authenticated_not_cached(self):
+        url = self.topic.get_absolute_url()
+        self.login_client()
+        self.client.get(url)
+        self.client.get(url)
+        self.assertEqual(Topic.objects.get(id=self.topic.id).views, 2)
+        self.assertIn('form', self.client.get(url).context)
+
+
+class ConditionalGetTest(TestCase, SharedTestModule):
+    def setUp(self):
+        self.ORIG_PYBB_CONDITIONAL_GET = defaults.PYBB_CONDITIONAL_GET
+        defaults.PYBB_CONDITIONAL_GET = True
+        cache.clear()
+        self.create_user()
+        self.create_initial()
+
+    def tearDown(self):
+        defaults.PYBB_CONDITIONAL_GET = self.ORIG_PYBB_CONDITIONAL_GET
+        cache.clear()
+
+    def test_topic_not_modified(self):
+        url = self.topic.get_absolute_url()
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.has_header('Last-Modified'))
+        etag = response['ETag']
+        with self.assertNumQueries(1):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(cache.get(build_cache_key('anonymous_topic_views', topic_id=self.topic.id)), 2)
+        # another page has another validator
+        response = self.client.get(url + '?page=1', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+        self.topic.closed = True
+        self.topic.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_forum_not_modified(self):
+        url = self.forum.get_absolute_url()
+        response = self.client.get(url)
+        last_modified = response['Last-Modified']
+        response = self.client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 304)
+        etag = self.client.get(url)['ETag']
+        Post.objects.create(topic=self.topic, user=self.user, body='new post')
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+    def test_hidden_pages_not_modified(self):
+        self.category.hidden = True
+        self.category.save()
+        # validators of hidden page are not checked
+        for url in (self.topic.get_absolute_url(), self.forum.get_absolute_url(), self.category.get_absolute_url()):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH='*')
+            self.assertEqual(response.status_code, 302)
+
+    def test_authenticated_pages_not_conditional(self):
+        self.login_client()
+        response = self.client.get(self.topic.get_absolute_url())
+        self.assertFalse(response.has_header('ETag'))
+
+    def test_feeds_not_modified(self):
+        url = reverse('pybb:feed_posts')
+        etag = self.client.get(url)['ETag']
+        with self.assertNumQueries(1):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        # authenticated user may see other set of posts
+        self.login_client()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.client.logout()
+        Post.objects.create(topic=self.topic, user=self.user, body='new post')
+        response = self.client.get(reverse('pybb:feed_posts'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'new post')
+
+    def test_feeds_with_buffered_counters(self):
+        ORIG_PYBB_BUFFER_FORUM_COUNTERS = defaults.PYBB_BUFFER_FORUM_COUNTERS
+        defaults.PYBB_BUFFER_FORUM_COUNTERS = True
+        try:
+            Forum.objects.update(updated=tznow() - datetime.timedelta(hours=1))
+            url = reverse('pybb:feed_posts')
+            last_modified = self.client.get(url)['Last-Modified']
+            post = Post.objects.create(topic=self.topic, user=self.user, body='new post')
+            self.assertTrue(ForumCounterDelta.objects.exists())
+            self.assertLess(Forum.objects.get(pk=self.forum.pk).updated, post.created)
+            response = self.client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified)
+            self.assertEqual(response.status_code, 200)
+            self.assertContains(response, 'new post')
+        finally:
+            defaults.PYBB_BUFFER_FORUM_COUNTERS = ORIG_PYBB_BUFFER_FORUM_COUNTERS
+
+
+class SurrogateKeysTest(TestCase, SharedTestModule):
+    def setUp(self):
+        self.ORIG_PYBB_SURROGATE_KEY_HEADER = defaults.PYBB_SURROGATE_KEY_HEADER
+        self.ORIG_PYBB_PURGE_BACKEND = defaults.PYBB_PURGE_BACKEND
+        defaults.PYBB_SURROGATE_KEY_HEADER = 'Surrogate-Key'
+        defaults.PYBB_PURGE_BACKEND = 'pybb.caching.LocalPurgeBackend'
+        self.create_user()
+        self.create_initial()
+
+    def tearDown(self):
+        defaults.PYBB_SURROGATE_KEY_HEADER = self.ORIG_PYBB_SURROGATE_KEY_HEADER
+        defaults.PYBB_PURGE_BACKEND = self.ORIG_PYBB_PURGE_BACKEND
+
+    def test_surrogate_keys_headers(self):
+        response = self.client.get(self.topic.get_absolute_url())
+        self.assertEqual(response['Surrogate-Key'], 'pybb-structure pybb-topic-%s' % self.topic.id)
+        response = self.client.get(self.forum.get_absolute_url())
+        self.assertEqual(response['Surrogate-Key'], 'pybb-forum-%s pybb-structure' % self.forum.id)
+        response = self.client.get(self.category.get_absolute_url())
+        self.assertEqual(response['Surrogate-Key'], 'pybb-category-%s pybb-structure' % self.category.id)
+        response = self.client.get(reverse('pybb:index'))
+        self.assertEqual(response['Surrogate-Key'], 'pybb-index pybb-structure')
+        response = self.client.get(reverse('pybb:feed_topics'))
+        self.assertEqual(response['Surrogate-Key'], 'pybb-index pybb-structure')
+
+        # private responses are not marked
+        self.login_client()
+        response = self.client.get(self.topic.get_absolute_url())
+        self.assertFalse(response.has_header('Surrogate-Key'))
+
+    def test_purge_on_write(self):
+        backend = caching.get_purge_backend()
+        backend.purged = []
+        Post.objects.create(topic=self.topic, user=self.user, body='purge me')
+        for key in ('pybb-topic-%s' % self.topic.id, 'pybb-forum-%s' % self.forum.id,
+                    'pybb-category-%s' % self.category.id, 'pybb-index'):
+            self.assertIn(key, backend.purged)
+        self.assertNotIn('pybb-structure', backend.purged)
+
+        backend.purged = []
+        self.forum.name = 'renamed'
+        self.forum.save()
+        self.assertIn('pybb-structure', backend.purged)
+
+
+class RenderCacheTest(TestCase, SharedTestModule):
+    def setUp(self):
+        self.ORIG_PYBB_MARKUP_ENGINES = defaults.PYBB_MARKUP_ENGINES
+        self.rendered = []
+        engine = defaults.PYBB_MARKUP_ENGINES[defaults.PYBB_MARKUP]
+
+        def counting_engine(text):
+            self.rendered.append(text)
+            return engine(text)
+        defaults.PYBB_MARKUP_ENGINES = dict(defaults.PYBB_MARKUP_ENGINES)
+        defaults.PYBB_MARKUP_ENGINES[defaults.PYBB_MARKUP] = counting_engine
+        markup.local_cache.clear()
+        self.create_user()
+        self.create_initial()
+        del self.rendered[:]
+
+    def tearDown(self):
+        defaults.PYBB_MARKUP_ENGINES = self.ORIG_PYBB_MARKUP_ENGINES
+        markup.local_cache.clear()
+
+    def test_render_cached(self):
+        self.assertEqual(markup.render('[b]cached[/b]'), '<strong>cached</strong>')
+        self.assertEqual(markup.render('[b]cached[/b]'), '<strong>cached</strong>')
+        self.assertEqual(self.rendered, ['[b]cached[/b]'])
+
+        self.login_client()
+        for _ in range(2):
+            response = self.client.post(reverse('pybb:post_ajax_preview'), data={'data': '[i]preview[/i]'})
+            self.assertContains(response, '<em>preview</em>')
+        self.assertEqual(self.rendered.count('[i]preview[/i]'), 1)
+
+    def test_render_cache_depends_on_smiles(self):
+        ORIG_PYBB_SMILES = defaults.PYBB_SMILES
+        try:
+            markup.render('smile :)')
+            defaults.PYBB_SMILES = {':)': 'other.png'}
+            self.assertNotEqual(markup.get_render_cache_key('smile :)'),
+                                markup.get_render_cache_key('smile :)', markup='markdown'))
+            markup.render('smile :)')
+        finally:
+            defaults.PYBB_SMILES = ORIG_PYBB_SMILES
+        self.assertEqual(self.rendered, ['smile :)', 'smile :)'])
+
+    def test_smile_it_single_pass(self):
+        ORIG_PYBB_SMILES = defaults.PYBB_SMILES
+        try:
+            defaults.PYBB_SMILES = dict((':smile%d:' % i, 'smile%d.png' % i) for i in range(500))
+            defaults.PYBB_SMILES.update({':)': 'smile.png', ':))': 'lol.png', '8)': 'glasses.png'})
+            img = '<img src="%s%s%%s" alt="smile" />' % (settings.STATIC_URL, defaults.PYBB_SMILES_PREFIX)
+            self.assertEqual(defaults.smile_it('a :) b :)) c :smile42: :smile4 8)'),
+                             'a %s b %s c %s :smile4 %s' % (img % 'smile.png', img % 'lol.png',
+                                                            img % 'smile42.png', img % 'glasses.png'))
+            body = 'text :smile499: ' * 10000
+            self.assertEqual(defaults.smile_it(body), ('text %s ' % (img % 'smile499.png')) * 10000)
+        finally:
+            defaults.PYBB_SMILES = ORIG_PYBB_SMILES
+
+    def test_markdown_engine(self):
+        engine = defaults.MarkdownEngine(safe_mode='escape')
+        img = '<img src="%s%s%%s" alt="smile" />' % (settings.STATIC_URL, defaults.PYBB_SMILES_PREFIX)
+        self.assertEqual(engine('**bold** :) http://example.com/ <b>'),
+                         '<p><strong>bold</strong> %s <a href="http://example.com/">http://example.com/</a> '
+                         '&lt;b&gt;</p>' % (img % 'smile.png'))
+        # emoticons are not replaced inside links
+        self.assertEqual(engine('8) http://example.com/8)/ text'),
+                         '<p>%s <a href="http://example.com/8)/">http://example.com/8)/</a> text</p>'
+                         % (img % 'glasses.png'))
+        parser = engine.get_parser()
+        self.assertEqual(engine('[link][ref]\n\n[ref]: http://example.com/'),
+                         '<p><a href="http://example.com/">link</a></p>')
+        # references from previous text are reset
+        self.assertEqual(engine('[link][ref]'), '<p>[link][ref]</p>')
+        self.assertIs(engine.get_parser(), parser)
+
+        parsers = []
+        thread = threading.Thread(target=lambda: parsers.append(engine.get_parser()))
+        thread.start()
+        thread.join()
+        self.assertIsNot(parsers[0], parser)
+
+    def test_not_rendered_if_body_not_changed(self):
+        markup.local_cache.clear()
+        post = Post.objects.get(id=self.post.id)
+        post.on_moderation = True
+        post.save()
+        self.assertEqual(self.rendered, [])
+        post.body = 'changed [b]body[/b]'
+        post.save()
+        self.assertEqual(self.rendered, ['changed [b]body[/b]'])
+        self.assertEqual(Post.objects.get(id=self.post.id).body_html, 'changed <strong>body</strong>')
+
+        profile = util.get_pybb_profile(self.user)
+        profile.save()
+        self.assertEqual(len(self.rendered), 1)
+        profile.signature = 'new [b]signature[/b]'
+        profile.save()
+        self.assertEqual(util.get_pybb_profile(User.objects.get(id=self.user.id)).signature_html,
+                         'new <strong>signature</strong>')
+
+
+class RerenderCommandTest(TestCase, SharedTestModule):
+    def setUp(self):
+        self.ORIG_PYBB_SMILES = defaults.PYBB_SMILES
+        self.create_user()
+        self.create_initial()
+        self.posts = [Post.objects.create(topic=self.topic, user=self.user, body='post %d :)' % i)
+                      for i in range(5)]
+        profile = util.get_pybb_profile(self.user)
+        profile.signature = 'signature :)'
+        profile.save()
+        markup.local_cache.clear()
+
+    def tearDown(self):
+        defaults.PYBB_SMILES = self.ORIG_PYBB_SMILES
+        markup.local_cache.clear()
+
+    def test_rerender(self):
+        defaults.PYBB_SMILES = {':)': 'new_smile.png'}
+        topic_updated = Topic.objects.get(id=self.topic.id).updated
+        call_command('pybb_rerender', dry_run=True, chunk_size=2, stdout=StringIO())
+        self.assertNotIn('new_smile.png', Post.objects.get(id=self.posts[0].id).body_html)
+
+        out = StringIO()
+        call_command('pybb_rerender', posts_only=True, from_id=self.posts[1].id, to_id=self.posts[3].id,
+                     chunk_size=2, stdout=out)
+        self.assertIn('Total posts: 3 rendered, 3 changed', out.getvalue())
+        self.assertNotIn('signatures', out.getvalue())
+        self.assertEqual([p.id for p in Post.objects.filter(body_html__contains='new_smile.png')],
+                         [p.id for p in self.posts[1:4]])
+        self.assertEqual(Topic.objects.get(id=self.topic.id).updated, topic_updated)
+
+        out = StringIO()
+        call_command('pybb_rerender', stdout=out)
+        self.assertIn('Total posts: 6 rendered, 2 changed', out.getvalue())
+        self.assertIn('Total signatures: 1 rendered, 1 changed', out.getvalue())
+        self.assertIn('new_smile.png', util.get_pybb_profile(User.objects.get(id=self.user.id)).signature_html)
+
+    def test_rerender_resume(self):
+        defaults.PYBB_SMILES = {':)': 'new_smile.png'}
+        state_file = os.path.join(tempfile.mkdtemp(), 'state.json')
+        try:
+            call_command('pybb_rerender', posts_only=True, to_id=self.posts[1].id, state_file=state_file,
+                         stdout=StringIO())
+            out = StringIO()
+            call_command('pybb_rerender', posts_only=True, state_file=state_file, stdout=out)
+            self.assertIn('Total posts: 3 rendered, 3 changed', out.getvalue())
+        finally:
+            shutil.rmtree(os.path.dirname(state_file))
+        self.assertFalse(Post.objects.exclude(body_html__contains='new_smile.png').filter(body__contains=':)').exists())
+
+
+class CompressedBodyTest(TestCase, SharedTestModule):
+    def setUp(self):
+        self.ORIG_PYBB_COMPRESS_RENDERED_BODY = defaults.PYBB_COMPRESS_RENDERED_BODY
+        self.create_user()
+        self.create_initial()
+        self.body = '\n'.join('[b]line %d[/b] of long post' % i for i in range(100))
+
+    def tearDown(self):
+        defaults.PYBB_COMPRESS_RENDERED_BODY = self.ORIG_PYBB_COMPRESS_RENDERED_BODY
+
+    def get_stored(self, post):
+        return Post.objects.filter(id=post.id).values_list('body_html', 'body_text')[0]
+
+    def test_compressed_storage(self):
+        defaults.PYBB_COMPRESS_RENDERED_BODY = True
+        post = Post.objects.create(topic=self.topic, user=self.user, body=self.body)
+        body_html, body_text = self.get_stored(post)
+        self.assertTrue(body_html.startswith(fields.COMPRESSED_PREFIX))
+        self.assertTrue(body_text.startswith(fields.COMPRESSED_PREFIX))
+        self.assertLess(len(body_html), len(post.body_html))
+
+        post = Post.objects.get(id=post.id)
+        self.assertIn('<strong>line 99</strong>', post.body_html)
+        self.assertIn('line 99 of long post', post.body_text)
+        self.assertContains(self.client.get(post.get_absolute_url(), follow=True), '<strong>line 99</strong>')
+
+        # short values are not compressed, values which look like compressed are always compressed
+        self.assertEqual(fields.compress('short'), 'short')
+        for value in ('short', fields.COMPRESSED_PREFIX, fields.COMPRESSED_PREFIX + 'text', self.body):
+            self.assertEqual(fields.decompress(fields.compress(value)), value)
+
+        defaults.PYBB_COMPRESS_RENDERED_BODY = False
+        self.assertIn('<strong>line 99</strong>', Post.objects.get(id=post.id).body_html)
+
+    def test_compress_bodies_command(self):
+        post = Post.objects.create(topic=self.topic, user=self.user, body=self.body)
+        defaults.PYBB_COMPRESS_RENDERED_BODY = True
+        out = StringIO()
+        call_command('pybb_compress_bodies', dry_run=True, stdout=out)
+        self.assertIn('Would convert 1 of 2 posts to compressed format', out.getvalue())
+        self.assertFalse(self.get_stored(post)[0].startswith(fields.COMPRESSED_PREFIX))
+
+        out = StringIO()
+        call_command('pybb_compress_bodies', chunk_size=1, stdout=out)
+        self.assertIn('Converted 1 of 2 posts to compressed format', out.getvalue())
+        self.assertTrue(self.get_stored(post)[0].startswith(fields.COMPRESSED_PREFIX))
+        self.assertEqual(Post.objects.get(id=post.id).body_html, post.body_html)
+
+        defaults.PYBB_COMPRESS_RENDERED_BODY = False
+        call_command('pybb_compress_bodies', stdout=StringIO())
+        self.assertEqual(self.get_stored(post), (post.body_html, post.body_text))
+
+
+class RecordingTaskBackend(tasks.BaseTaskBackend):
+    def __init__(self):
+        self.tasks = []
+
+    def enqueue(self, path, args):
+        self.tasks.append((path, args))
+
+    def get_tasks(self, path):
+        return [args for task_path, args in self.tasks if task_path == path]
+
+    def run(self):
+        while self.tasks:
+            tasks.run_task(*self.tasks.pop(0))
+
+
+class RenderLimitsTest(TestCase, SharedTestModule):
+    def setUp(self):
+        self.ORIG_PYBB_RENDER_MAX_LENGTH = defaults.PYBB_RENDER_MAX_LENGTH
+        self.ORIG_PYBB_RENDER_MAX_DEPTH = defaults.PYBB_RENDER_MAX_DEPTH
+        self.ORIG_PYBB_RENDER_TIME_BUDGET = defaults.PYBB_RENDER_TIME_BUDGET
+        self.ORIG_PYBB_RENDER_MAX_THREADS = defaults.PYBB_RENDER_MAX_THREADS
+        self.ORIG_PYBB_TASK_BACKEND = defaults.PYBB_TASK_BACKEND
+        self.ORIG_PYBB_MARKUP_ENGINES = defaults.PYBB_MARKUP_ENGINES
+        defaults.PYBB_TASK_BACKEND = 'pybb.tests.RecordingTaskBackend'
+        self.backend = tasks.get_backend()
+        self.backend.tasks = []
+        markup.local_cache.clear()
+        self.create_user()
+        self.create_initial()
+
+    def tearDown(self):
+        defaults.PYBB_RENDER_MAX_LENGTH = self.ORIG_PYBB_RENDER_MAX_LENGTH
+        defaults.PYBB_RENDER_MAX_DEPTH = self.ORIG_PYBB_RENDER_MAX_DEPTH
+        defaults.PYBB_RENDER_TIME_BUDGET = self.ORIG_PYBB_RENDER_TIME_BUDGET
+        defaults.PYBB_RENDER_MAX_THREADS = self.ORIG_PYBB_RENDER_MAX_THREADS
+        defaults.PYBB_TASK_BACKEND = self.ORIG_PYBB_TASK_BACKEND
+        defaults.PYBB_MARKUP_ENGINES = self.ORIG_PYBB_MARKUP_ENGINES
+        markup.local_cache.clear()
+
+    def test_max_length(self):
+        defaults.PYBB_RENDER_MAX_LENGTH = 100
+        post = Post.objects.create(topic=self.topic, user=self.user, body='[b]long[/b] <post>' * 10)
+        self.assertTrue(post.body_html.startswith('<div class="pybb-render-pending">'))
+        self.assertIn('[b]long[/b] &lt;post&gt;', post.body_html)
+        self.assertEqual(self.backend.get_tasks('pybb.tasks.render_post'), [(post.id,)])
+        self.assertEqual(markup.get_render_stats()['deferred'] > 0, True)
+
+        self.backend.run()
+        post = Post.objects.get(id=post.id)
+        self.assertEqual(post.body_html, '<strong>long</strong> &lt;post&gt;' * 10)
+        self.assertEqual(post.body_text, 'long <post>' * 10)
+
+        self.login_client()
+        response = self.client.post(reverse('pybb:post_ajax_preview'), data={'data': '[b]long[/b]' * 10})
+        self.assertContains(response, 'pybb-render-pending')
+        self.assertNotContains(response, '<strong>')
+
+        # immediate backend would render post within the same request, placeholder is kept instead
+        defaults.PYBB_TASK_BACKEND = 'pybb.tasks.ImmediateBackend'
+        post = Post.objects.create(topic=self.topic, user=self.user, body='[b]other[/b]' * 10)
+        self.assertIn('pybb-render-pending', Post.objects.get(id=post.id).body_html)
+
+    def test_max_depth(self):
+        defaults.PYBB_RENDER_MAX_DEPTH = 3
+        self.assertEqual(markup.get_bbcode_depth('[quote][quote]a[/quote][/quote][list][*]a[*]b[/list]'), 2)
+        self.assertEqual(markup.get_markdown_depth('text\n> > > quote\n>>\n'), 3)
+        self.assertFalse(markup.exceeds_limits('[quote]' * 3 + 'a' + '[/quote]' * 3))
+        self.assertTrue(markup.exceeds_limits('[quote]' * 4 + 'a' + '[/quote]' * 4))
+        self.assertTrue(markup.exceeds_limits('>>>> a', markup='markdown'))
+
+        post = Post.objects.create(topic=self.topic, user=self.user, body='[quote]' * 10 + 'a' + '[/quote]' * 10)
+        self.assertIn('pybb-render-pending', post.body_html)
+        self.assertEqual(self.backend.get_tasks('pybb.tasks.render_post'), [(post.id,)])
+
+    def test_time_budget(self):
+        engine = defaults.PYBB_MARKUP_ENGINES[defaults.PYBB_MARKUP]
+
+        def slow_engine(text):
+            if 'slow' in text:
+                time.sleep(0.3)
+            return engine(text)
+        defaults.PYBB_MARKUP_ENGINES = dict(defaults.PYBB_MARKUP_ENGINES)
+        defaults.PYBB_MARKUP_ENGINES[defaults.PYBB_MARKUP] = slow_engine
+        defaults.PYBB_RENDER_TIME_BUDGET = 0.05
+        markup.stats.reset()
+
+        self.assertEqual(markup.render_within_limits('[b]fast[/b]'), '<strong>fast</strong>')
+        self.assertIsNone(markup.render_within_limits('[b]slow[/b]'))
+        # the same text is not rendered again while background rendering is running
+        self.assertIsNone(markup.render_within_limits('[b]slow[/b]'))
+        self.assertTrue(markup.wait_pending_render('[b]slow[/b]', timeout=1))
+        # rendering was finished in background
+        self.assertEqual(markup.render_within_limits('[b]slow[/b]'), '<strong>slow</strong>')
+        render_stats = markup.get_render_stats()
+        self.assertEqual(render_stats['count'], 2)
+        self.assertEqual(render_stats['over_budget'], 1)
+        self.assertEqual(render_stats['deferred'], 2)
+        self.assertGreater(render_stats['max_time'], 0.3)
+
+    def test_background_renders_limit(self):
+        engine = defaults.PYBB_MARKUP_ENGINES[defaults.PYBB_MARKUP]
+        rendered = []
+
+        def slow_engine(text):
+            rendered.append(text)
+            time.sleep(0.2)
+            return engine(text)
+        defaults.PYBB_MARKUP_ENGINES = dict(defaults.PYBB_MARKUP_ENGINES)
+        defaults.PYBB_MARKUP_ENGINES[defaults.PYBB_MARKUP] = slow_engine
+        defaults.PYBB_RENDER_TIME_BUDGET = 0.05
+        defaults.PYBB_RENDER_MAX_THREADS = 1
+
+        self.assertIsNone(markup.render_within_limits('[b]slow1[/b]'))
+        # all background threads are busy, second text is not rendered
+        self.assertIsNone(markup.render_within_limits('[b]slow2[/b]'))
+        self.assertTrue(markup.wait_pending_render('[b]slow1[/b]', timeout=1))
+        self.assertEqual(rendered, ['[b]slow1[/b]'])
+        self.assertIsNone(markup.render_within_limits('[b]slow2[/b]'))
+        self.assertTrue(markup.wait_pending_render('[b]slow2[/b]', timeout=1))
+        self.assertEqual(markup.render_within_limits('[b]slow2[/b]'), '<strong>slow2</strong>')
+
+
+recorded_tasks = []
+
+
+def record_task(value):
+    recorded_tasks.append((value, threading.current_thread().name))
+
+
+class NotificationsTest(TestCase, SharedTestModule):
+    def setUp(self):
+        self.ORIG_PYBB_NOTIFICATION_BATCH_SIZE = defaults.PYBB_NOTIFICATION_BATCH_SIZE
+        self.ORIG_PYBB_TASK_BACKEND = defaults.PYBB_TASK_BACKEND
+        self.ORIG_render_notification = subscription.render_notification
+        self.create_user()
+        self.create_initial()
+        mail.outbox = []
+
+    def tearDown(self):
+        defaults.PYBB_NOTIFICATION_BATCH_SIZE = self.ORIG_PYBB_NOTIFICATION_BATCH_SIZE
+        defaults.PYBB_TASK_BACKEND = self.ORIG_PYBB_TASK_BACKEND
+        subscription.render_notification = self.ORIG_render_notification
+
+    def test_notifications_batched(self):
+        defaults.PYBB_NOTIFICATION_BATCH_SIZE = 2
+        for i in range(5):
+            user = User.objects.create_user(username='user%d' % i, password='user', email='user%d@example.com' % i)
+            profile = util.get_pybb_profile(user)
+            profile.language = 'ru' if i % 2 else 'en'
+            profile.save()
+            self.topic.subscribers.add(user)
+        invalid = User.objects.create_user(username='invalid', password='user', email='invalid')
+        self.topic.subscribers.add(invalid, self.user)
+        rendered = []
+
+        def render_notification(post, site, lang):
+            rendered.append(lang)
+            return self.ORIG_render_notification(post, site, lang)
+        subscription.render_notification = render_notification
+
+        defaults.PYBB_TASK_BACKEND = 'pybb.tests.RecordingTaskBackend'
+        backend = tasks.get_backend()
+        backend.tasks = []
+        post = Post.objects.create(topic=self.topic, user=self.user, body='reply')
+        self.assertEqual(backend.get_tasks('pybb.subscription.send_topic_notifications'), [(post.id,)])
+        self.assertEqual(len(mail.outbox), 0)
+
+        backend.run()
+        self.assertEqual(sorted(msg.to[0] for msg in mail.outbox), ['user%d@example.com' % i for i in range(5)])
+        self.assertTrue(all(post.get_absolute_url() in msg.body for msg in mail.outbox))
+        self.assertEqual(sorted(rendered), ['en', 'ru'])
+
+    def test_no_connection_without_emails(self):
+        user = User.objects.create_user(username='user0', password='user', email='user0@example.com')
+        profile = util.get_pybb_profile(user)
+        profile.notification_delivery = Profile.DELIVERY_DAILY
+        profile.save()
+        self.topic.subscribers.add(user, self.user)
+        connections = []
+
+        def get_connection(*args, **kwargs):
+            connections.append(args)
+            return orig_get_connection(*args, **kwargs)
+        orig_get_connection = subscription.get_connection
+        subscription.get_connection = get_connection
+        try:
+            Post.objects.create(topic=self.topic, user=self.user, body='reply')
+            self.assertEqual(connections, [])
+            self.topic.subscribers.add(User.objects.create_user('user1', 'user1@example.com', 'user1'))
+            Post.objects.create(topic=self.topic, user=self.user, body='reply')
+            self.assertEqual(len(connections), 1)
+        finally:
+            subscription.get_connection = orig_get_connection
+        self.assertEqual([msg.to for msg in mail.outbox], [['user1@example.com']])
+
+    def test_edit_does_not_notify(self):
+        user = User.objects.create_user(username='user2', password='user2', email='user2@example.com')
+        post = Post.objects.create(topic=self.topic, user=user, body='reply')
+        self.assertTrue(self.topic.subscribers.filter(pk=user.pk).exists())
+        self.assertEqual(util.get_pybb_profile(user).post_count, 1)
+        self.topic.subscribers.remove(user)
+
+        defaults.PYBB_TASK_BACKEND = 'pybb.tests.RecordingTaskBackend'
+        backend = tasks.get_backend()
+        backend.tasks = []
+        post.body = 'edited reply'
+        post.save()
+        self.assertEqual(backend.get_tasks('pybb.subscription.send_topic_notifications'), [])
+        # user unsubscribed after posting is not subscribed again by edit
+        self.assertFalse(self.topic.subscribers.filter(pk=user.pk).exists())
+        self.assertEqual(Profile.objects.get(user=user).post_count, 1)
+
+    def test_digests(self):
+        topic2 = Topic.objects.create(name='topic2', forum=self.forum, user=self.user)
+        Post.objects.create(topic=topic2, user=self.user, body='head')
+        users = []
+        for i, delivery in enumerate([Profile.DELIVERY_HOURLY, Profile.DELIVERY_DAILY, Profile.DELIVERY_IMMEDIATE]):
+            user = User.objects.create_user(username='user%d' % i, password='user', email='user%d@example.com' % i)
+            profile = util.get_pybb_profile(user)
+            profile.notification_delivery = delivery
+            profile.save()
+            self.topic.subscribers.add(user)
+            topic2.subscribers.add(user)
+            users.append(user)
+        posts = [Post.objects.create(topic=topic, user=self.user, body='reply')
+                 for topic in (self.topic, topic2, self.topic)]
+        self.assertEqual(set(msg.to[0] for msg in mail.outbox), set(['user2@example.com']))
+        self.assertEqual(PendingNotification.objects.count(), 6)
+
+        mail.outbox = []
+        out = StringIO()
+        call_command('pybb_send_digests', period='hourly', stdout=out)
+        self.assertIn('Sent 1 hourly digests', out.getvalue())
+        self.assertEqual([msg.to for msg in mail.outbox], [['user0@example.com']])
+        self.assertTrue(all(post.get_absolute_url() in mail.outbox[0].body for post in posts))
+        self.assertIn(topic2.get_absolute_url(), mail.outbox[0].body)
+        self.assertEqual(PendingNotification.objects.filter(user=users[0]).count(), 0)
+
+        # unsubscribed topics are not included in digest
+        client = Client()
+        client.login(username='user1', password='user')
+        client.get(reverse('pybb:delete_subscription', args=[topic2.id]))
+        mail.outbox = []
+        call_command('pybb_send_digests', period='daily', stdout=StringIO())
+        self.assertEqual([msg.to for msg in mail.outbox], [['user1@example.com']])
+        self.assertNotIn(topic2.get_absolute_url(), mail.outbox[0].body)
+        self.assertFalse(PendingNotification.objects.exists())
+
+    def test_digests_send_failure(self):
+        user = User.objects.create_user(username='user0', password='user', email='user0@example.com')
+        profile = util.get_pybb_profile(user)
+        profile.notification_delivery = Profile.DELIVERY_HOURLY
+        profile.save()
+        self.topic.subscribers.add(user)
+        Post.objects.create(topic=self.topic, user=self.user, body='reply')
+        self.assertEqual(PendingNotification.objects.count(), 1)
+
+        def fail(*args, **kwargs):
+            raise IOError('SMTP is down')
+        orig_send_mass_mail = subscription.send_mass_mail
+        subscription.send_mass_mail = fail
+        try:
+            self.assertEqual(subscription.send_digests([Profile.DELIVERY_HOURLY]), 0)
+        finally:
+            subscription.send_mass_mail = orig_send_mass_mail
+        # notification is kept for the next digest
+        self.assertEqual(PendingNotification.objects.count(), 1)
+        mail.outbox = []
+        self.assertEqual(subscription.send_digests([Profile.DELIVERY_HOURLY]), 1)
+        self.assertIn('User %s:' % self.user.get_username(), mail.outbox[0].body)
+        self.assertFalse(PendingNotification.objects.exists())
+
+    def test_local_queue_backend(self):
+        defaults.PYBB_TASK_BACKEND = 'pybb.tasks.LocalQueueBackend'
+        backend = tasks.get_backend()
+        del recorded_tasks[:]
+        tasks.enqueue('pybb.tests.record_task', 1)
+        tasks.enqueue('pybb.tests.record_task', 2)
+        backend.join()
+        self.assertEqual(recorded_tasks, [(1, 'pybb-tasks'), (2, 'pybb-tasks')])
+
+
+class PostWriteTest(TestCase, SharedTestModule):
+    def setUp(self):
+        self.ORIG_PYBB_TASK_BACKEND = defaults.PYBB_TASK_BACKEND
+        self.ORIG_add_counters = Forum.add_counters
+        defaults.PYBB_TASK_BACKEND = 'pybb.tests.RecordingTaskBackend'
+        self.backend = tasks.get_backend()
+        self.backend.tasks = []
+        self.create_user()
+        self.create_initial()
+        self.backend.tasks = []
+
+    def tearDown(self):
+        defaults.PYBB_TASK_BACKEND = self.ORIG_PYBB_TASK_BACKEND
+        Forum.add_counters = self.ORIG_add_counters
+
+    def get_statements(self, queries):
+        return [q['sql'] for q in queries if not q['sql'].startswith(('SAVEPOINT', 'RELEASE SAVEPOINT'))]
+
+    def test_create_queries_limit(self):
+        user = User.objects.create_user('user2', 'user2@localhost', 'user2')
+        user = User.objects.get(pk=user.pk)
+        for i in range(3):
+            Post.objects.create(topic=self.topic, user=self.user, body='reply%d' % i)
+        self.backend.tasks = []
+        topic = Topic.objects.select_related('forum').get(pk=self.topic.pk)
+        with CaptureQueriesContext(connection) as queries:
+            post = Post.objects.create(topic=topic, user=user, body='reply')
+        self.assertLessEqual(len(self.get_statements(queries)), Post.POST_CREATE_QUERIES_LIMIT)
+        self.assertEqual(self.backend.get_tasks('pybb.subscription.send_topic_notifications'), [(post.pk,)])
+        # topic head is found without loading all posts of topic
+        post_selects = [q['sql'] for q in queries if 'FROM "pybb_post"' in q['sql']]
+        self.assertTrue(post_selects)
+        self.assertTrue(all('LIMIT' in sql for sql in post_selects))
+
+        topic = Topic.objects.get(pk=self.topic.pk)
+        self.assertEqual((topic.post_count, topic.updated), (5, post.created))
+        forum = Forum.objects.get(pk=self.forum.pk)
+        self.assertEqual((forum.post_count, forum.topic_count, forum.updated), (5, 1, post.created))
+        self.assertEqual(util.get_pybb_profile(User.objects.get(pk=user.pk)).post_count, 1)
+
+        # topic and forum are loaded with one query when post has only topic id
+        with CaptureQueriesContext(connection) as queries:
+            Post.objects.create(topic_id=self.topic.pk, user=user, body='reply')
+        self.assertLessEqual(len(self.get_statements(queries)), Post.POST_CREATE_QUERIES_LIMIT + 1)
+
+        # new topic costs one more insert
+        forum = Forum.objects.get(pk=self.forum.pk)
+        with CaptureQueriesContext(connection) as queries:
+            topic = Topic.objects.create(forum=forum, user=user, name='topic2')
+            Post.objects.create(topic=topic, user=user, body='head')
+        self.assertLessEqual(len(self.get_statements(queries)), Post.POST_CREATE_QUERIES_LIMIT + 1)
+        forum = Forum.objects.get(pk=self.forum.pk)
+        self.assertEqual((forum.post_count, forum.topic_count), (7, 2))
+
+    def test_create_rollback(self):
+        def add_counters(*args, **kwargs):
+            raise RuntimeError
+        Forum.add_counters = add_counters
+        self.login_client()
+        add_post_url = reverse('pybb:add_post', kwargs={'topic_id': self.topic.id})
+        values = self.get_form_values(self.client.get(add_post_url))
+        values['body'] = 'reply'
+        with transaction.atomic():
+            self.assertRaises(RuntimeError, self.client.post, add_post_url, values)
+        self.assertEqual(Post.objects.count(), 1)
+        self.assertEqual(Topic.objects.get(pk=self.topic.pk).post_count, 1)
+        self.assertEqual(self.backend.tasks, [])
+
+    def test_commit_hooks(self):
+        called = []
+        with tasks.atomic():
+            tasks.on_commit(called.append, 1)
+            tasks.on_commit(called.append, 1)
+            try:
+                with tasks.atomic():
+                    tasks.on_commit(called.append, 2)
+                    raise RuntimeError
+            except RuntimeError:
+                pass
+            tasks.on_commit(called.append, 3)
+            self.assertEqual(called, [])
+        self.assertEqual(called, [1, 3])
+        tasks.on_commit(called.append, 4)
+        self.assertEqual(called, [1, 3, 4])
+
+
+
+class CommitHooksTest(TransactionTestCase):
+    def test_outer_transaction(self):
+        called = []
+        with transaction.atomic():
+            with tasks.atomic():
+                tasks.on_commit(called.append, 1)
+            tasks.on_commit(called.append, 2)
+            tasks.on_commit(called.append, 2)
+            self.assertEqual(called, [])
+        self.assertEqual(called, [1, 2])
+        try:
+            with transaction.atomic():
+                with tasks.atomic():
+                    tasks.on_commit(called.append, 3)
+                raise RuntimeError
+        except RuntimeError:
+            pass
+        tasks.on_commit(called.append, 4)
+        self.assertEqual(called, [1, 2, 4])
+
+class BufferedCountersTest(TestCase, SharedTestModule):
+    def setUp(self):
+        self.ORIG_PYBB_BUFFER_FORUM_COUNTERS = defaults.PYBB_BUFFER_FORUM_COUNTERS
+        self.create_user()
+        self.create_initial()
+        defaults.PYBB_BUFFER_FORUM_COUNTERS = True
+
+    def tearDown(self):
+        defaults.PYBB_BUFFER_FORUM_COUNTERS = self.ORIG_PYBB_BUFFER_FORUM_COUNTERS
+
+    def test_buffered_counters(self):
+        topic = Topic.objects.create(name='topic2', forum=self.forum, user=self.user)
+        Post.objects.create(topic=topic, user=self.user, body='head')
+        post = Post.objects.create(topic=self.topic, user=self.user, body='reply')
+        self.assertEqual(ForumCounterDelta.objects.count(), 2)
+        forum = Forum.objects.get(pk=self.forum.pk)
+        self.assertEqual((forum.post_count, forum.topic_count), (1, 1))
+
+        # readers see pending deltas
+        response = self.client.get(reverse('pybb:index'))
+        forum = pybb_forum_unread(response.context['categories'][0].forums_accessed, self.user)[0]
+        self.assertEqual((forum.post_count, forum.topic_count, forum.updated), (3, 2, post.created))
+
+        self.assertEqual(counters.flush_forum_counters(), 1)
+        self.assertFalse(ForumCounterDelta.objects.exists())
+        forum = Forum.objects.get(pk=self.forum.pk)
+        self.assertEqual((forum.post_count, forum.topic_count, forum.updated), (3, 2, post.created))
+        self.assertEqual(counters.with_pending([forum])[0].post_count, 3)
+        self.assertEqual(counters.flush_forum_counters(), 0)
+
+        # recounting drops pending deltas
+        Post.objects.create(topic=self.topic, user=self.user, body='reply')
+        forum.update_counters()
+        self.assertFalse(ForumCounterDelta.objects.exists())
+        self.assertEqual(Forum.objects.get(pk=self.forum.pk).post_count, 4)
+
+
+class TopicViewsTest(TestCase, SharedTestModule):
+    def setUp(self):
+        self.ORIG_PYBB_TOPIC_VIEWS_BUFFER = defaults.PYBB_TOPIC_VIEWS_BUFFER
+        self.ORIG_PYBB_TOPIC_VIEWS_FLUSH_INTERVAL = defaults.PYBB_TOPIC_VIEWS_FLUSH_INTERVAL
+        self.ORIG_PYBB_TOPIC_VIEWS_DEDUP_TIMEOUT = defaults.PYBB_TOPIC_VIEWS_DEDUP_TIMEOUT
+        defaults.PYBB_TOPIC_VIEWS_BUFFER = True
+        cache.clear()
+        self.create_user()
+        self.create_initial()
+
+    def tearDown(self):
+        defaults.PYBB_TOPIC_VIEWS_BUFFER = self.ORIG_PYBB_TOPIC_VIEWS_BUFFER
+        defaults.PYBB_TOPIC_VIEWS_FLUSH_INTERVAL = self.ORIG_PYBB_TOPIC_VIEWS_FLUSH_INTERVAL
+        defaults.PYBB_TOPIC_VIEWS_DEDUP_TIMEOUT = self.ORIG_PYBB_TOPIC_VIEWS_DEDUP_TIMEOUT
+        cache.clear()
+
+    def test_buffered_views(self):
+        defaults.PYBB_TOPIC_VIEWS_FLUSH_INTERVAL = 3600
+        counters._views_flushed_at = time.time()
+        url = self.topic.get_absolute_url()
+        for _ in range(5):
+            self.client.get(url)
+        self.login_client()
+        self.client.get(url)
+        self.assertEqual(Topic.objects.get(pk=self.topic.pk).views, 0)
+        topic2 = Topic.objects.create(name='topic2', forum=self.forum, user=self.user)
+        topics = pybbm_prefetch_topic_views(Topic.objects.order_by('pk'))
+        self.assertEqual([pybbm_calc_topic_views(topic) for topic in topics], [6, 0])
+        self.assertEqual(pybbm_calc_topic_views(Topic.objects.get(pk=self.topic.pk)), 6)
+
+        counters.flush_topic_views([self.topic.id, topic2.id])
+        self.assertEqual(Topic.objects.get(pk=self.topic.pk).views, 6)
+        self.assertEqual(counters.get_pending_views([self.topic.id]), {self.topic.id: 0})
+        self.assertEqual(pybbm_calc_topic_views(Topic.objects.get(pk=self.topic.pk)), 6)
+
+    def test_flush_interval(self):
+        defaults.PYBB_TOPIC_VIEWS_FLUSH_INTERVAL = 0
+        url = self.topic.get_absolute_url()
+        self.client.get(url)
+        self.client.get(url)
+        self.assertEqual(Topic.objects.get(pk=self.topic.pk).views, 2)
+        self.assertEqual(counters.get_pending_views([self.topic.id]), {self.topic.id: 0})
+
+    def test_flush_locked(self):
+        defaults.PYBB_TOPIC_VIEWS_FLUSH_INTERVAL = 0
+        url = self.topic.get_absolute_url()
+        # another flush is running, topic is kept for the next one
+        cache.add(build_cache_key('topic_views_flush_lock'), 1, 60)
+        self.client.get(url)
+        self.assertEqual(Topic.objects.get(pk=self.topic.pk).views, 0)
+        self.assertIn(self.topic.id, counters._viewed_topic_ids)
+        cache.delete(build_cache_key('topic_views_flush_lock'))
+        topic2 = Topic.objects.create(name='topic2', forum=self.forum, user=self.user)
+        self.client.get(topic2.get_absolute_url())
+        self.assertEqual(Topic.objects.get(pk=self.topic.pk).views, 1)
+        self.assertEqual(Topic.objects.get(pk=topic2.pk).views, 1)
+        self.assertEqual(counters._viewed_topic_ids, set())
+
+    def test_flush_command(self):
+        defaults.PYBB_TOPIC_VIEWS_FLUSH_INTERVAL = 3600
+        counters._views_flushed_at = time.time()
+        topic2 = Topic.objects.create(name='topic2', forum=self.forum, user=self.user)
+        for topic in (self.topic, topic2, self.topic):
+            self.client.get(topic.get_absolute_url())
+        self.assertEqual(Topic.objects.get(pk=self.topic.pk).views, 0)
+        # topics viewed in another process are saved too
+        counters._viewed_topic_ids.clear()
+        out = StringIO()
+        call_command('pybb_flush_counters', chunk_size=1, stdout=out)
+        self.assertIn('Views of 2 topics saved', out.getvalue())
+        self.assertEqual(Topic.objects.get(pk=self.topic.pk).views, 2)
+        self.assertEqual(Topic.objects.get(pk=topic2.pk).views, 1)
+        self.assertEqual(counters.get_pending_views([self.topic.id, topic2.id]), {self.topic.id: 0, topic2.id: 0})
+
+    def test_dedup(self):
+        defaults.PYBB_TOPIC_VIEWS_FLUSH_INTERVAL = 0
+        defaults.PYBB_TOPIC_VIEWS_DEDUP_TIMEOUT = 60
+        url = self.topic.get_absolute_url()
+        self.client.get(url)
+        self.client.get(url)
+        self.assertEqual(Topic.objects.get(pk=self.topic.pk).views, 1)
+        self.client.get(url, REMOTE_ADDR='10.0.0.1')
+        self.assertEqual(Topic.objects.get(pk=self.topic.pk).views, 2)
+        self.login_client()
+        self.client.get(url)
+        self.client.get(url)
+        self.assertEqual(Topic.objects.get(pk=self.topic.pk).views, 3)
+
+
+class UpdateCountersCommandTest(TestCase, SharedTestModule):
+    def setUp(self):
+        self.create_user()
+        self.create_initial()
+        self.forum2 = Forum.objects.create(name='forum2', category=self.category)
+        self.topics = [self.topic]
+        for i in range(4):
+            topic = Topic.objects.create(name='topic%d' % i, forum=self.forum2, user=self.user)
+            Post.objects.create(topic=topic, user=self.user, body='head')
+            self.topics.append(topic)
+        self.reply = Post.objects.create(topic=self.topics[2], user=self.user, body='reply')
+        self.reply.updated = self.reply.created + datetime.timedelta(minutes=5)
+        self.reply.save()
+        self.expected = [(t.post_count, t.updated) for t in Topic.objects.filter(pk__in=[t.pk for t in self.topics])
+                         .order_by('pk')]
+        self.expected_forums = [(f.post_count, f.topic_count, f.updated) for f in Forum.objects.order_by('pk')]
+
+    def get_counters(self):
+        topics = [(t.post_count, t.updated) for t in Topic.objects.order_by('pk')]
+        forums = [(f.post_count, f.topic_count, f.updated) for f in Forum.objects.order_by('pk')]
+        return topics, forums
+
+    def test_update_counters(self):
+        self.assertEqual(self.expected[2], (2, self.reply.updated))
+        Topic.objects.update(post_count=0)
+        Topic.objects.filter(pk=self.topics[3].pk).update(updated=None)
+        Forum.objects.update(post_count=0, topic_count=0)
+
+        out = StringIO()
+        call_command('pybb_update_counters', forum_id=self.forum2.pk, only_changed=True, chunk_size=2, stdout=out)
+        self.assertIn('Total topics: 4 checked, 4 updated', out.getvalue())
+        self.assertIn('Total forums: 1 checked, 1 updated', out.getvalue())
+        topics, forums = self.get_counters()
+        self.assertEqual(topics[0][0], 0)
+        self.assertEqual(topics[1:], self.expected[1:])
+        self.assertEqual(forums, [(0, 0, self.expected_forums[0][2]), self.expected_forums[1]])
+
+        out = StringIO()
+        call_command('pybb_update_counters', only_changed=True, stdout=out)
+        self.assertIn('Total topics: 5 checked, 1 updated', out.getvalue())
+        self.assertIn('Total forums: 2 checked, 1 updated', out.getvalue())
+        self.assertEqual(self.get_counters(), (self.expected, self.expected_forums))
+
+        out = StringIO()
+        call_command('pybb_update_counters', stdout=out)
+        self.assertIn('Total topics: 5 checked, 5 updated', out.getvalue())
+        self.assertEqual(self.get_counters(), (self.expected, self.expected_forums))
+
+
+class PurgeUserPostsTest(TestCase, SharedTestModule):
+    def setUp(self):
+        self.ORIG_PYBB_TASK_BACKEND = defaults.PYBB_TASK_BACKEND
+        self.ORIG_PYBB_DELETE_BATCH_SIZE = defaults.PYBB_DELETE_BATCH_SIZE
+        self.ORIG_PYBB_DELETE_BACKGROUND_THRESHOLD = defaults.PYBB_DELETE_BACKGROUND_THRESHOLD
+        defaults.PYBB_TASK_BACKEND = 'pybb.tests.RecordingTaskBackend'
+        defaults.PYBB_DELETE_BATCH_SIZE = 2
+        self.backend = tasks.get_backend()
+        self.backend.tasks = []
+        self.create_user()
+        self.create_initial()
+        self.spammer = User.objects.create_user('spammer', 'spammer@localhost', 'spammer')
+        self.other = User.objects.create_user('other', 'other@localhost', 'other')
+        # topics started by spammer with replies of other users
+        self.spam_topics = []
+        for i in range(3):
+            topic = Topic.objects.create(name='spam%d' % i, forum=self.forum, user=self.spammer)
+            Post.objects.create(topic=topic, user=self.spammer, body='spam')
+            Post.objects.create(topic=topic, user=self.other, body='reply')
+            self.spam_topics.append(topic)
+        self.reply = Post.objects.create(topic=self.topic, user=self.spammer, body='spam reply')
+        self.post = Post.objects.get(pk=self.post.pk)
+        self.user.is_superuser = True
+        self.user.save()
+        self.backend.tasks = []
+
+    def tearDown(self):
+        defaults.PYBB_TASK_BACKEND = self.ORIG_PYBB_TASK_BACKEND
+        defaults.PYBB_DELETE_BATCH_SIZE = self.ORIG_PYBB_DELETE_BATCH_SIZE
+        defaults.PYBB_DELETE_BACKGROUND_THRESHOLD = self.ORIG_PYBB_DELETE_BACKGROUND_THRESHOLD
+
+    def block(self):
+        self.login_client()
+        return self.client.post(reverse('pybb:block_user', args=[self.spammer.username]),
+                                data={'block_and_delete_messages': 'block_and_delete_messages'}, follow=True)
+
+    def assert_purged(self):
+        self.assertFalse(Post.objects.filter(user=self.spammer).exists())
+        self.assertEqual(list(Topic.objects.all()), [self.topic])
+        topic = Topic.objects.get(pk=self.topic.pk)
+        self.assertEqual(topic.post_count, 1)
+        self.assertEqual(topic.updated, self.post.created)
+        forum = Forum.objects.get(pk=self.forum.pk)
+        self.assertEqual((forum.post_count, forum.topic_count), (1, 1))
+        self.assertEqual(util.get_pybb_profile(User.objects.get(pk=self.spammer.pk)).post_count, 0)
+        self.assertEqual(util.get_pybb_profile(User.objects.get(pk=self.other.pk)).post_count, 0)
+        self.assertEqual(util.get_pybb_profile(User.objects.get(pk=self.user.pk)).post_count, 1)
+
+    def test_purge(self):
+        response = self.block()
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(User.objects.get(pk=self.spammer.pk).is_active)
+        self.assertEqual(self.backend.get_tasks('pybb.moderation.purge_user_posts'), [])
+        # topics started by user are hidden at once and purged one by one
+        self.assertEqual(Topic.objects.filter(deleted=True).count(), 3)
+        self.assertEqual(sorted(self.backend.get_tasks('pybb.moderation.purge_topic')),
+                         [(topic.pk,) for topic in self.spam_topics])
+        forum = Forum.objects.get(pk=self.forum.pk)
+        self.assertEqual((forum.post_count, forum.topic_count), (1, 1))
+        self.backend.run()
+        self.assert_purged()
+
+        # topics emptied by purge are deleted, other empty topics are kept
+        empty = Topic.objects.create(name='empty', forum=self.forum, user=self.other)
+        topic = Topic.objects.create(name='topic', forum=self.forum, user=self.other)
+        Post.objects.create(topic=topic, user=self.spammer, body='spam')
+        moderation.purge_user_posts(self.spammer.pk)
+        self.backend.run()
+        self.assertEqual(set(Topic.objects.all()), set([self.topic, empty]))
+
+    def test_purge_in_batches(self):
+        for i in range(3):
+            topic = Topic.objects.create(name='topic%d' % i, forum=self.forum, user=self.other)
+            Post.objects.create(topic=topic, user=self.other, body='head')
+            Post.objects.create(topic=topic, user=self.spammer, body='spam')
+        with CaptureQueriesContext(connection) as queries:
+            moderation.purge_user_posts(self.spammer.pk)
+        # ids are never passed to database in lists longer than PYBB_DELETE_BATCH_SIZE
+        for query in queries:
+            for ids in re.findall(r' IN \(([^()]*)\)', query['sql']):
+                self.assertLessEqual(len(ids.split(',')), 2, query['sql'])
+        self.backend.run()
+        self.assertFalse(Post.objects.filter(user=self.spammer).exists())
+        self.assertEqual(Topic.objects.count(), 4)
+        self.assertEqual(Forum.objects.get(pk=self.forum.pk).post_count, 4)
+
+    def test_purge_in_background(self):
+        defaults.PYBB_DELETE_BACKGROUND_THRESHOLD = 3
+        response = self.block()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.backend.get_tasks('pybb.moderation.purge_user_posts'), [(self.spammer.pk,)])
+        self.assertEqual(Post.objects.filter(user=self.spammer).count(), 4)
+        self.backend.run()
+        self.assert_purged()
+
+    def test_purge_with_immediate_backend(self):
+        defaults.PYBB_TASK_BACKEND = 'pybb.tasks.ImmediateBackend'
+        defaults.PYBB_DELETE_BACKGROUND_THRESHOLD = 3
+        # posts are deleted within request, so moderator isn't told about background deletion
+        self.assertFalse(moderation.block_user(self.spammer, delete_posts=True))
+        self.assert_purged()
+
+
+class DeleteTopicTest(TestCase, SharedTestModule):
+    def setUp(self):
+        self.ORIG_PYBB_TASK_BACKEND = defaults.PYBB_TASK_BACKEND
+        self.ORIG_PYBB_DELETE_BATCH_SIZE = defaults.PYBB_DELETE_BATCH_SIZE
+        defaults.PYBB_TASK_BACKEND = 'pybb.tests.RecordingTaskBackend'
+        defaults.PYBB_DELETE_BATCH_SIZE = 2
+        self.create_user()
+        self.create_initial()
+        self.other = User.objects.create_user('other', 'other@localhost', 'other')
+        self.big_topic = Topic.objects.create(name='big', forum=self.forum, user=self.other,
+                                              poll_type=Topic.POLL_TYPE_SINGLE, poll_question='?')
+        self.head = Post.objects.create(topic=self.big_topic, user=self.other, body='head')
+        for i in range(4):
+            Post.objects.create(topic=self.big_topic, user=self.user if i % 2 else self.other, body='reply')
+        answer = PollAnswer.objects.create(topic=self.big_topic, text='yes')
+        for user in (self.user, self.other):
+            PollAnswerUser.objects.create(poll_answer=answer, user=user)
+            TopicReadTracker.objects.create(topic=self.big_topic, user=user)
+        self.user.is_superuser = True
+        self.user.save()
+        self.backend = tasks.get_backend()
+        self.backend.tasks = []
+
+    def tearDown(self):
+        defaults.PYBB_TASK_BACKEND = self.ORIG_PYBB_TASK_BACKEND
+        defaults.PYBB_DELETE_BATCH_SIZE = self.ORIG_PYBB_DELETE_BATCH_SIZE
+
+    def test_delete_topic(self):
+        self.login_client()
+        response = self.client.post(reverse('pybb:delete_post', args=[self.head.pk]), follow=True)
+        self.assertEqual(response.status_code, 200)
+
+        # topic is hidden at once, even from superuser, purge is deferred
+        self.assertTrue(Topic.objects.get(pk=self.big_topic.pk).deleted)
+        self.assertEqual(Post.objects.filter(topic=self.big_topic).count(), 5)
+        self.assertEqual(self.backend.get_tasks('pybb.moderation.purge_topic'), [(self.big_topic.pk,)])
+        self.assertEqual(list(permissions.perms.filter_topics(self.user, Topic.objects.all())), [self.topic])
+        self.assertFalse(permissions.perms.filter_posts(self.user, Post.objects.filter(topic=self.big_topic)).exists())
+        self.assertNotContains(self.client.get(self.forum.get_absolute_url()), self.big_topic.get_absolute_url())
+        self.assertEqual(self.client.get(self.big_topic.get_absolute_url()).status_code, 404)
+        forum = Forum.objects.get(pk=self.forum.pk)
+        self.assertEqual((forum.post_count, forum.topic_count), (1, 1))
+        self.assertEqual(forum.last_post, self.post)
+        self.assertEqual(forum.updated, Topic.objects.get(pk=self.topic.pk).updated)
+
+        # counters are decremented without counting posts of forum, hiding twice changes nothing
+        with CaptureQueriesContext(connection) as queries:
+            moderation.delete_topic(Topic.objects.get(pk=self.big_topic.pk))
+        self.assertFalse([q for q in queries if 'COUNT(' in q['sql']])
+        forum = Forum.objects.get(pk=self.forum.pk)
+        self.assertEqual((forum.post_count, forum.topic_count), (1, 1))
+        self.assertEqual(self.backend.get_tasks('pybb.moderation.purge_topic'), [(self.big_topic.pk,)])
+
+        self.backend.run()
+        self.assertFalse(Topic.objects.filter(pk=self.big_topic.pk).exists())
+        self.assertFalse(Post.objects.filter(topic=self.big_topic.pk).exists())
+        self.assertFalse(PollAnswer.objects.filter(topic=self.big_topic.pk).exists())
+        self.assertFalse(PollAnswerUser.objects.exists())
+        self.assertFalse(TopicReadTracker.objects.filter(topic=self.big_topic.pk).exists())
+        forum = Forum.objects.get(pk=self.forum.pk)
+        self.assertEqual((forum.post_count, forum.topic_count), (1, 1))
+        self.assertEqual(util.get_pybb_profile(User.objects.get(pk=self.other.pk)).post_count, 0)
+        self.assertEqual(util.get_pybb_profile(User.objects.get(pk=self.user.pk)).post_count, 1)
+
+        # purge of already purged topic does nothing
+        moderation.purge_topic(self.big_topic.pk)
+
+
+class TopicModerationTest(TestCase, SharedTestModule):
+    def setUp(self):
+        self.create_user()
+        self.create_initial()
+        self.forum2 = Forum.objects.create(name='forum2', category=self.category)
+        self.other = User.objects.create_user('other', 'other@localhost', 'other')
+        self.topic2 = Topic.objects.create(name='topic2', forum=self.forum, user=self.other)
+        self.posts2 = [Post.objects.create(topic=self.topic2, user=self.other, body='post%d' % i) for i in range(4)]
+        self.topic3 = Topic.objects.create(name='topic3', forum=self.forum2, user=self.other)
+        Post.objects.create(topic=self.topic3, user=self.other, body='head')
+        self.user.is_superuser = True
+        self.user.save()
+        self.login_client()
+
+    def assert_counters(self):
+        """
+        Check that counters changed by deltas are equal to recounted ones
+        """
+        def get_counters():
+            return ([(t.post_count, t.updated) for t in Topic.objects.order_by('pk')],
+                    [(f.post_count, f.topic_count, f.updated) for f in Forum.objects.order_by('pk')])
+        values = get_counters()
+        counters.recount_topics(Topic.objects.all(), Post.objects.all())
+        counters.recount_forums(Forum.objects.all())
+        self.assertEqual(values, get_counters())
+
+    def test_move_topics(self):
+        url = reverse('pybb:move_topics') + '?topic=%d&topic=%d' % (self.topic.pk, self.topic2.pk)
+        response = self.client.get(url)
+        self.assertContains(response, self.topic2.get_absolute_url())
+        values = {'topics': [self.topic.pk, self.topic2.pk], 'forum': self.forum2.pk}
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(url, values, follow=True)
+        self.assertRedirects(response, self.forum2.get_absolute_url())
+        self.assertEqual(Topic.objects.filter(forum=self.forum2).count(), 3)
+        forum2 = Forum.objects.get(pk=self.forum2.pk)
+        self.assertEqual((forum2.post_count, forum2.topic_count), (6, 3))
+        self.assert_counters()
+        # posts are not touched one by one
+        self.assertFalse([q for q in queries.captured_queries if 'UPDATE "pybb_post"' in q['sql']])
+
+    def test_merge_topics(self):
+        self.topic2.subscribers.add(self.other)
+        url = reverse('pybb:merge_topics') + '?topic=%d&topic=%d' % (self.topic2.pk, self.topic3.pk)
+        self.assertContains(self.client.get(url), self.topic3.get_absolute_url())
+        values = {'topics': [self.topic2.pk, self.topic3.pk], 'target': self.topic.pk}
+        response = self.client.post(url, values, follow=True)
+        self.assertRedirects(response, self.topic.get_absolute_url())
+        self.assertEqual(list(Topic.objects.all()), [self.topic])
+        topic = Topic.objects.get(pk=self.topic.pk)
+        self.assertEqual(topic.post_count, 6)
+        self.assertEqual(topic.head, self.post)
+        self.assertEqual(set(topic.subscribers.all()), set([self.user, self.other]))
+        self.assert_counters()
+
+    def test_split_topic(self):
+        url = reverse('pybb:split_topic', args=[self.topic2.pk]) + '?post=%d' % self.posts2[2].pk
+        values = self.get_form_values(self.client.get(url), 'split-topic')
+        values.update({'following': 'on', 'name': 'split', 'forum': self.forum2.pk})
+        response = self.client.post(url, values, follow=True)
+        new_topic = Topic.objects.get(name='split')
+        self.assertRedirects(response, new_topic.get_absolute_url())
+        self.assertEqual(list(new_topic.posts.order_by('created')), self.posts2[2:])
+        self.assertEqual((new_topic.forum, new_topic.user, new_topic.created),
+                         (self.forum2, self.other, self.posts2[2].created))
+        self.assertEqual(Topic.objects.get(pk=self.topic2.pk).post_count, 2)
+        self.assert_counters()
+
+        # topic is deleted when all its posts are split
+        moderation.split_posts(Post.objects.filter(topic=self.topic3), 'split2')
+        self.assertFalse(Topic.objects.filter(pk=self.topic3.pk).exists())
+        self.assert_counters()
+
+    def test_permissions(self):
+        self.login_client('other', 'other')
+        self.assertEqual(self.client.get(reverse('pybb:move_topics')).status_code, 403)
+        self.assertEqual(self.client.get(reverse('pybb:split_topic', args=[self.topic2.pk])).status_code, 403)
+        self.forum2.moderators.add(self.other)
+        # topics of forum which is not moderated by user can't be selected
+        response = self.client.post(reverse('pybb:move_topics'), {'topics': [self.topic2.pk], 'forum': self.forum2.pk})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Topic.objects.get(pk=self.topic2.pk).forum, self.forum)
+
+
+class SearchTest(TestCase, SharedTestModule):
+    def setUp(self):
+        self.ORIG_PYBB_SEARCH_BACKEND = defaults.PYBB_SEARCH_BACKEND
+        defaults.PYBB_SEARCH_BACKEND = 'pybb.search.LocalIndexBackend'
+        self.create_user()
+        self.create_initial()
+        self.other = User.objects.create_user('other', 'other@localhost', 'other')
+        self.topic2 = Topic.objects.create(name='Engine tuning', forum=self.forum, user=self.other)
+        self.post2 = Post.objects.create(topic=self.topic2, user=self.other, body='Carburettor needs cleaning')
+        self.post3 = Post.objects.create(topic=self.topic2, user=self.user, body='Cleaning the [b]valves[/b] too')
+
+    def tearDown(self):
+        defaults.PYBB_SEARCH_BACKEND = self.ORIG_PYBB_SEARCH_BACKEND
+
+    def search(self, query, user=None):
+        posts = permissions.perms.filter_posts(user or self.user, Post.objects.all())
+        return set(search.search_posts(query, posts))
+
+    def test_get_terms(self):
+        self.assertEqual(search.get_terms('Foo, bar; foo a Ünïcode!'), ['foo', 'bar', 'ünïcode'])
+        self.assertEqual(search.get_terms(''), [])
+
+    def test_index_updates(self):
+        # body text and topic name are indexed, all query terms should match
+        self.assertEqual(self.search('cleaning'), set([self.post2, self.post3]))
+        self.assertEqual(self.search('VALVES cleaning'), set([self.post3]))
+        self.assertEqual(self.search('engine'), set([self.post2, self.post3]))
+        self.assertEqual(self.search('engine valves'), set([self.post3]))
+        self.assertEqual(self.search('valves carburettor'), set())
+        self.assertEqual(self.search('b'), set())
+
+        self.post3.body = 'Pistons'
+        self.post3.save()
+        self.assertEqual(self.search('valves'), set())
+        self.assertEqual(self.search('pistons'), set([self.post3]))
+
+        self.topic2.name = 'Motor'
+        self.topic2.save()
+        self.assertEqual(self.search('engine'), set())
+        self.assertEqual(self.search('motor'), set([self.post2, self.post3]))
+
+        self.post3.delete()
+        self.assertEqual(self.search('pistons'), set())
+        self.assertFalse(SearchTerm.objects.filter(term='pistons').exists())
+
+    def test_visibility(self):
+        self.forum.hidden = True
+        self.forum.save()
+        self.assertEqual(self.search('cleaning', AnonymousUser()), set())
+        self.forum.hidden = False
+        self.forum.save()
+
+        orig_premoderation = defaults.PYBB_PREMODERATION
+        defaults.PYBB_PREMODERATION = premoderate_test
+        try:
+            self.post3.on_moderation = True
+            self.post3.save()
+            self.assertEqual(self.search('cleaning', AnonymousUser()), set([self.post2]))
+            self.assertEqual(self.search('cleaning', self.user), set([self.post2, self.post3]))
+        finally:
+            defaults.PYBB_PREMODERATION = orig_premoderation
+
+    def test_search_view(self):
+        url = reverse('pybb:search')
+        response = self.client.get(url, data={'q': 'valves'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(list(response.context['post_list']), [self.post3])
+        self.assertContains(response, self.post3.get_absolute_url())
+        self.assertNotContains(response, self.post2.get_absolute_url())
+        response = self.client.get(url, data={'q': '!'})
+        self.assertEqual(list(response.context['post_list']), [])
+        self.assertTrue(response.context['form'].errors)
+
+        # search is opt-in: without backend nothing is indexed and search page is missing
+        defaults.PYBB_SEARCH_BACKEND = None
+        self.assertEqual(self.client.get(url, data={'q': 'valves'}).status_code, 404)
+        post = Post.objects.create(topic=self.topic2, user=self.user, body='unindexed')
+        self.assertFalse(SearchTerm.objects.filter(post=post).exists())
+
+    def test_rebuild_command(self):
+        SearchTerm.objects.all().delete()
+        SearchTerm.objects.create(term='stale', post=self.post)
+        out = StringIO()
+        call_command('pybb_rebuild_search_index', chunk_size=1, stdout=out)
+        self.assertIn('Indexed 2 topics', out.getvalue())
+        self.assertIn('Indexed 3 posts', out.getvalue())
+        self.assertEqual(self.search('stale'), set())
+        self.assertEqual(self.search('engine cleaning'), set([self.post2, self.post3]))
+        self.assertEqual(self.search('etopic test'), set([self.post]))
+
+    def test_rerender_command(self):
+        Post.objects.filter(pk=self.post2.pk).update(body_text='stale')
+        search.get_backend().index_posts([Post.objects.get(pk=self.post2.pk)])
+        self.assertEqual(self.search('stale'), set([self.post2]))
+        call_command('pybb_rerender', posts_only=True, stdout=StringIO())
+        self.assertEqual(self.search('stale'), set())
+        self.assertEqual(self.search('carburettor'), set([self.post2]))
+        self.assertEqual(self.search('valves'), set([self.post3]))
+
+
 def premoderate_test(user, post):
     """
     Test premoderate function
@@ -1198,6 +2578,40 @@ class PreModerationTest(TestCase, SharedTestModule):
         response = client.get(Topic.objects.get(name='new topic name').get_absolute_url())
         self.assertEqual(response.status_code, 200)
 
+    def test_moderation_queue(self):
+        other = User.objects.create_user('other', 'other@localhost', 'other')
+        replies = [Post.objects.create(topic=self.topic, user=other, body='reply%d' % i, on_moderation=True)
+                   for i in range(3)]
+        topic = Topic.objects.create(name='moderated', forum=self.forum, user=other, on_moderation=True)
+        head = Post.objects.create(topic=topic, user=other, body='head', on_moderation=True)
+        # subscribers are notified only about approved posts
+        self.assertEqual(len(mail.outbox), 0)
+
+        moderator = User.objects.create_user('moderator', 'moderator@localhost', 'moderator')
+        self.client.login(username='zeus', password='zeus')
+        url = reverse('pybb:moderation_queue', args=[self.forum.pk])
+        self.assertEqual(self.client.get(url).status_code, 403)
+        self.assertNotContains(self.client.get(self.forum.get_absolute_url()), url)
+        self.forum.moderators.add(moderator)
+        self.client.login(username='moderator', password='moderator')
+        self.assertContains(self.client.get(self.forum.get_absolute_url()), url)
+        response = self.client.get(url)
+        self.assertEqual(list(response.context['post_list']), replies + [head])
+
+        response = self.client.post(url, {'posts': [replies[0].pk, replies[1].pk, head.pk], 'approve': '1'},
+                                    follow=True)
+        self.assertRedirects(response, url)
+        self.assertEqual(list(response.context['post_list']), [replies[2]])
+        self.assertFalse(Topic.objects.get(pk=topic.pk).on_moderation)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertIn(replies[1].get_absolute_url(), mail.outbox[0].body)
+
+        self.client.post(url, {'posts': [replies[2].pk], 'reject': '1'})
+        self.assertFalse(Post.objects.filter(pk=replies[2].pk).exists())
+        self.assertEqual(Topic.objects.get(pk=self.topic.pk).post_count, 3)
+        self.assertEqual(Forum.objects.get(pk=self.forum.pk).post_count, 4)
+        self.assertEqual(util.get_pybb_profile(User.objects.get(pk=other.pk)).post_count, 3)
+
     def tearDown(self):
         defaults.PYBB_PREMODERATION = self.ORIG_PYBB_PREMODERATION
 
@@ -1424,6 +2838,46 @@ class PollTest(TestCase, SharedTestModule):
         self.assertListEqual([a.votes() for a in PollAnswer.objects.all()], [1, 1])
         self.assertListEqual([a.votes_percent() for a in PollAnswer.objects.all()], [50.0, 50.0])
 
+    def test_poll_page_queries(self):
+        self.topic.poll_type = Topic.POLL_TYPE_MULTIPLE
+        self.topic.save()
+        answers = [PollAnswer.objects.create(topic=self.topic, text='answer%d' % i) for i in range(5)]
+        other = User.objects.create_user('other', 'other@localhost', 'other')
+        Topic.objects.get(pk=self.topic.pk).add_poll_votes(other, answers[:2])
+        self.assertEqual(Topic.objects.get(pk=self.topic.pk).poll_vote_count, 2)
+        self.assertEqual([a.vote_count for a in PollAnswer.objects.order_by('pk')], [1, 1, 0, 0, 0])
+
+        self.client.login(username='other', password='other')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.topic.get_absolute_url())
+        self.assertContains(response, '50.00 %')
+        poll_queries = [q['sql'] for q in queries.captured_queries if 'pybb_pollanswer' in q['sql']]
+        # answers with their tallies and voted state of user
+        self.assertEqual(len(poll_queries), 2)
+
+    def test_poll_vote_changes(self):
+        self.topic.poll_type = Topic.POLL_TYPE_MULTIPLE
+        self.topic.save()
+        answers = [PollAnswer.objects.create(topic=self.topic, text='answer%d' % i) for i in range(3)]
+        self.login_client()
+        vote_url = reverse('pybb:topic_poll_vote', kwargs={'pk': self.topic.id})
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(vote_url, data={'answers': [a.id for a in answers]}, follow=True)
+        self.assertEqual(response.status_code, 200)
+        inserts = [q['sql'] for q in queries.captured_queries if 'INSERT INTO "pybb_pollansweruser"' in q['sql']]
+        self.assertEqual(len(inserts), 1)
+        self.assertEqual([a.vote_count for a in PollAnswer.objects.order_by('pk')], [1, 1, 1])
+
+        # vote of user who has voted already doesn't change tallies
+        topic = Topic.objects.get(pk=self.topic.pk)
+        self.assertFalse(topic.add_poll_votes(self.user, answers[:1]))
+        self.assertEqual(Topic.objects.get(pk=self.topic.pk).poll_vote_count, 3)
+
+        self.assertEqual(topic.cancel_poll_votes(self.user), 3)
+        self.assertEqual(topic.cancel_poll_votes(self.user), 0)
+        self.assertEqual(Topic.objects.get(pk=self.topic.pk).poll_vote_count, 0)
+        self.assertEqual([a.vote_count for a in PollAnswer.objects.order_by('pk')], [0, 0, 0])
+
     def test_poll_voting_on_closed_topic(self):
         self.login_client()
         self.topic.poll_type = Topic.POLL_TYPE_SINGLE
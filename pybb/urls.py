@@ -11,7 +11,8 @@ from pybb.views import IndexView, CategoryView, ForumView, TopicView,\
     AddPostView, EditPostView, UserView, PostView, ProfileEditView,\
     DeletePostView, StickTopicView, UnstickTopicView, CloseTopicView,\
     OpenTopicView, ModeratePost, TopicPollVoteView, LatestTopicsView,\
-    UserTopics, UserPosts, topic_cancel_poll_vote
+    UserTopics, UserPosts, TopicSubscribersView, MoveTopicsView, MergeTopicsView, SplitTopicView, \
+    ModerationQueueView, SearchView, topic_cancel_poll_vote
 
 
 urlpatterns = patterns('',
@@ -25,6 +26,8 @@ urlpatterns += patterns('pybb.views',
                         url('^$', IndexView.as_view(), name='index'),
                         url('^category/(?P<pk>\d+)/$', CategoryView.as_view(), name='category'),
                         url('^forum/(?P<pk>\d+)/$', ForumView.as_view(), name='forum'),
+                        url('^forum/(?P<pk>\d+)/moderation/$', ModerationQueueView.as_view(),
+                            name='moderation_queue'),
 
                         # User
                         url('^users/(?P<username>[^/]+)/$', UserView.as_view(), name='user'),
@@ -42,9 +45,17 @@ urlpatterns += patterns('pybb.views',
                         url('^topic/(?P<pk>\d+)/unstick/$', UnstickTopicView.as_view(), name='unstick_topic'),
                         url('^topic/(?P<pk>\d+)/close/$', CloseTopicView.as_view(), name='close_topic'),
                         url('^topic/(?P<pk>\d+)/open/$', OpenTopicView.as_view(), name='open_topic'),
+                        url('^topic/(?P<pk>\d+)/subscribers/$', TopicSubscribersView.as_view(),
+                            name='topic_subscribers'),
                         url('^topic/(?P<pk>\d+)/poll_vote/$', TopicPollVoteView.as_view(), name='topic_poll_vote'),
                         url('^topic/(?P<pk>\d+)/cancel_poll_vote/$', topic_cancel_poll_vote, name='topic_cancel_poll_vote'),
                         url('^topic/latest/$', LatestTopicsView.as_view(), name='topic_latest'),
+                        url('^topic/move/$', MoveTopicsView.as_view(), name='move_topics'),
+                        url('^topic/merge/$', MergeTopicsView.as_view(), name='merge_topics'),
+                        url('^topic/(?P<pk>\d+)/split/$', SplitTopicView.as_view(), name='split_topic'),
+
+                        # Search
+                        url('^search/$', SearchView.as_view(), name='search'),
 
                         # Add topic/post
                         url('^forum/(?P<forum_id>\d+)/topic/add/$', AddPostView.as_view(), name='add_topic'),
@@ -76,10 +76,41 @@ def get_pybb_profile_model():
 def build_cache_key(key_name, **kwargs):
     if key_name == 'anonymous_topic_views':
         return 'pybbm_anonymous_topic_%s_views' % kwargs['topic_id']
+    elif key_name == 'page_cache_version':
+        return 'pybbm_page_cache_version_%s' % kwargs['name']
+    elif key_name == 'anonymous_page':
+        return 'pybbm_anonymous_page_%s' % kwargs['hash']
+    elif key_name == 'rendered_markup':
+        return 'pybbm_rendered_markup_%s' % kwargs['hash']
+    elif key_name == 'topic_views':
+        return 'pybbm_topic_%s_views_%s' % (kwargs['topic_id'], kwargs['shard'])
+    elif key_name == 'topic_viewer':
+        return 'pybbm_topic_%s_viewer_%s' % (kwargs['topic_id'], kwargs['hash'])
+    elif key_name == 'topic_views_flush_lock':
+        return 'pybbm_topic_views_flush_lock'
     else:
         raise ValueError('Wrong key_name parameter passed: %s' % key_name)
 
 
+def iter_id_chunks(qs, chunk_size, from_id=None, to_id=None):
+    """
+    Yield (first pk, last pk) of consecutive chunks of `qs` with `chunk_size` rows,
+    optionally only from `from_id` to `to_id` inclusive
+    """
+    if from_id is not None:
+        qs = qs.filter(pk__gte=from_id)
+    if to_id is not None:
+        qs = qs.filter(pk__lte=to_id)
+    qs = qs.order_by('pk').values_list('pk', flat=True)
+    last_id = None
+    while True:
+        ids = list((qs.filter(pk__gt=last_id) if last_id is not None else qs)[:chunk_size])
+        if not ids:
+            return
+        last_id = ids[-1]
+        yield ids[0], last_id
+
+
 def get_file_path(instance, filename, to):
     """
     This function generate filename with uuid4
@@ -9,9 +9,8 @@ from django.core.exceptions import PermissionDenied
 from django.core.urlresolvers import reverse
 from django.contrib import messages
 from django.db.models import F, Q
-from django.db.models.aggregates import Count
 from django.http import HttpResponseRedirect, HttpResponse, Http404, HttpResponseBadRequest,\
-    HttpResponseForbidden
+    HttpResponseForbidden, HttpResponseNotModified
 from django.shortcuts import get_object_or_404, redirect, render
 from django.utils.translation import ugettext as _
 from django.utils.decorators import method_decorator
@@ -20,6 +19,7 @@ from django.views.generic.edit import ModelFormMixin
 from django.views.decorators.csrf import csrf_protect
 from django.views import generic
 from pybb.util import build_cache_key
+from pybb import caching, counters, markup, moderation, search, tasks
 
 try:
     from pure_pagination import Paginator
@@ -33,8 +33,10 @@ except ImportError:
     Page.pages = lambda self: [PageRepr(i) for i in range(1, self.paginator.num_pages + 1)]
     pure_pagination = False
 
-from pybb.models import Category, Forum, Topic, Post, TopicReadTracker, ForumReadTracker, PollAnswerUser
-from pybb.forms import PostForm, AdminPostForm, AttachmentFormSet, PollAnswerFormSet, PollForm
+from pybb.models import Category, Forum, Topic, Post, TopicReadTracker, ForumReadTracker, \
+    PendingNotification
+from pybb.forms import PostForm, AdminPostForm, AttachmentFormSet, PollAnswerFormSet, PollForm, MoveTopicsForm, \
+    MergeTopicsForm, SplitTopicForm, SearchForm
 from pybb.templatetags.pybb_tags import pybb_topic_poll_not_voted
 from pybb import defaults
 
@@ -73,7 +75,64 @@ class RedirectToLoginMixin(object):
         return '/'
 
 
-class IndexView(generic.ListView):
+class AnonymousCacheMixin(object):
+    """ mixin which serves pages for anonymous users from cache if PYBB_ANONYMOUS_PAGE_CACHE_TIMEOUT is set,
+        answers with 304 Not Modified if PYBB_CONDITIONAL_GET is enabled and page was not changed and
+        marks pages with surrogate keys for caching proxy if PYBB_SURROGATE_KEY_HEADER is set.
+        Views inheriting from this should implement get_cache_dependencies(), which returns list of
+        version keys (see pybb.caching) which should invalidate cached page, and may implement
+        get_last_modified() and check_permissions().
+    """
+    def dispatch(self, request, *args, **kwargs):
+        # Permissions are checked before cached page or 304 is returned, so they don't reveal hidden pages
+        self.check_permissions()
+        # Pages of authenticated users show read marks, subscriptions and poll votes, which don't change
+        # versions of cache dependencies, so neither cache nor validators are used for them
+        if request.method not in ('GET', 'HEAD') or request.user.is_authenticated():
+            return super(AnonymousCacheMixin, self).dispatch(request, *args, **kwargs)
+        if not defaults.PYBB_CONDITIONAL_GET:
+            response = self.dispatch_cached(request, *args, **kwargs)
+        else:
+            last_modified = self.get_last_modified()
+            etag = caching.make_etag(request, self.get_cache_dependencies(), last_modified)
+            if caching.is_not_modified(request, etag, last_modified):
+                self.response_from_cache()
+                return HttpResponseNotModified()
+            response = self.dispatch_cached(request, *args, **kwargs)
+            if response.status_code == 200:
+                caching.set_validators(response, etag, last_modified)
+        if response.status_code == 200:
+            caching.set_surrogate_keys(response, self.get_cache_dependencies())
+        return response
+
+    def dispatch_cached(self, request, *args, **kwargs):
+        if not caching.is_cacheable_request(request):
+            return super(AnonymousCacheMixin, self).dispatch(request, *args, **kwargs)
+        key = caching.get_page_cache_key(request, self.get_cache_dependencies())
+        response = caching.get_cached_page(key)
+        if response is not None:
+            self.response_from_cache()
+            return response
+        response = super(AnonymousCacheMixin, self).dispatch(request, *args, **kwargs)
+        caching.cache_page(key, request, response)
+        return response
+
+    def get_cache_dependencies(self):
+        return [caching.INDEX, caching.STRUCTURE]
+
+    def get_last_modified(self):
+        return None
+
+    def check_permissions(self):
+        """ raise PermissionDenied if user may not view this page """
+        pass
+
+    def response_from_cache(self):
+        """ called when cached page or 304 response is returned instead of regular processing """
+        pass
+
+
+class IndexView(AnonymousCacheMixin, generic.ListView):
 
     template_name = 'pybb/index.html'
     context_object_name = 'categories'
@@ -90,7 +149,7 @@ class IndexView(generic.ListView):
         return perms.filter_categories(self.request.user, Category.objects.all())
 
 
-class CategoryView(RedirectToLoginMixin, generic.DetailView):
+class CategoryView(RedirectToLoginMixin, AnonymousCacheMixin, generic.DetailView):
 
     template_name = 'pybb/index.html'
     context_object_name = 'category'
@@ -98,14 +157,16 @@ class CategoryView(RedirectToLoginMixin, generic.DetailView):
     def get_login_redirect_url(self):
         return reverse('pybb:category', args=(self.kwargs['pk'],))
 
-    def get_queryset(self):
-        return Category.objects.all()
+    def get_cache_dependencies(self):
+        return [caching.category_version(self.kwargs['pk']), caching.STRUCTURE]
 
-    def get_object(self, queryset=None):
-        obj = super(CategoryView, self).get_object(queryset)
-        if not perms.may_view_category(self.request.user, obj):
+    def check_permissions(self):
+        self.category = get_object_or_404(Category.objects.all(), pk=self.kwargs['pk'])
+        if not perms.may_view_category(self.request.user, self.category):
             raise PermissionDenied
-        return obj
+
+    def get_object(self, queryset=None):
+        return self.category
 
     def get_context_data(self, **kwargs):
         ctx = super(CategoryView, self).get_context_data(**kwargs)
@@ -114,7 +175,7 @@ class CategoryView(RedirectToLoginMixin, generic.DetailView):
         return ctx
 
 
-class ForumView(RedirectToLoginMixin, PaginatorMixin, generic.ListView):
+class ForumView(RedirectToLoginMixin, AnonymousCacheMixin, PaginatorMixin, generic.ListView):
 
     paginate_by = defaults.PYBB_FORUM_PAGE_SIZE
     context_object_name = 'topic_list'
@@ -123,23 +184,35 @@ class ForumView(RedirectToLoginMixin, PaginatorMixin, generic.ListView):
     def get_login_redirect_url(self):
         return reverse('pybb:forum', args=(self.kwargs['pk'],))
 
+    def get_cache_dependencies(self):
+        return [caching.forum_version(self.kwargs['pk']), caching.STRUCTURE]
+
+    def get_last_modified(self):
+        forums = counters.with_pending(Forum.objects.filter(pk=self.kwargs['pk']))
+        return forums[0].updated if forums else None
+
     def get_context_data(self, **kwargs):
         ctx = super(ForumView, self).get_context_data(**kwargs)
         ctx['forum'] = self.forum
         ctx['forum'].forums_accessed = perms.filter_forums(self.request.user, self.forum.child_forums.all())
+        if defaults.PYBB_PREMODERATION and self.request.user.is_authenticated() and \
+                perms.filter_moderated_forums(self.request.user, Forum.objects.filter(pk=self.forum.pk)).exists():
+            ctx['moderation_queue_count'] = Post.objects.filter(topic__forum=self.forum, topic__deleted=False,
+                                                                on_moderation=True).count()
         return ctx
 
-    def get_queryset(self):
-        self.forum = get_object_or_404(Forum.objects.all(), pk=self.kwargs['pk'])
+    def check_permissions(self):
+        self.forum = get_object_or_404(Forum.objects.select_related('category'), pk=self.kwargs['pk'])
         if not perms.may_view_forum(self.request.user, self.forum):
             raise PermissionDenied
 
+    def get_queryset(self):
         qs = self.forum.topics.order_by('-sticky', '-updated').select_related()
         qs = perms.filter_topics(self.request.user, qs)
         return qs
 
 
-class LatestTopicsView(PaginatorMixin, generic.ListView):
+class LatestTopicsView(AnonymousCacheMixin, PaginatorMixin, generic.ListView):
 
     paginate_by = defaults.PYBB_FORUM_PAGE_SIZE
     context_object_name = 'topic_list'
@@ -151,7 +224,7 @@ class LatestTopicsView(PaginatorMixin, generic.ListView):
         return qs.order_by('-updated')
 
 
-class TopicView(RedirectToLoginMixin, PaginatorMixin, generic.ListView):
+class TopicView(RedirectToLoginMixin, AnonymousCacheMixin, PaginatorMixin, generic.ListView):
     paginate_by = defaults.PYBB_TOPIC_PAGE_SIZE
     template_object_name = 'post_list'
     template_name = 'pybb/topic.html'
@@ -176,8 +249,18 @@ class TopicView(RedirectToLoginMixin, PaginatorMixin, generic.ListView):
     def get_attachment_formset_class(self):
         return self.attachment_formset_class
 
+    def get_cache_dependencies(self):
+        return [caching.topic_version(self.topic.id), caching.STRUCTURE]
+
+    def get_last_modified(self):
+        return self.topic.updated
+
+    def response_from_cache(self):
+        self.update_views()
+
     def dispatch(self, request, *args, **kwargs):
-        self.topic = get_object_or_404(Topic.objects.select_related('forum'), pk=kwargs['pk'])
+        self.topic = get_object_or_404(Topic.objects.select_related('forum', 'forum__category'), pk=kwargs['pk'],
+                                       deleted=False)
 
         if request.GET.get('first-unread'):
             if request.user.is_authenticated():
@@ -203,10 +286,29 @@ class TopicView(RedirectToLoginMixin, PaginatorMixin, generic.ListView):
 
         return super(TopicView, self).dispatch(request, *args, **kwargs)
 
-    def get_queryset(self):
+    def check_permissions(self):
         if not perms.may_view_topic(self.request.user, self.topic):
             raise PermissionDenied
-        if self.request.user.is_authenticated() or not defaults.PYBB_ANONYMOUS_VIEWS_CACHE_BUFFER:
+
+    def get_queryset(self):
+        self.update_views()
+        qs = self.topic.posts.all().select_related('user')
+        if defaults.PYBB_PROFILE_RELATED_NAME:
+            qs = qs.select_related('user__%s' % defaults.PYBB_PROFILE_RELATED_NAME)
+        if not perms.may_moderate_topic(self.request.user, self.topic):
+            qs = perms.filter_posts(self.request.user, qs)
+        return qs
+
+    def update_views(self):
+        if self.request.user.is_authenticated():
+            viewer = 'user:%s' % self.request.user.pk
+        else:
+            viewer = 'ip:%s' % self.request.META.get('REMOTE_ADDR', '')
+        if not counters.is_new_view(self.topic.id, viewer):
+            return
+        if defaults.PYBB_TOPIC_VIEWS_BUFFER:
+            counters.record_topic_view(self.topic.id)
+        elif self.request.user.is_authenticated() or not defaults.PYBB_ANONYMOUS_VIEWS_CACHE_BUFFER:
             Topic.objects.filter(id=self.topic.id).update(views=F('views') + 1)
         else:
             cache_key = build_cache_key('anonymous_topic_views', topic_id=self.topic.id)
@@ -215,19 +317,15 @@ class TopicView(RedirectToLoginMixin, PaginatorMixin, generic.ListView):
                 Topic.objects.filter(id=self.topic.id).update(views=F('views') +
                                                                     defaults.PYBB_ANONYMOUS_VIEWS_CACHE_BUFFER)
                 cache.set(cache_key, 0)
-        qs = self.topic.posts.all().select_related('user')
-        if defaults.PYBB_PROFILE_RELATED_NAME:
-            qs = qs.select_related('user__%s' % defaults.PYBB_PROFILE_RELATED_NAME)
-        if not perms.may_moderate_topic(self.request.user, self.topic):
-            qs = perms.filter_posts(self.request.user, qs)
-        return qs
 
     def get_context_data(self, **kwargs):
         ctx = super(TopicView, self).get_context_data(**kwargs)
 
         if self.request.user.is_authenticated():
             self.request.user.is_moderator = perms.may_moderate_topic(self.request.user, self.topic)
-            self.request.user.is_subscribed = self.request.user in self.topic.subscribers.all()
+            self.request.user.is_subscribed = self.topic.subscribers.filter(pk=self.request.user.pk).exists()
+            if self.request.user.is_staff:
+                ctx['subscriber_count'] = self.topic.subscribers.count()
             if perms.may_post_as_admin(self.request.user):
                 ctx['form'] = self.get_admin_post_form_class()(
                     initial={'login': getattr(self.request.user, username_field)},
@@ -305,6 +403,12 @@ class PostEditMixin(object):
         return ctx
 
     def form_valid(self, form):
+        # topic, post, attachments and poll answers are saved in one transaction,
+        # notifications are sent after commit
+        with tasks.atomic():
+            return self.save_post(form)
+
+    def save_post(self, form):
         success = True
         save_attachments = False
         save_poll_answers = False
@@ -332,17 +436,22 @@ class PostEditMixin(object):
                 else:
                     self.object.topic.poll_question = None
                     self.object.topic.poll_answers.all().delete()
+                    self.object.topic.poll_vote_count = 0
         else:
             pollformset = None
 
         if success:
-            self.object.topic.save()
+            # topic of new reply is not changed by form
+            if self.object.pk or not self.object.topic.pk:
+                self.object.topic.save()
             self.object.topic = self.object.topic
             self.object.save()
             if save_attachments:
                 aformset.save()
             if save_poll_answers:
                 pollformset.save()
+                # votes of deleted answers are deleted too
+                self.object.topic.update_poll_votes()
             return super(ModelFormMixin, self).form_valid(form)
         else:
             return self.render_to_response(self.get_context_data(form=form, aformset=aformset, pollformset=pollformset))
@@ -436,6 +545,26 @@ class EditPostView(PostEditMixin, generic.UpdateView):
         return post
 
 
+class TopicSubscribersView(PaginatorMixin, generic.ListView):
+    paginate_by = defaults.PYBB_FORUM_PAGE_SIZE
+    template_name = 'pybb/topic_subscribers.html'
+    context_object_name = 'subscriber_list'
+
+    def dispatch(self, request, *args, **kwargs):
+        self.topic = get_object_or_404(Topic.objects.select_related('forum'), pk=kwargs['pk'])
+        if not request.user.is_staff or not perms.may_view_topic(request.user, self.topic):
+            raise PermissionDenied
+        return super(TopicSubscribersView, self).dispatch(request, *args, **kwargs)
+
+    def get_queryset(self):
+        return self.topic.subscribers.order_by(username_field)
+
+    def get_context_data(self, **kwargs):
+        ctx = super(TopicSubscribersView, self).get_context_data(**kwargs)
+        ctx['topic'] = self.topic
+        return ctx
+
+
 class UserView(generic.DetailView):
     model = User
     template_name = 'pybb/user.html'
@@ -475,6 +604,31 @@ class UserPosts(PaginatorMixin, generic.ListView):
         return context
 
 
+class SearchView(PaginatorMixin, generic.ListView):
+    paginate_by = defaults.PYBB_TOPIC_PAGE_SIZE
+    template_name = 'pybb/search.html'
+    context_object_name = 'post_list'
+
+    def dispatch(self, request, *args, **kwargs):
+        if search.get_backend() is None:
+            raise Http404
+        return super(SearchView, self).dispatch(request, *args, **kwargs)
+
+    def get_queryset(self):
+        self.form = SearchForm(self.request.GET or None)
+        if not self.form.is_valid():
+            return Post.objects.none()
+        qs = perms.filter_posts(self.request.user, Post.objects.all())
+        qs = search.search_posts(self.form.cleaned_data['q'], qs)
+        return qs.select_related('topic', 'user').order_by('-created', '-id')
+
+    def get_context_data(self, **kwargs):
+        ctx = super(SearchView, self).get_context_data(**kwargs)
+        ctx['form'] = self.form
+        ctx['query'] = self.form.cleaned_data['q'] if self.form.is_valid() else ''
+        return ctx
+
+
 class UserTopics(PaginatorMixin, generic.ListView):
     model = Topic
     paginate_by = defaults.PYBB_FORUM_PAGE_SIZE
@@ -517,11 +671,45 @@ class ModeratePost(generic.RedirectView):
         post = get_object_or_404(Post, pk=self.kwargs['pk'])
         if not perms.may_moderate_topic(self.request.user, post.topic):
             raise PermissionDenied
-        post.on_moderation = False
-        post.save()
+        moderation.approve_posts(Post.objects.filter(pk=post.pk))
         return post.get_absolute_url()
 
 
+class ModerationQueueView(PaginatorMixin, generic.ListView):
+    """
+    Premoderated posts of forum, selected posts are approved or rejected at once
+    """
+    paginate_by = defaults.PYBB_TOPIC_PAGE_SIZE
+    template_name = 'pybb/moderation_queue.html'
+    context_object_name = 'post_list'
+
+    @method_decorator(login_required)
+    def dispatch(self, request, *args, **kwargs):
+        self.forum = get_object_or_404(Forum, pk=kwargs['pk'])
+        if not perms.filter_moderated_forums(request.user, Forum.objects.filter(pk=self.forum.pk)).exists():
+            raise PermissionDenied
+        return super(ModerationQueueView, self).dispatch(request, *args, **kwargs)
+
+    def get_queryset(self):
+        return Post.objects.filter(topic__forum=self.forum, topic__deleted=False, on_moderation=True)\
+            .select_related('topic', 'user').order_by('created')
+
+    def get_context_data(self, **kwargs):
+        ctx = super(ModerationQueueView, self).get_context_data(**kwargs)
+        ctx['forum'] = self.forum
+        return ctx
+
+    def post(self, request, *args, **kwargs):
+        posts = self.get_queryset().filter(pk__in=[pk for pk in request.POST.getlist('posts') if pk.isdigit()])
+        if 'approve' in request.POST:
+            count = moderation.approve_posts(posts)
+            messages.success(request, _('%d posts approved') % count, fail_silently=True)
+        elif 'reject' in request.POST:
+            count = moderation.reject_posts(posts)
+            messages.success(request, _('%d posts rejected') % count, fail_silently=True)
+        return redirect(reverse('pybb:moderation_queue', args=[self.forum.pk]))
+
+
 class ProfileEditView(generic.UpdateView):
 
     template_name = 'pybb/edit_profile.html'
@@ -571,7 +759,7 @@ class DeletePostView(generic.DeleteView):
 
     def get_success_url(self):
         try:
-            Topic.objects.get(pk=self.topic.id)
+            Topic.objects.get(pk=self.topic.id, deleted=False)
         except Topic.DoesNotExist:
             return self.forum.get_absolute_url()
         else:
@@ -628,6 +816,86 @@ class OpenTopicView(TopicActionBaseView):
         topic.save()
 
 
+class TopicsModerationView(generic.FormView):
+    """
+    Base view for actions on several topics selected with `topic` GET parameters
+    """
+
+    @method_decorator(login_required)
+    def dispatch(self, request, *args, **kwargs):
+        if not perms.filter_moderated_forums(request.user, Forum.objects.all()).exists():
+            raise PermissionDenied
+        return super(TopicsModerationView, self).dispatch(request, *args, **kwargs)
+
+    def get_initial(self):
+        return {'topics': self.request.GET.getlist('topic')}
+
+    def get_form_kwargs(self):
+        kwargs = super(TopicsModerationView, self).get_form_kwargs()
+        kwargs['user'] = self.request.user
+        return kwargs
+
+    def get_context_data(self, **kwargs):
+        ctx = super(TopicsModerationView, self).get_context_data(**kwargs)
+        form = ctx['form']
+        ids = form.data.getlist('topics') if form.is_bound else form.initial['topics']
+        ctx['topic_list'] = form.fields['topics'].queryset.filter(pk__in=[pk for pk in ids if pk.isdigit()])
+        return ctx
+
+
+class MoveTopicsView(TopicsModerationView):
+    template_name = 'pybb/move_topics.html'
+    form_class = MoveTopicsForm
+
+    def form_valid(self, form):
+        forum = form.cleaned_data['forum']
+        count = moderation.move_topics(form.cleaned_data['topics'], forum)
+        messages.success(self.request, _('%d topics moved') % count, fail_silently=True)
+        return redirect(forum.get_absolute_url())
+
+
+class MergeTopicsView(TopicsModerationView):
+    template_name = 'pybb/merge_topics.html'
+    form_class = MergeTopicsForm
+
+    def form_valid(self, form):
+        target = form.cleaned_data['target']
+        count = moderation.merge_topics(form.cleaned_data['topics'], target)
+        messages.success(self.request, _('%d topics merged') % count, fail_silently=True)
+        return redirect(target.get_absolute_url())
+
+
+class SplitTopicView(generic.FormView):
+    template_name = 'pybb/split_topic.html'
+    form_class = SplitTopicForm
+
+    @method_decorator(login_required)
+    def dispatch(self, request, *args, **kwargs):
+        self.topic = get_object_or_404(Topic.objects.select_related('forum'), pk=kwargs['pk'], deleted=False)
+        if not perms.may_moderate_topic(request.user, self.topic):
+            raise PermissionDenied
+        return super(SplitTopicView, self).dispatch(request, *args, **kwargs)
+
+    def get_initial(self):
+        return {'posts': self.request.GET.getlist('post'), 'forum': self.topic.forum_id}
+
+    def get_form_kwargs(self):
+        kwargs = super(SplitTopicView, self).get_form_kwargs()
+        kwargs['topic'] = self.topic
+        kwargs['user'] = self.request.user
+        return kwargs
+
+    def get_context_data(self, **kwargs):
+        ctx = super(SplitTopicView, self).get_context_data(**kwargs)
+        ctx['topic'] = self.topic
+        return ctx
+
+    def form_valid(self, form):
+        topic = moderation.split_posts(form.cleaned_data['posts'], form.cleaned_data['name'],
+                                       form.cleaned_data['forum'])
+        return redirect(topic.get_absolute_url())
+
+
 class TopicPollVoteView(generic.UpdateView):
     model = Topic
     http_method_names = ['post', ]
@@ -643,18 +911,18 @@ class TopicPollVoteView(generic.UpdateView):
         return kwargs
 
     def form_valid(self, form):
-        # already voted
-        if not perms.may_vote_in_topic(self.request.user, self.object) or \
-           not pybb_topic_poll_not_voted(self.object, self.request.user):
+        # closed topic or already voted
+        if not perms.may_vote_in_topic(self.request.user, self.object):
             return HttpResponseForbidden()
 
         answers = form.cleaned_data['answers']
-        for answer in answers:
-            # poll answer from another topic
-            if answer.topic != self.object:
-                return HttpResponseBadRequest()
+        # poll answer from another topic
+        if any(answer.topic_id != self.object.pk for answer in answers):
+            return HttpResponseBadRequest()
 
-            PollAnswerUser.objects.create(poll_answer=answer, user=self.request.user)
+        # user could vote in concurrent request after the check above
+        if not self.object.add_poll_votes(self.request.user, answers):
+            return HttpResponseForbidden()
         return super(ModelFormMixin, self).form_valid(form)
 
     def form_invalid(self, form):
@@ -667,7 +935,7 @@ class TopicPollVoteView(generic.UpdateView):
 @login_required
 def topic_cancel_poll_vote(request, pk):
     topic = get_object_or_404(Topic, pk=pk)
-    PollAnswerUser.objects.filter(user=request.user, poll_answer__topic_id=topic.id).delete()
+    topic.cancel_poll_votes(request.user)
     return HttpResponseRedirect(topic.get_absolute_url())
 
 
@@ -675,6 +943,7 @@ def topic_cancel_poll_vote(request, pk):
 def delete_subscription(request, topic_id):
     topic = get_object_or_404(perms.filter_topics(request.user, Topic.objects.all()), pk=topic_id)
     topic.subscribers.remove(request.user)
+    PendingNotification.objects.filter(user=request.user, post__topic=topic).delete()
     return HttpResponseRedirect(topic.get_absolute_url())
 
 
@@ -688,7 +957,9 @@ def add_subscription(request, topic_id):
 @login_required
 def post_ajax_preview(request):
     content = request.POST.get('data')
-    html = defaults.PYBB_MARKUP_ENGINES[defaults.PYBB_MARKUP](content)
+    html = markup.render_within_limits(content)
+    if html is None:
+        html = markup.render_placeholder(content)
     return render(request, 'pybb/_markitup_preview.html', {'html': html})
 
 
@@ -709,15 +980,9 @@ def block_user(request, username):
     user = get_object_or_404(User, **{username_field: username})
     if not perms.may_block_user(request.user, user):
         raise PermissionDenied
-    user.is_active = False
-    user.save()
-    if 'block_and_delete_messages' in request.POST:
-        # individually delete each post and empty topic to fire method
-        # with forum/topic counters recalculation
-        for p in Post.objects.filter(user=user):
-            p.delete()
-        for t in Topic.objects.annotate(cnt=Count('posts')).filter(cnt=0):
-            t.delete()
+    in_background = moderation.block_user(user, delete_posts='block_and_delete_messages' in request.POST)
+    if in_background:
+        messages.info(request, _('User posts will be deleted in background'), fail_silently=True)
     msg = _('User successfuly blocked')
     messages.success(request, msg, fail_silently=True)
     return redirect('pybb:index')
@@ -1,6 +1,8 @@
 #!/usr/bin/env python
 import sys
 import os
+import shutil
+import tempfile
 from os.path import dirname, abspath
 from optparse import OptionParser
 
@@ -17,6 +19,9 @@ TEMPLATE_CONTEXT_PROCESSORS = [
     'django.core.context_processors.tz'
 ]
 
+# Uploaded attachments go to temporary directory, which is removed after tests
+MEDIA_ROOT = tempfile.mkdtemp(prefix='pybb-test-media-')
+
 # For convenience configure settings if they are not pre-configured or if we
 # haven't been provided settings to use by environment variable.
 if not settings.configured and not os.environ.get('DJANGO_SETTINGS_MODULE'):
@@ -39,6 +44,7 @@ if not settings.configured and not os.environ.get('DJANGO_SETTINGS_MODULE'):
         DEBUG=False,
         SITE_ID=1,
         STATIC_URL='/static/',
+        MEDIA_ROOT=MEDIA_ROOT,
         TEMPLATE_DIRS=(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test/test_project/templates'), ),
         PYBB_ATTACHMENT_ENABLE=True,
         TEMPLATE_CONTEXT_PROCESSORS=TEMPLATE_CONTEXT_PROCESSORS,
@@ -62,7 +68,10 @@ def runtests(*test_args, **kwargs):
     sys.path.insert(0, parent)
     test_runner = Runner(verbosity=kwargs.get('verbosity', 1), interactive=kwargs.get('interactive', False),
                          failfast=kwargs.get('failfast'))
-    failures = test_runner.run_tests(test_args)
+    try:
+        failures = test_runner.run_tests(test_args)
+    finally:
+        shutil.rmtree(MEDIA_ROOT, ignore_errors=True)
     sys.exit(failures)
 
 if __name__ == '__main__':
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark of markdown markup engine.
+
+Compares pybb.defaults.MarkdownEngine with the former engine, which built new
+Markdown instance for every text and made separate urlize and smile_it passes
+over the output. Run from the project root:
+
+    python test/benchmarks/markdown_engine.py
+"""
+from __future__ import unicode_literals, print_function
+import os
+import random
+import sys
+import threading
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from django.conf import settings
+
+if not settings.configured:
+    settings.configure(STATIC_URL='/static/')
+
+from django.utils.html import urlize
+from markdown import Markdown
+
+from pybb import defaults
+
+
+def lambda_engine(text):
+    return urlize(defaults.smile_it(Markdown(safe_mode='escape').convert(text)))
+
+
+def make_text(size):
+    words = ['lorem', 'ipsum', 'dolor', 'sit', 'amet,', 'consectetur', 'adipiscing', 'elit', 'sed', 'do',
+             'eiusmod', 'tempor', '**bold**', '*em*', 'end.', 'yes:', ':)', ';)', ':D', '`code`', '\n\n', '\n* item']
+    links = ['http://example.com/', 'www.example.org', 'mail@example.com']
+    rnd = random.Random(size)
+    text, length = [], 0
+    while length < size:
+        # about one link per 50 words
+        text.append(rnd.choice(links) if rnd.random() < 0.02 else rnd.choice(words))
+        length += len(text[-1]) + 1
+    return ' '.join(text)
+
+
+def throughput(engine, texts, threads):
+    def work():
+        for text in texts:
+            engine(text)
+    workers = [threading.Thread(target=work) for _ in range(threads)]
+    start = timeit.default_timer()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return len(texts) * threads / (timeit.default_timer() - start)
+
+
+def run(text_size, count, threads=1):
+    texts = [make_text(text_size + i) for i in range(count)]
+    engine = defaults.MarkdownEngine(safe_mode='escape')
+    for text in texts:
+        assert engine(text) == lambda_engine(text)
+    old = throughput(lambda_engine, texts, threads)
+    new = throughput(engine, texts, threads)
+    print('%8d chars, %d threads: lambda %8.1f texts/s, MarkdownEngine %8.1f texts/s, x%.2f' %
+          (text_size, threads, old, new, new / old))
+
+
+if __name__ == '__main__':
+    run(100, 2000)
+    run(1000, 1000)
+    run(10000, 100)
+    run(100000, 10)
+    run(1000, 250, threads=4)
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark of emoticons substitution in rendered html.
+
+Compares pybb.defaults.smile_it with the former implementation (one str.replace
+pass per emoticon) on large bodies and large emoticons maps. Run from the
+project root:
+
+    python test/benchmarks/smiles.py
+"""
+from __future__ import unicode_literals, print_function
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from django.conf import settings
+
+if not settings.configured:
+    settings.configure(STATIC_URL='/static/')
+
+from pybb import defaults
+
+
+def replace_smile_it(text):
+    for smile, url in defaults.PYBB_SMILES.items():
+        text = text.replace(smile, '<img src="%s%s%s" alt="smile" />' %
+                            (settings.STATIC_URL, defaults.PYBB_SMILES_PREFIX, url))
+    return text
+
+
+def make_body(size, smiles):
+    words = ['lorem', 'ipsum', 'dolor', 'sit', 'amet,', '<strong>bold</strong>', '<br />'] + list(smiles)
+    rnd = random.Random(size)
+    body, length = [], 0
+    while length < size:
+        body.append(rnd.choice(words))
+        length += len(body[-1]) + 1
+    return ' '.join(body)
+
+
+def make_smiles(count):
+    smiles = dict(defaults.PYBB_SMILES)
+    for i in range(count - len(smiles)):
+        smiles[':smile%d:' % i] = 'smile%d.png' % i
+    return smiles
+
+
+def run(smiles_count, body_size, number=20):
+    defaults.PYBB_SMILES = make_smiles(smiles_count)
+    body = make_body(body_size, list(defaults.PYBB_SMILES)[:50])
+    assert defaults.smile_it(body) == replace_smile_it(body)
+    old = timeit.timeit(lambda: replace_smile_it(body), number=number) / number
+    new = timeit.timeit(lambda: defaults.smile_it(body), number=number) / number
+    print('%6d smiles, %8d chars: str.replace %8.2f ms, single pass %8.2f ms, x%.1f' %
+          (smiles_count, body_size, old * 1000, new * 1000, old / new))
+
+
+if __name__ == '__main__':
+    for smiles_count in (12, 200, 2000):
+        for body_size in (1000, 100000, 1000000):
+            run(smiles_count, body_size, number=3 if body_size > 100000 else 20)